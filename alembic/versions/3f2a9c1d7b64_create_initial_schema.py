@@ -0,0 +1,114 @@
+"""create initial schema
+
+Revision ID: 3f2a9c1d7b64
+Revises:
+Create Date: 2022-07-04 09:12:45.318204+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c1d7b64'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('username', sa.String(), nullable=False),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('disabled', sa.Boolean(), nullable=True),
+        sa.Column('hashed_password', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('username'),
+    )
+    op.create_table(
+        'refresh_tokens',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('user_id', sa.String(length=22), nullable=False),
+        sa.Column('family_id', sa.String(length=22), nullable=False),
+        sa.Column('digest', sa.String(length=32), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('rotated_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('digest'),
+    )
+    op.create_index(op.f('ix_refresh_tokens_expires_at'), 'refresh_tokens', ['expires_at'], unique=False)
+    op.create_index(op.f('ix_refresh_tokens_family_id'), 'refresh_tokens', ['family_id'], unique=False)
+    op.create_table(
+        'api_keys',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('user_id', sa.String(length=22), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('prefix', sa.String(length=12), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('prefix'),
+    )
+    op.create_index(op.f('ix_api_keys_user_id'), 'api_keys', ['user_id'], unique=False)
+    op.create_table(
+        'collections',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('owner_id', sa.String(length=22), nullable=True),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('cursor_value', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_collections_cursor_value'), 'collections', ['cursor_value'], unique=True)
+    op.create_table(
+        'items',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('owner_id', sa.String(length=22), nullable=True),
+        sa.Column('collection_id', sa.String(length=22), nullable=True),
+        sa.Column('data_type', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('cursor_value', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['collection_id'], ['collections.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_items_cursor_value'), 'items', ['cursor_value'], unique=True)
+    op.create_table(
+        'chunks',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('item_id', sa.String(length=22), nullable=True),
+        sa.Column('index', sa.Integer(), nullable=True),
+        sa.Column('body', sa.LargeBinary(), nullable=True),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('uk_chunk_item_id_index', 'chunks', ['item_id', 'index'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uk_chunk_item_id_index', table_name='chunks')
+    op.drop_table('chunks')
+    op.drop_index(op.f('ix_items_cursor_value'), table_name='items')
+    op.drop_table('items')
+    op.drop_index(op.f('ix_collections_cursor_value'), table_name='collections')
+    op.drop_table('collections')
+    op.drop_index(op.f('ix_api_keys_user_id'), table_name='api_keys')
+    op.drop_table('api_keys')
+    op.drop_index(op.f('ix_refresh_tokens_family_id'), table_name='refresh_tokens')
+    op.drop_index(op.f('ix_refresh_tokens_expires_at'), table_name='refresh_tokens')
+    op.drop_table('refresh_tokens')
+    op.drop_table('users')
@@ -0,0 +1,61 @@
+"""share chunk data
+
+Revision ID: a9d3e5c7b2f1
+Revises: f3b8c1d6e4a7
+Create Date: 2022-08-29 09:17:44.538120+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3e5c7b2f1'
+down_revision = 'f3b8c1d6e4a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.rename_table('chunk_data', 'item_chunk_data')
+    op.create_table(
+        'chunk_data',
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('body', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('digest'),
+    )
+    # the same digest may have been archived for several items; keep one body each
+    op.execute(
+        "INSERT INTO chunk_data (digest, body) SELECT d.digest, d.body FROM item_chunk_data d "
+        "WHERE d.item_id = (SELECT MIN(e.item_id) FROM item_chunk_data e WHERE e.digest = d.digest)"
+    )
+    op.drop_table('item_chunk_data')
+    op.create_index('ix_chunks_digest', 'chunks', ['digest'])
+    op.create_index('ix_item_version_chunks_digest', 'item_version_chunks', ['digest'])
+
+
+def downgrade():
+    op.drop_index('ix_item_version_chunks_digest', table_name='item_version_chunks')
+    op.drop_index('ix_chunks_digest', table_name='chunks')
+    # copies only refer to their bodies by digest, either in chunk_data or in a chunk that stores it
+    op.execute(
+        "UPDATE chunks SET body = COALESCE("
+        "(SELECT chunk_data.body FROM chunk_data WHERE chunk_data.digest = chunks.digest), "
+        "(SELECT h.body FROM chunks h WHERE h.digest = chunks.digest AND h.body IS NOT NULL LIMIT 1)) "
+        "WHERE body IS NULL"
+    )
+    op.rename_table('chunk_data', 'shared_chunk_data')
+    op.create_table(
+        'chunk_data',
+        sa.Column('item_id', sa.String(length=22), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('body', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('item_id', 'digest'),
+    )
+    op.execute(
+        "INSERT INTO chunk_data (item_id, digest, body) "
+        "SELECT DISTINCT v.item_id, s.digest, s.body FROM shared_chunk_data s "
+        "JOIN item_version_chunks c ON c.digest = s.digest JOIN item_versions v ON v.id = c.version_id"
+    )
+    op.drop_table('shared_chunk_data')
@@ -0,0 +1,40 @@
+"""add item documents
+
+Revision ID: c5d7e3f1a2b8
+Revises: 8b1e4d2a6c90
+Create Date: 2022-07-25 08:47:19.104628+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d7e3f1a2b8'
+down_revision = '8b1e4d2a6c90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.add_column(
+            sa.Column('document', sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'), nullable=True)
+        )
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_index(
+            'ix_items_document',
+            'items',
+            ['document'],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_ops={'document': 'jsonb_path_ops'},
+        )
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_items_document', table_name='items')
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.drop_column('document')
@@ -0,0 +1,46 @@
+"""add item search
+
+Revision ID: d4a9b6e2f017
+Revises: c5d7e3f1a2b8
+Create Date: 2022-08-01 09:12:44.381920+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a9b6e2f017'
+down_revision = 'c5d7e3f1a2b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.add_column(
+            sa.Column('search_vector', sa.Text().with_variant(postgresql.TSVECTOR(), 'postgresql'), nullable=True)
+        )
+    if op.get_bind().dialect.name == 'postgresql':
+        op.create_index('ix_items_search_vector', 'items', ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_table(
+        'item_terms',
+        sa.Column('item_id', sa.String(length=22), nullable=False),
+        sa.Column('term', sa.String(length=64), nullable=False),
+        sa.Column('owner_id', sa.String(length=22), nullable=False),
+        sa.Column('collection_id', sa.String(length=22), nullable=False),
+        sa.Column('weight', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('item_id', 'term'),
+    )
+    op.create_index('ix_item_terms_owner_id_term', 'item_terms', ['owner_id', 'term', 'collection_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_item_terms_owner_id_term', table_name='item_terms')
+    op.drop_table('item_terms')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_items_search_vector', table_name='items')
+    with op.batch_alter_table('items') as batch_op:
+        batch_op.drop_column('search_vector')
@@ -0,0 +1,37 @@
+"""create item derivatives
+
+Revision ID: e7c2f5a8d391
+Revises: d4a9b6e2f017
+Create Date: 2022-08-08 14:05:31.726384+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7c2f5a8d391'
+down_revision = 'd4a9b6e2f017'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'item_derivatives',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('item_id', sa.String(length=22), nullable=False),
+        sa.Column('variant', sa.String(), nullable=False),
+        sa.Column('media_type', sa.String(), nullable=False),
+        sa.Column('source_updated_at', sa.DateTime(), nullable=False),
+        sa.Column('body', sa.LargeBinary(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('uk_item_derivative_item_id_variant', 'item_derivatives', ['item_id', 'variant'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uk_item_derivative_item_id_variant', table_name='item_derivatives')
+    op.drop_table('item_derivatives')
@@ -0,0 +1,78 @@
+"""add item versions
+
+Revision ID: f3b8c1d6e4a7
+Revises: e7c2f5a8d391
+Create Date: 2022-08-15 11:42:09.215573+00:00
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8c1d6e4a7'
+down_revision = 'e7c2f5a8d391'
+branch_labels = None
+depends_on = None
+
+
+def backfill_chunk_digests():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute("UPDATE chunks SET digest = encode(sha256(body), 'hex')")
+        return
+    chunks = sa.table('chunks', sa.column('id'), sa.column('body'), sa.column('digest'))
+    ids = [d.id for d in bind.execute(sa.select(chunks.c.id))]
+    for chunk_id in ids:
+        body = bind.execute(sa.select(chunks.c.body).where(chunks.c.id == chunk_id)).scalar()
+        bind.execute(
+            chunks.update().where(chunks.c.id == chunk_id).values(digest=hashlib.sha256(body or b'').hexdigest())
+        )
+
+
+def upgrade():
+    with op.batch_alter_table('chunks') as batch_op:
+        batch_op.add_column(sa.Column('digest', sa.String(length=64), nullable=True))
+    backfill_chunk_digests()
+    with op.batch_alter_table('chunks') as batch_op:
+        batch_op.alter_column('digest', existing_type=sa.String(length=64), nullable=False)
+    op.create_table(
+        'chunk_data',
+        sa.Column('item_id', sa.String(length=22), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('body', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('item_id', 'digest'),
+    )
+    op.create_table(
+        'item_versions',
+        sa.Column('id', sa.String(length=22), nullable=False),
+        sa.Column('item_id', sa.String(length=22), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('data_type', sa.String(), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['item_id'], ['items.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('uk_item_version_item_id_version', 'item_versions', ['item_id', 'version'], unique=True)
+    op.create_table(
+        'item_version_chunks',
+        sa.Column('version_id', sa.String(length=22), nullable=False),
+        sa.Column('index', sa.Integer(), nullable=False),
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.ForeignKeyConstraint(['version_id'], ['item_versions.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('version_id', 'index'),
+    )
+
+
+def downgrade():
+    op.drop_table('item_version_chunks')
+    op.drop_index('uk_item_version_item_id_version', table_name='item_versions')
+    op.drop_table('item_versions')
+    op.drop_table('chunk_data')
+    with op.batch_alter_table('chunks') as batch_op:
+        batch_op.drop_column('digest')
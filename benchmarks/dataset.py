@@ -0,0 +1,162 @@
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from docserver import models, schema, utils
+from docserver.types import DataTypeString
+from sqlalchemy import func, insert, select
+from sqlalchemy.engine.base import Engine
+
+password = "B3nchm@rk!"
+
+# (weight, min bytes, max bytes); sizes are drawn log-uniformly inside each bucket.
+size_distribution: Sequence[Tuple[float, int, int]] = (
+    (0.95, 100, 4 * 1024),
+    (0.049, 4 * 1024, 256 * 1024),
+    (0.00099, 256 * 1024, 16 * 1024 * 1024),
+    (0.00001, 16 * 1024 * 1024, 500 * 1024 * 1024),
+)
+
+
+@dataclass(frozen=True)
+class Profile:
+    users: int
+    collections: int
+    items: int
+    max_item_size: int
+
+
+profiles: Dict[str, Profile] = {
+    "tiny": Profile(users=2, collections=20, items=500, max_item_size=1024 * 1024),
+    "small": Profile(users=4, collections=200, items=20_000, max_item_size=16 * 1024 * 1024),
+    "medium": Profile(users=8, collections=1_000, items=200_000, max_item_size=64 * 1024 * 1024),
+    "large": Profile(users=16, collections=5_000, items=2_000_000, max_item_size=500 * 1024 * 1024),
+}
+
+
+@dataclass
+class Dataset:
+    usernames: List[str]
+    collection_ids: Dict[str, List[str]]
+    item_ids: Dict[str, List[str]]
+    item_sizes: Dict[str, int]
+
+
+def sample_size(rng: random.Random, max_item_size: int) -> int:
+    weights = [d[0] for d in size_distribution]
+    _, lo, hi = rng.choices(size_distribution, weights=weights)[0]
+    hi = min(hi, max_item_size)
+    if lo >= hi:
+        return hi
+    return int(math.exp(rng.uniform(math.log(lo), math.log(hi))))
+
+
+def pattern_chunks(pattern: memoryview, size: int) -> Iterator[memoryview]:
+    for i in range(0, size, models.chunk_size):
+        yield pattern[: min(models.chunk_size, size - i)]
+
+
+def generate(engine: Engine, profile: Profile, seed: int = 0, batch_size: int = 5_000) -> Dataset:
+    rng = random.Random(seed)
+    data_types = sorted(DataTypeString.valid_types)
+    pattern = memoryview(bytes(rng.getrandbits(8) for _ in range(4096)) * (models.chunk_size // 4096))
+    hashed_password = schema._get_hashed_value(password)
+    started = datetime(2022, 1, 1)
+    dataset = Dataset(usernames=[], collection_ids={}, item_ids={}, item_sizes={})
+
+    with engine.begin() as conn:
+        users = []
+        for i in range(profile.users):
+            username = f"bench{i:04d}"
+            users.append(
+                {
+                    "id": utils.gen_uuid(),
+                    "username": username,
+                    "email": f"{username}@bench.example.com",
+                    "hashed_password": hashed_password,
+                    "created_at": started,
+                    "updated_at": started,
+                }
+            )
+            dataset.usernames.append(username)
+        conn.execute(insert(models.User), users)
+
+        collections = []
+        for i in range(profile.collections):
+            user = users[i % len(users)]
+            dt = started + timedelta(seconds=i)
+            cid = utils.gen_uuid()
+            collections.append(
+                {
+                    "id": cid,
+                    "owner_id": user["id"],
+                    "name": f"collection{i:06d}",
+                    "created_at": dt,
+                    "updated_at": dt,
+                    "cursor_value": utils.format_cursor_value(dt, cid),
+                }
+            )
+            dataset.collection_ids.setdefault(user["username"], []).append(cid)
+        conn.execute(insert(models.Collection), collections)
+
+    item_rows, chunk_rows = [], []
+    chunk_bytes = 0
+    for i in range(profile.items):
+        collection = collections[rng.randrange(len(collections))]
+        dt = started + timedelta(milliseconds=i)
+        item_id = utils.gen_uuid()
+        size = sample_size(rng, profile.max_item_size)
+        item_rows.append(
+            {
+                "id": item_id,
+                "owner_id": collection["owner_id"],
+                "collection_id": collection["id"],
+                "data_type": rng.choice(data_types),
+                "created_at": dt,
+                "updated_at": dt,
+                "cursor_value": utils.format_cursor_value(dt, item_id),
+            }
+        )
+        for index, body in enumerate(pattern_chunks(pattern, size)):
+            chunk_rows.append({"id": utils.gen_uuid(), "item_id": item_id, "index": index, "body": body})
+            chunk_bytes += len(body)
+        dataset.item_ids.setdefault(collection["id"], []).append(item_id)
+        dataset.item_sizes[item_id] = size
+        if len(item_rows) >= batch_size or chunk_bytes >= 4 * models.chunk_size:
+            _flush(engine, item_rows, chunk_rows)
+            item_rows, chunk_rows, chunk_bytes = [], [], 0
+    _flush(engine, item_rows, chunk_rows)
+    return dataset
+
+
+def _flush(engine: Engine, item_rows: List[dict], chunk_rows: List[dict]):
+    if len(item_rows) == 0:
+        return
+    with engine.begin() as conn:
+        conn.execute(insert(models.Item), item_rows)
+        if len(chunk_rows) > 0:
+            conn.execute(insert(models.Chunk), chunk_rows)
+
+
+def load(engine: Engine) -> Dataset:
+    dataset = Dataset(usernames=[], collection_ids={}, item_ids={}, item_sizes={})
+    with engine.connect() as conn:
+        usernames = dict(
+            conn.execute(select(models.User.id, models.User.username).order_by(models.User.username)).all()
+        )
+        dataset.usernames = [d for d in usernames.values() if d.startswith("bench")]
+        for cid, owner_id in conn.execute(select(models.Collection.id, models.Collection.owner_id)):
+            dataset.collection_ids.setdefault(usernames[owner_id], []).append(cid)
+        sizes = (
+            select(
+                models.Item.id, models.Item.collection_id, func.coalesce(func.sum(func.length(models.Chunk.body)), 0)
+            )
+            .outerjoin(models.Chunk, models.Chunk.item_id == models.Item.id)
+            .group_by(models.Item.id, models.Item.collection_id)
+        )
+        for item_id, cid, size in conn.execute(sizes):
+            dataset.item_ids.setdefault(cid, []).append(item_id)
+            dataset.item_sizes[item_id] = size
+    return dataset
@@ -0,0 +1,251 @@
+import argparse
+import json
+import random
+import resource
+import secrets
+import statistics
+import sys
+import time
+from base64 import urlsafe_b64encode
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+from docserver import config, models
+from docserver.app import generate_app
+from fastapi.testclient import TestClient
+
+from . import dataset as dataset_module
+
+
+@dataclass
+class Result:
+    requests: int
+    p50_ms: float
+    p99_ms: float
+    throughput_rps: float
+    peak_rss_mb: float
+
+
+def percentile(values: List[float], q: float) -> float:
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def measure(requests: int, call: Callable[[int], object]) -> Result:
+    latencies = []
+    started = time.perf_counter()
+    for i in range(requests):
+        t = time.perf_counter()
+        response = call(i)
+        latencies.append((time.perf_counter() - t) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f"request failed with {response.status_code}: {response.text[:200]}")
+    elapsed = time.perf_counter() - started
+    return Result(
+        requests=requests,
+        p50_ms=percentile(latencies, 50),
+        p99_ms=percentile(latencies, 99),
+        throughput_rps=requests / elapsed,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+class Bench:
+    def __init__(self, client: TestClient, settings: config.Settings, data: dataset_module.Dataset, seed: int):
+        self.client = client
+        self.prefix = settings.API_V1_STR
+        self.data = data
+        self.rng = random.Random(seed)
+        # users created by the benchmark outlive the run when the dataset is reused with --skip-load
+        self.run_id = secrets.token_hex(3)
+        self.username = data.usernames[0]
+        response = client.post(
+            f"{self.prefix}/token", json={"loginId": self.username, "password": dataset_module.password}
+        )
+        self.tokens = response.json()
+        self.headers = {"Authorization": f"Bearer {self.tokens['accessToken']}"}
+        api_key = client.post(f"{self.prefix}/users/me/api-keys", json={"name": "bench"}, headers=self.headers)
+        self.api_key_headers = {"Authorization": f"Bearer {api_key.json()['apiKey']}"}
+        self.collection_ids = data.collection_ids[self.username]
+        self.item_refs = [(c, i) for c in self.collection_ids for i in data.item_ids.get(c, [])]
+
+    def random_item(self, max_size: Optional[int] = None):
+        refs = self.item_refs
+        if max_size is not None:
+            refs = [d for d in refs if self.data.item_sizes[d[1]] <= max_size] or refs
+        return self.rng.choice(refs)
+
+    def deepest_cursor_page(self, collection_id: Optional[str] = None) -> str:
+        url = (
+            f"{self.prefix}/collections"
+            if collection_id is None
+            else f"{self.prefix}/collections/{collection_id}/items"
+        )
+        cursor, pages = None, 0
+        while pages < 10:
+            res = self.client.get(url, params={"cursor": cursor} if cursor else None, headers=self.headers).json()
+            if res["meta"]["nextCursor"] is None:
+                break
+            cursor, pages = res["meta"]["nextCursor"], pages + 1
+        return url if cursor is None else f"{url}?cursor={cursor}"
+
+    def scenarios(self, body_size: int) -> Dict[str, Callable[[int], object]]:
+        prefix, client, headers = self.prefix, self.client, self.headers
+        body = urlsafe_b64encode(b"x" * body_size).decode("utf-8")
+        busiest = max(self.collection_ids, key=lambda c: len(self.data.item_ids.get(c, [])))
+        deep_collections = self.deepest_cursor_page()
+        deep_items = self.deepest_cursor_page(busiest)
+        login = {"loginId": self.username, "password": dataset_module.password}
+        state = {"refresh_token": self.tokens["refreshToken"], "collections": [], "items": [], "api_keys": []}
+
+        def create_user(i):
+            name = f"newbench{self.run_id}{i:06d}"
+            return client.post(
+                f"{prefix}/users",
+                json={"username": name, "email": f"{name}@bench.example.com", "password": dataset_module.password},
+            )
+
+        def refresh_token(i):
+            res = client.post(f"{prefix}/token", json={"refreshToken": state["refresh_token"]})
+            state["refresh_token"] = res.json()["refreshToken"]
+            return res
+
+        def create_api_key(i):
+            res = client.post(f"{prefix}/users/me/api-keys", json={"name": f"bench{i}"}, headers=headers)
+            state["api_keys"].append(res.json()["id"])
+            return res
+
+        def create_collection(i):
+            res = client.post(f"{prefix}/collections", json={"name": f"bench{i}"}, headers=headers)
+            state["collections"].append(res.json()["id"])
+            return res
+
+        def create_item(i):
+            res = client.post(
+                f"{prefix}/collections/{busiest}/items", json={"dataType": "text/plain", "body": body}, headers=headers
+            )
+            state["items"].append(res.json()["id"])
+            return res
+
+        def item_url(max_size: Optional[int] = None) -> str:
+            return "{}/collections/{}/items/{}".format(prefix, *self.random_item(max_size=max_size))
+
+        return {
+            "create_user": create_user,
+            "login_json": lambda i: client.post(f"{prefix}/token", json=login),
+            "login_form": lambda i: client.post(
+                f"{prefix}/login", data={"username": self.username, "password": dataset_module.password}
+            ),
+            "refresh_token": refresh_token,
+            "users_me_jwt": lambda i: client.get(f"{prefix}/users/me", headers=headers),
+            "users_me_api_key": lambda i: client.get(f"{prefix}/users/me", headers=self.api_key_headers),
+            "create_api_key": create_api_key,
+            "list_api_keys": lambda i: client.get(f"{prefix}/users/me/api-keys", headers=headers),
+            "delete_api_key": lambda i: client.delete(
+                f"{prefix}/users/me/api-keys/{state['api_keys'][i]}", headers=headers
+            ),
+            "list_collections_first_page": lambda i: client.get(f"{prefix}/collections", headers=headers),
+            "list_collections_deep_page": lambda i: client.get(deep_collections, headers=headers),
+            "retrieve_collection": lambda i: client.get(
+                f"{prefix}/collections/{self.rng.choice(self.collection_ids)}", headers=headers
+            ),
+            "create_collection": create_collection,
+            "update_collection": lambda i: client.put(
+                f"{prefix}/collections/{state['collections'][i]}", json={"name": f"renamed{i}"}, headers=headers
+            ),
+            "list_items_first_page": lambda i: client.get(f"{prefix}/collections/{busiest}/items", headers=headers),
+            "list_items_deep_page": lambda i: client.get(deep_items, headers=headers),
+            "retrieve_small_item": lambda i: client.get(item_url(max_size=4 * 1024), headers=headers),
+            "retrieve_any_item": lambda i: client.get(item_url(), headers=headers),
+            "create_item": create_item,
+            "update_item": lambda i: client.put(
+                f"{prefix}/collections/{busiest}/items/{state['items'][i]}",
+                json={"dataType": "text/csv", "body": body},
+                headers=headers,
+            ),
+            "delete_item": lambda i: client.delete(
+                f"{prefix}/collections/{busiest}/items/{state['items'][i]}", headers=headers
+            ),
+            "delete_collection": lambda i: client.delete(
+                f"{prefix}/collections/{state['collections'][i]}", headers=headers
+            ),
+        }
+
+
+def compare(results: Dict[str, Result], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result.p99_ms > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result.p99_ms:.2f}ms > baseline {base['p99_ms']:.2f}ms")
+        if result.throughput_rps < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result.throughput_rps:.1f}rps < baseline {base['throughput_rps']:.1f}rps"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark every docserver endpoint against a generated dataset.")
+    parser.add_argument("--database-uri", help="sqlite:///path or postgresql://...; defaults to the configured DB")
+    parser.add_argument("--profile", choices=sorted(dataset_module.profiles), default="tiny")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--body-size", type=int, default=4096, help="body size for create_item")
+    parser.add_argument("--only", nargs="*", help="run only these scenarios")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-load", action="store_true", help="reuse a database loaded by a previous run")
+    parser.add_argument("--baseline", help="JSON file to compare against")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    overrides = {"REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS": 0}
+    if args.database_uri:
+        overrides["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    settings = config.get_setting(**overrides)
+    app = generate_app(settings)
+    engine = app.session_handler.engine
+    if args.skip_load:
+        data = dataset_module.load(engine)
+    else:
+        models.Base.metadata.drop_all(engine)
+        models.Base.metadata.create_all(engine)
+        started = time.perf_counter()
+        data = dataset_module.generate(engine, dataset_module.profiles[args.profile], seed=args.seed)
+        print(f"loaded {args.profile} dataset in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    results: Dict[str, Result] = {}
+    with TestClient(app) as client:
+        bench = Bench(client, settings, data, args.seed)
+        for name, call in bench.scenarios(args.body_size).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(args.requests, call)
+            r = results[name]
+            print(
+                f"{name:32s} p50={r.p50_ms:9.2f}ms p99={r.p99_ms:9.2f}ms "
+                f"rps={r.throughput_rps:9.1f} peak_rss={r.peak_rss_mb:8.1f}MB"
+            )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fp:
+            json.dump({k: asdict(v) for k, v in results.items()}, fp, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
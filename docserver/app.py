@@ -1,9 +1,42 @@
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import FastAPI, Response
 from fastapi.security import OAuth2PasswordBearer
 
-from . import routers
+from . import images, jobs, metrics, routers, tasks
+from .cache import ByteLRUCache, InvalidationBus, TTLCache
 from .config import get_setting
-from .deps import SessionHandler
+from .deps import AsyncSessionHandler, SessionHandler
+from .middleware import CompressionMiddleware, MetricsMiddleware, ProfilingMiddleware, QueryStatsMiddleware
+from .resp import RespCache, RespClient, RespInvalidationBus
+
+
+def setup_caches(settings):
+    bus = InvalidationBus()
+    if settings.CACHE_URL is not None:
+        bus = RespInvalidationBus(settings.CACHE_URL, settings.CACHE_INVALIDATION_CHANNEL)
+    api_key_cache = TTLCache(settings.API_KEY_CACHE_SECONDS, settings.API_KEY_CACHE_SIZE, name="api_keys")
+    bus.attach(api_key_cache)
+    if settings.CACHE_BACKEND == "redis":
+        response_cache = RespCache(
+            RespClient(settings.CACHE_URL), name="responses", max_entry_bytes=settings.RESPONSE_CACHE_MAX_ENTRY_BYTES
+        )
+    else:
+        response_cache = ByteLRUCache(
+            settings.RESPONSE_CACHE_MAX_BYTES, settings.RESPONSE_CACHE_MAX_ENTRY_BYTES, name="responses"
+        )
+        bus.attach(response_cache)
+    return bus, api_key_cache, response_cache
+
+
+def setup_job_worker(settings, session_handler, concurrency: int) -> jobs.Worker:
+    return jobs.Worker(
+        session_handler.job_session,
+        concurrency=concurrency,
+        poll_interval=settings.JOBS_POLL_INTERVAL_SECONDS,
+        lease_seconds=settings.JOBS_LEASE_SECONDS,
+        retry_seconds=settings.JOBS_RETRY_SECONDS,
+    )
 
 
 def generate_app(settings=None):
@@ -11,13 +44,87 @@ def generate_app(settings=None):
         return generate_app(get_setting())
     app = FastAPI(title='document server', openapi_url=f"{settings.API_V1_STR}/openapi.json")
     app.settings = settings
-    app.session_handler = SessionHandler(settings)
+    app.session_handler = (AsyncSessionHandler if settings.DB_ASYNC else SessionHandler)(settings)
     app.oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/login")
+    app.cache_bus, app.api_key_cache, app.response_cache = setup_caches(settings)
+    app.job_worker = setup_job_worker(settings, app.session_handler, settings.JOBS_IN_PROCESS_WORKERS)
+    app.image_renderer = images.DerivativeRenderer(settings.IMAGE_DERIVATIVE_WORKERS)
     app.include_router(
         routers.generate_router(
-            settings=app.settings, session_handler=app.session_handler, oauth2_scheme=app.oauth2_scheme
+            settings=app.settings,
+            session_handler=app.session_handler,
+            oauth2_scheme=app.oauth2_scheme,
+            api_key_cache=app.api_key_cache,
+            response_cache=app.response_cache,
+            job_worker=app.job_worker,
+            image_renderer=app.image_renderer,
         ),
         prefix=settings.API_V1_STR,
     )
+    if settings.COMPRESSION_ENABLED:
+        app.add_middleware(CompressionMiddleware, minimum_size=settings.COMPRESSION_MINIMUM_SIZE)
+    if settings.METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
+
+        @app.get(settings.METRICS_PATH, include_in_schema=False)
+        def get_metrics():
+            return Response(metrics.render(metrics.registry), media_type=metrics.content_type)
+
+    if settings.PROFILING_ENABLED:
+        app.add_middleware(
+            ProfilingMiddleware,
+            token=settings.PROFILING_TOKEN,
+            output_dir=settings.PROFILING_OUTPUT_DIR,
+            header=settings.PROFILING_HEADER,
+            interval=settings.PROFILING_INTERVAL_SECONDS,
+        )
+
+    app.add_middleware(
+        QueryStatsMiddleware,
+        server_timing=settings.SERVER_TIMING_ENABLED,
+        repeated_query_threshold=settings.QUERY_REPEAT_WARNING_THRESHOLD,
+    )
+
+    app.background_tasks = []
+
+    @app.on_event("startup")
+    async def start_background_tasks():
+        app.cache_bus.start()
+        if settings.JOBS_IN_PROCESS_WORKERS > 0:
+            app.job_worker.start()
+        if settings.REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS > 0:
+            app.background_tasks.append(
+                asyncio.create_task(
+                    tasks.run_periodically(
+                        settings.REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS,
+                        tasks.sweep_expired_refresh_tokens,
+                        app.session_handler,
+                    )
+                )
+            )
+        if settings.ITEM_VERSIONS_PRUNE_INTERVAL_SECONDS > 0:
+            app.background_tasks.append(
+                asyncio.create_task(
+                    tasks.run_periodically(
+                        settings.ITEM_VERSIONS_PRUNE_INTERVAL_SECONDS,
+                        tasks.prune_item_versions,
+                        app.session_handler,
+                        settings.ITEM_VERSIONS_KEEP,
+                        settings.ITEM_VERSIONS_MAX_AGE_DAYS,
+                        settings.ITEM_VERSIONS_PRUNE_BATCH_SIZE,
+                    )
+                )
+            )
+
+    @app.on_event("shutdown")
+    async def stop_background_tasks():
+        for task in app.background_tasks:
+            task.cancel()
+        app.background_tasks.clear()
+        app.cache_bus.close()
+        app.image_renderer.close()
+        await asyncio.get_running_loop().run_in_executor(None, app.job_worker.stop)
+        if isinstance(app.session_handler, AsyncSessionHandler):
+            await app.session_handler.dispose()
 
     return app
@@ -0,0 +1,497 @@
+import calendar
+import codecs
+import mimetypes
+import struct
+import tarfile
+import zipfile
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Type
+
+data_type_extensions = {
+    "text/plain": ".txt",
+    "text/uri-list": ".uri",
+    "text/csv": ".csv",
+    "text/css": ".css",
+    "text/html": ".html",
+    "application/xhtml+xml": ".xhtml",
+    "image/png": ".png",
+    "image/jpg": ".jpg",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/svg+xml": ".svg",
+    "application/xml": ".xml",
+    "text/xml": ".xml",
+    "application/javascript": ".js",
+    "application/json": ".json",
+    "application/octet-stream": ".bin",
+}
+
+extension_data_types = {
+    ".txt": "text/plain",
+    ".text": "text/plain",
+    ".md": "text/plain",
+    ".uri": "text/uri-list",
+    ".csv": "text/csv",
+    ".css": "text/css",
+    ".html": "text/html",
+    ".htm": "text/html",
+    ".xhtml": "application/xhtml+xml",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml",
+    ".xml": "application/xml",
+    ".js": "application/javascript",
+    ".mjs": "application/javascript",
+    ".json": "application/json",
+    ".bin": "application/octet-stream",
+}
+magic_data_types = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+sniff_max_bytes = 4096
+
+
+def member_name(item_id: str, data_type: Optional[str]) -> str:
+    extension = data_type_extensions.get(data_type or "")
+    if extension is None:
+        extension = (data_type and mimetypes.guess_extension(data_type)) or ".bin"
+    return f"{item_id}{extension}"
+
+
+def sniff_text_data_type(text: str) -> str:
+    head = text.lstrip("\ufeff \t\r\n").lower()
+    if head.startswith(("{", "[")):
+        return "application/json"
+    if head.startswith(("<!doctype html", "<html")):
+        return "text/html"
+    if head.startswith("<svg") or (head.startswith("<?xml") and "<svg" in head):
+        return "image/svg+xml"
+    if head.startswith("<?xml"):
+        return "application/xml"
+    return "text/plain"
+
+
+def guess_data_type(name: str, head: bytes) -> str:
+    """Data type of an archive member from its extension, falling back to the magic bytes of its first chunk."""
+    _, dot, extension = name.rpartition("/")[2].rpartition(".")
+    data_type = extension_data_types.get(f".{extension.lower()}") if dot else None
+    if data_type is not None:
+        return data_type
+    for magic, data_type in magic_data_types:
+        if head.startswith(magic):
+            return data_type
+    try:
+        # a multi-byte sequence may be cut at the end of the sniffed prefix, which is not an error
+        text = codecs.getincrementaldecoder("utf-8")().decode(head[:sniff_max_bytes], final=False)
+    except UnicodeDecodeError:
+        return "application/octet-stream"
+    return "application/octet-stream" if "\x00" in text else sniff_text_data_type(text)
+
+
+class StreamSink:
+    """Write-only file object that hands whatever was written back to the caller on drain()."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._parts.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        res = b"".join(self._parts)
+        self._parts.clear()
+        return res
+
+
+class TarStreamWriter:
+    media_type = "application/x-tar"
+
+    def __init__(self):
+        self._size = 0
+
+    def begin_file(self, name: str, size: int, mtime: datetime) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = calendar.timegm(mtime.utctimetuple())
+        info.mode = 0o644
+        self._size = size
+        return info.tobuf(format=tarfile.PAX_FORMAT)
+
+    def write(self, data) -> bytes:
+        return data if isinstance(data, bytes) else bytes(data)
+
+    def end_file(self) -> bytes:
+        remainder = self._size % tarfile.BLOCKSIZE
+        return tarfile.NUL * (tarfile.BLOCKSIZE - remainder) if remainder else b""
+
+    def close(self) -> bytes:
+        return tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+class ZipStreamWriter:
+    """Stored (uncompressed) zip written to an unseekable sink, so sizes and CRCs follow each member."""
+
+    media_type = "application/zip"
+
+    def __init__(self):
+        self._sink = StreamSink()
+        self._zip = zipfile.ZipFile(self._sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._member = None
+
+    def begin_file(self, name: str, size: int, mtime: datetime) -> bytes:
+        info = zipfile.ZipInfo(name, date_time=mtime.timetuple()[:6])
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+        self._member = self._zip.open(info, "w")
+        return self._sink.drain()
+
+    def write(self, data) -> bytes:
+        self._member.write(data)
+        return self._sink.drain()
+
+    def end_file(self) -> bytes:
+        self._member.close()
+        self._member = None
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.drain()
+
+
+writers: Dict[str, Type] = {"tar": TarStreamWriter, "zip": ZipStreamWriter}
+
+
+class ArchiveEvent(NamedTuple):
+    kind: str  # "start" with the member name, "data" with a slice of its body, or "end"
+    value: Any = None
+
+
+meta_max_bytes = 1024 * 1024
+
+
+def parse_pax_records(payload: bytes) -> Dict[str, str]:
+    records = {}
+    pos = 0
+    while pos < len(payload):
+        space = payload.index(b" ", pos)
+        length = int(payload[pos:space])
+        if length <= space - pos:
+            raise ValueError("malformed pax header")
+        key, _, value = payload[space + 1 : pos + length - 1].partition(b"=")
+        records[key.decode("utf-8")] = value.decode("utf-8", "surrogateescape")
+        pos += length
+    return records
+
+
+def is_ignored_member(name: str) -> bool:
+    return name.startswith("__MACOSX/") or name.endswith("/")
+
+
+class TarStreamReader:
+    """Incremental tar parser; feed() accepts arbitrary slices of the archive and yields events of regular files."""
+
+    meta_types = (
+        tarfile.XHDTYPE,
+        tarfile.XGLTYPE,
+        tarfile.SOLARIS_XHDTYPE,
+        tarfile.GNUTYPE_LONGNAME,
+        tarfile.GNUTYPE_LONGLINK,
+    )
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._remaining = 0
+        self._padding = 0
+        self._member: Optional[str] = None
+        self._meta: Optional[bytearray] = None
+        self._meta_type = b""
+        self._pax: Dict[str, str] = {}
+        self._long_name: Optional[str] = None
+        self._finished = False
+
+    def feed(self, data: bytes) -> Iterator[ArchiveEvent]:
+        self._buffer += data
+        while not self._finished:
+            if self._remaining > 0:
+                n = min(self._remaining, len(self._buffer))
+                if n == 0:
+                    return
+                part = bytes(self._buffer[:n])
+                del self._buffer[:n]
+                self._remaining -= n
+                if self._meta is not None:
+                    self._meta += part
+                elif self._member is not None:
+                    yield ArchiveEvent("data", part)
+                if self._remaining == 0:
+                    yield from self._end_entry()
+            elif self._padding > 0:
+                n = min(self._padding, len(self._buffer))
+                if n == 0:
+                    return
+                del self._buffer[:n]
+                self._padding -= n
+            elif len(self._buffer) >= tarfile.BLOCKSIZE:
+                block = bytes(self._buffer[: tarfile.BLOCKSIZE])
+                del self._buffer[: tarfile.BLOCKSIZE]
+                yield from self._begin_entry(block)
+            else:
+                return
+        self._buffer.clear()
+
+    def _begin_entry(self, block: bytes) -> Iterator[ArchiveEvent]:
+        if block == tarfile.NUL * tarfile.BLOCKSIZE:
+            self._finished = True
+            return
+        try:
+            info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+        except tarfile.HeaderError as e:
+            raise ValueError(f"malformed tar header: {e}")
+        size = info.size
+        if info.type in self.meta_types:
+            if size > meta_max_bytes:
+                raise ValueError("tar extended header is too large")
+            self._meta = bytearray()
+            self._meta_type = info.type
+        else:
+            name = self._pax.get("path") or self._long_name or info.name
+            size = int(self._pax.get("size", size))
+            self._pax = {}
+            self._long_name = None
+            if info.isreg() and not is_ignored_member(name):
+                self._member = name
+                yield ArchiveEvent("start", name)
+        self._remaining = size
+        self._padding = -size % tarfile.BLOCKSIZE
+        if size == 0:
+            yield from self._end_entry()
+
+    def _end_entry(self) -> Iterator[ArchiveEvent]:
+        if self._meta is not None:
+            payload = bytes(self._meta)
+            self._meta = None
+            if self._meta_type == tarfile.XHDTYPE:
+                self._pax.update(parse_pax_records(payload))
+            elif self._meta_type == tarfile.GNUTYPE_LONGNAME:
+                self._long_name = payload.rstrip(tarfile.NUL).decode("utf-8", "surrogateescape")
+        elif self._member is not None:
+            self._member = None
+            yield ArchiveEvent("end")
+
+    def close(self):
+        if not self._finished and (self._remaining > 0 or self._padding > 0 or len(self._buffer) > 0):
+            raise ValueError("truncated tar archive")
+
+
+zip_local_header = struct.Struct("<4s5H3L2H")
+zip_extra_header = struct.Struct("<2H")
+zip_descriptor_signature = b"PK\x07\x08"
+zip_end_signatures = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+
+
+class ZipStreamReader:
+    """Incremental zip parser that reads local headers only, so the central directory is never needed.
+
+    Stored members whose sizes follow in a data descriptor, as written by ZipStreamWriter, end where a
+    descriptor matching the CRC and length of the bytes seen so far appears.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._state = "header"
+        self._waiting = False
+        self._member: Optional[str] = None
+        self._inflater = None
+        self._zip64 = False
+        self._compressed_size: Optional[int] = None
+        self._expected: Optional[tuple] = None
+        self._consumed = 0
+        self._crc = 0
+        self._size = 0
+
+    def feed(self, data: bytes) -> Iterator[ArchiveEvent]:
+        self._buffer += data
+        while self._state != "done":
+            self._waiting = False
+            yield from getattr(self, f"_read_{self._state}")()
+            if self._waiting:
+                return
+        self._buffer.clear()
+
+    def _read_header(self) -> Iterator[ArchiveEvent]:
+        if len(self._buffer) < 4:
+            self._waiting = True
+            return
+        signature = bytes(self._buffer[:4])
+        if signature in zip_end_signatures:
+            self._state = "done"
+            return
+        if signature != b"PK\x03\x04":
+            raise ValueError("malformed zip member header")
+        if len(self._buffer) < zip_local_header.size:
+            self._waiting = True
+            return
+        _, _, flags, method, _, _, crc, csize, usize, name_length, extra_length = zip_local_header.unpack_from(
+            self._buffer
+        )
+        end = zip_local_header.size + name_length + extra_length
+        if len(self._buffer) < end:
+            self._waiting = True
+            return
+        raw_name = bytes(self._buffer[zip_local_header.size : zip_local_header.size + name_length])
+        extra = bytes(self._buffer[zip_local_header.size + name_length : end])
+        del self._buffer[:end]
+        if flags & 0x1:
+            raise ValueError("encrypted zip members are not supported")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"unsupported zip compression method {method}")
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        self._zip64 = False
+        pos = 0
+        while pos + zip_extra_header.size <= len(extra):
+            tag, length = zip_extra_header.unpack_from(extra, pos)
+            if tag == 0x0001:
+                self._zip64 = True
+                if length >= 16 and 0xFFFFFFFF in (usize, csize):
+                    usize, csize = struct.unpack_from("<2Q", extra, pos + zip_extra_header.size)
+            pos += zip_extra_header.size + length
+        self._member = None if is_ignored_member(name) else name
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else None
+        self._compressed_size = None if flags & 0x8 else csize
+        self._expected = None if flags & 0x8 else (crc, usize)
+        self._consumed = self._crc = self._size = 0
+        self._state = "data"
+        if self._member is not None:
+            yield ArchiveEvent("start", name)
+
+    def _emit(self, data: bytes) -> Iterator[ArchiveEvent]:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        if self._member is not None and len(data) > 0:
+            yield ArchiveEvent("data", data)
+
+    def _read_data(self) -> Iterator[ArchiveEvent]:
+        if self._compressed_size is not None:
+            n = min(self._compressed_size - self._consumed, len(self._buffer))
+            part = bytes(self._buffer[:n])
+            del self._buffer[:n]
+            self._consumed += n
+            yield from self._emit(self._inflater.decompress(part) if self._inflater is not None else part)
+            if self._consumed < self._compressed_size:
+                self._waiting = True
+                return
+            if self._inflater is not None:
+                yield from self._emit(self._inflater.flush())
+            yield from self._end_member()
+        elif self._inflater is not None:
+            part = bytes(self._buffer)
+            self._buffer.clear()
+            yield from self._emit(self._inflater.decompress(part))
+            if not self._inflater.eof:
+                self._waiting = True
+                return
+            self._buffer[:0] = self._inflater.unused_data
+            self._state = "descriptor"
+        else:
+            yield from self._scan_stored()
+
+    def _scan_stored(self) -> Iterator[ArchiveEvent]:
+        """Emits stored bytes up to the data descriptor, which carries the only record of where they end."""
+        length_format = "<2Q" if self._zip64 else "<2L"
+        descriptor_size = 8 + struct.calcsize(length_format)
+        start = 0
+        while True:
+            pos = self._buffer.find(zip_descriptor_signature, start)
+            if pos < 0:
+                # keep a possibly split signature for the next feed
+                yield from self._emit_buffered(max(0, len(self._buffer) - 3))
+                self._waiting = True
+                return
+            if len(self._buffer) < pos + descriptor_size:
+                yield from self._emit_buffered(pos)
+                self._waiting = True
+                return
+            (crc,) = struct.unpack_from("<L", self._buffer, pos + 4)
+            csize, usize = struct.unpack_from(length_format, self._buffer, pos + 8)
+            if csize == usize == self._size + pos and crc == zlib.crc32(self._buffer[:pos], self._crc):
+                yield from self._emit_buffered(pos)
+                del self._buffer[:descriptor_size]
+                self._expected = (crc, usize)
+                yield from self._end_member()
+                return
+            start = pos + 1
+
+    def _emit_buffered(self, n: int) -> Iterator[ArchiveEvent]:
+        part = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        yield from self._emit(part)
+
+    def _read_descriptor(self) -> Iterator[ArchiveEvent]:
+        length_format = "<2Q" if self._zip64 else "<2L"
+        offset = 4 if self._buffer[:4] == zip_descriptor_signature else 0
+        end = offset + 4 + struct.calcsize(length_format)
+        if len(self._buffer) < end:
+            self._waiting = True
+            return
+        (crc,) = struct.unpack_from("<L", self._buffer, offset)
+        _, usize = struct.unpack_from(length_format, self._buffer, offset + 4)
+        del self._buffer[:end]
+        self._expected = (crc, usize)
+        yield from self._end_member()
+
+    def _end_member(self) -> Iterator[ArchiveEvent]:
+        if self._expected != (self._crc, self._size):
+            raise ValueError("zip member failed its CRC or size check")
+        if self._inflater is not None and not self._inflater.eof:
+            raise ValueError("truncated deflate stream in zip member")
+        self._state = "header"
+        if self._member is not None:
+            self._member = None
+            yield ArchiveEvent("end")
+
+    def close(self):
+        if self._state != "done":
+            raise ValueError("truncated zip archive")
+
+
+class ArchiveReader:
+    """Detects a zip, tar or gzip-compressed tar from its leading bytes and feeds it to the matching parser."""
+
+    def __init__(self):
+        self._head = bytearray()
+        self._parser = None
+        self._gunzip = None
+
+    def feed(self, data: bytes) -> Iterator[ArchiveEvent]:
+        if self._parser is None:
+            self._head += data
+            if len(self._head) < 4:
+                return
+            data = bytes(self._head)
+            if data.startswith(b"PK"):
+                self._parser = ZipStreamReader()
+            else:
+                if data.startswith(b"\x1f\x8b"):
+                    self._gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._parser = TarStreamReader()
+        if self._gunzip is not None:
+            data = self._gunzip.decompress(data)
+        yield from self._parser.feed(data)
+
+    def close(self):
+        if self._parser is None:
+            raise ValueError("archive is empty")
+        if self._gunzip is not None and not self._gunzip.eof:
+            raise ValueError("truncated gzip stream")
+        self._parser.close()
@@ -0,0 +1,565 @@
+import json
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from . import archives, jsonpointer, jsonstream, models, schema, search, types, utils
+from .operators import (
+    ArchiveImport,
+    ItemDocument,
+    archive_items_statement,
+    archived_chunk_indexes,
+    chunk_bytes_read,
+    chunk_bytes_written,
+    chunk_rows,
+    clone_source_items_statement,
+    collection_items_statement,
+    consume_refresh_token_statement,
+    copy_chunks_statement,
+    copy_items_statement,
+    count_chunk_bytes_read,
+    count_statement,
+    create_api_key_statement,
+    create_collection_statement,
+    create_item_derivative_statement,
+    create_item_statement,
+    create_item_version_statement,
+    create_job_statement,
+    create_refresh_token_statement,
+    create_user_statement,
+    decode_access_token,
+    delete_api_key_statement,
+    delete_chunks_statement,
+    delete_collection_statement,
+    delete_expired_refresh_tokens_statement,
+    delete_item_derivatives_statement,
+    delete_item_statement,
+    delete_item_versions_statement,
+    delete_refresh_token_family_statement,
+    delete_unreferenced_chunk_data_statement,
+    diff_chunks,
+    expired_item_versions_statement,
+    extract_body_text,
+    find_api_key_statement,
+    find_rotated_refresh_token_family_statement,
+    find_user_statement,
+    forget_deleted,
+    full_text_search_statement,
+    id_map_subquery,
+    item_conditions,
+    item_list_conditions,
+    item_version_chunk_rows,
+    item_version_chunks_statement,
+    item_version_digests_statement,
+    item_version_document_head,
+    json_data_type,
+    list_api_keys_statement,
+    list_item_versions_statement,
+    live_chunk_digests,
+    lock_chunk_data_statement,
+    lock_item_chunks_statement,
+    lock_items_statement,
+    neighbor_statements,
+    page_response,
+    page_statement,
+    parse_json_document,
+    plan_import_writes,
+    referenced_chunks_conditions,
+    retrieve_chunk_statement,
+    retrieve_collection_statement,
+    retrieve_item_derivative_statement,
+    retrieve_item_document_statement,
+    retrieve_item_header_statement,
+    retrieve_item_statement,
+    retrieve_item_version_statement,
+    retrieve_job_statement,
+    search_page_response,
+    search_page_statement,
+    share_chunk_bodies_statement,
+    sort_page,
+    source_chunks_statement,
+    unreferenced_chunk_data_statement,
+    update_collection_statement,
+    update_item_document_statement,
+    update_item_search_vector_statement,
+    update_item_statement,
+    verify_api_key_record,
+    version_chunk_bodies_statement,
+)
+
+
+async def create_user(db: AsyncSession, query: schema.UserCreateQuery) -> schema.UserRetrieveResponse:
+    hashed_password = await run_in_threadpool(query.password.get_hashed_value)
+    try:
+        user = (await db.execute(create_user_statement(query, hashed_password))).one()
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise ValueError("username and/or email already exists.")
+    return schema.UserRetrieveResponse.from_orm(user)
+
+
+async def authenticate_user(db: AsyncSession, query: schema.UserLoginQuery) -> Union[models.User, None]:
+    user = (await db.execute(find_user_statement(query))).scalar()
+    if user is None:
+        return None
+    if await run_in_threadpool(query.password.verify_with_hashed_value, user.hashed_password):
+        return schema.UserRetrieveResponse.from_orm(user)
+    return None
+
+
+async def get_user_by_access_token(
+    db: AsyncSession, access_token: str, secret_key: str, algorithm: str
+) -> Union[models.User, None]:
+    uid_in_payload = decode_access_token(access_token, secret_key, algorithm)
+    if uid_in_payload is None:
+        return None
+    return await db.get(models.User, uid_in_payload)
+
+
+async def create_refresh_token(
+    db: AsyncSession,
+    user_id: schema.ShortUUID,
+    expires_delta: timedelta,
+    family_id: Optional[schema.ShortUUID] = None,
+) -> str:
+    token = utils.gen_refresh_token()
+    await db.execute(create_refresh_token_statement(token, user_id, expires_delta, family_id))
+    await db.commit()
+    return token
+
+
+async def rotate_refresh_token(
+    db: AsyncSession, refresh_token: str, expires_delta: timedelta
+) -> Union[Tuple[schema.ShortUUID, str], None]:
+    digest = utils.calc_token_digest(refresh_token)
+    record = (await db.execute(consume_refresh_token_statement(digest))).first()
+    if record is None:
+        await revoke_reused_refresh_token(db, digest)
+        return None
+    return record.user_id, await create_refresh_token(db, record.user_id, expires_delta, family_id=record.family_id)
+
+
+async def revoke_reused_refresh_token(db: AsyncSession, digest: str) -> int:
+    family_id = (await db.execute(find_rotated_refresh_token_family_statement(digest))).scalar()
+    if family_id is None:
+        return 0
+    res = (await db.execute(delete_refresh_token_family_statement(family_id))).rowcount
+    await db.commit()
+    return res
+
+
+async def delete_expired_refresh_tokens(db: AsyncSession, now: Optional[datetime] = None) -> int:
+    res = (await db.execute(delete_expired_refresh_tokens_statement(now or utils.gen_datetime()))).rowcount
+    await db.commit()
+    return res
+
+
+async def create_api_key(
+    db: AsyncSession, user: models.User, data: schema.ApiKeyCreateQuery, secret_key: str
+) -> schema.ApiKeyCreateResponse:
+    api_key = utils.gen_api_key()
+    record = (await db.execute(create_api_key_statement(user, data, api_key, secret_key))).one()
+    await db.commit()
+    return schema.ApiKeyCreateResponse(api_key=api_key, **record._mapping)
+
+
+async def list_api_keys(db: AsyncSession, user: models.User):
+    return (await db.execute(list_api_keys_statement(user))).all()
+
+
+async def delete_api_key(db: AsyncSession, user: models.User, api_key_id: schema.ShortUUID) -> Union[str, None]:
+    res = (await db.execute(delete_api_key_statement(user, api_key_id))).scalar()
+    await db.commit()
+    return res
+
+
+async def authenticate_api_key(db: AsyncSession, api_key: str, digest: str):
+    prefix = utils.parse_api_key_prefix(api_key)
+    if prefix is None:
+        return None
+    return verify_api_key_record((await db.execute(find_api_key_statement(prefix))).first(), digest)
+
+
+async def create_collection(db: AsyncSession, data: schema.CollectionCreateQuery, user: models.User):
+    collection = (await db.execute(create_collection_statement(data, user))).one()
+    await db.commit()
+    return collection
+
+
+async def list_collections(
+    db: AsyncSession, user: models.User, cursor: Optional[types.EncodedCursor] = None, page_size: int = 10
+):
+    conditions = (models.Collection.owner_id == user.id,)
+    return await _list_page(db, models.Collection, conditions, cursor, page_size)
+
+
+async def retrieve_collection(db: AsyncSession, user: models.User, collection_id: schema.ShortUUID):
+    return (await db.execute(retrieve_collection_statement(user, collection_id))).scalar()
+
+
+async def update_collection(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, data: schema.CollectionUpdateQuery
+):
+    collection = (await db.execute(update_collection_statement(user, collection_id, data))).first()
+    await db.commit()
+    return collection
+
+
+async def delete_collection(db: AsyncSession, user: models.User, collection_id: schema.ShortUUID):
+    await keep_referenced_chunk_bodies(db, collection_items_statement(user, collection_id))
+    res = (await db.execute(delete_collection_statement(user, collection_id))).scalar()
+    forget_deleted(db.sync_session, models.Collection, res)
+    await db.commit()
+    return res
+
+
+async def create_item(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, data: schema.ItemCreateQuery
+):
+    body = data.body.decode_to_binary()
+    document = await run_in_threadpool(parse_json_document, data.data_type, body)
+    search_text = await run_in_threadpool(extract_body_text, data.data_type, body)
+    item = (await db.execute(create_item_statement(user, collection_id, data, document, search_text))).first()
+    if item is None:
+        return None
+    await insert_chunks(db, item.id, body)
+    await db.commit()
+    return item
+
+
+async def insert_chunks(db: AsyncSession, item_id: schema.ShortUUID, body: bytes):
+    await insert_chunk_rows(db, await run_in_threadpool(chunk_rows, item_id, body))
+
+
+async def insert_chunk_rows(db: AsyncSession, chunks: List[Dict[str, Any]]):
+    if len(chunks) > 0:
+        chunk_bytes_written.inc(sum(len(d["body"]) for d in chunks))
+        await db.execute(insert(models.Chunk), chunks)
+
+
+async def retrieve_item(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID
+):
+    return count_chunk_bytes_read((await db.execute(retrieve_item_statement(user, collection_id, item_id))).scalar())
+
+
+async def retrieve_item_header(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID
+):
+    return (await db.execute(retrieve_item_header_statement(user, collection_id, item_id))).first()
+
+
+async def update_item(
+    db: AsyncSession,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    data: schema.ItemUpdateQuery,
+):
+    body = data.body.decode_to_binary() if data.body is not None else None
+    if data.data_type is None and body is None:
+        return await retrieve_item_header(db, user, collection_id, item_id)
+    live = (await db.execute(lock_item_chunks_statement(user, collection_id, item_id))).all()
+    if len(live) == 0:
+        await db.rollback()
+        return None
+    await archive_item_version(db, live)
+    document = await run_in_threadpool(parse_json_document, data.data_type, body)
+    item = (await db.execute(update_item_statement(user, collection_id, item_id, data, document))).first()
+    if body is not None:
+        await replace_chunks(db, item.id, body, live_chunk_digests(live))
+    elif search.is_searchable(data.data_type):
+        body = (await retrieve_item(db, user, collection_id, item_id)).body
+        if data.data_type == json_data_type:
+            document = await run_in_threadpool(parse_json_document, json_data_type, body)
+            await db.execute(update_item_document_statement(item.id, document))
+    search_text = await run_in_threadpool(extract_body_text, item.data_type, body)
+    if search_text is not None or data.data_type is not None:
+        await db.execute(update_item_search_vector_statement(item.id, search_text))
+    await db.execute(delete_item_derivatives_statement(item.id))
+    await db.commit()
+    return item
+
+
+async def archive_item_version(db: AsyncSession, live):
+    version_id = utils.gen_uuid()
+    await db.execute(create_item_version_statement(version_id, live))
+    refs = item_version_chunk_rows(version_id, live)
+    if len(refs) > 0:
+        await db.execute(insert(models.ItemVersionChunk), refs)
+
+
+async def replace_chunks(db: AsyncSession, item_id: schema.ShortUUID, body: bytes, live: Dict[int, str]):
+    changed, stale = await run_in_threadpool(diff_chunks, item_id, body, live)
+    if len(stale) > 0:
+        archived = [models.Chunk.item_id == item_id, models.Chunk.index.in_(archived_chunk_indexes(live, stale))]
+        await db.execute(share_chunk_bodies_statement(archived))
+        await db.execute(delete_chunks_statement(item_id, stale))
+    await insert_chunk_rows(db, changed)
+
+
+async def list_item_versions(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID
+):
+    if await retrieve_item_header(db, user, collection_id, item_id) is None:
+        return None
+    return (await db.execute(list_item_versions_statement(item_id))).all()
+
+
+async def retrieve_item_version_header(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, version: int
+):
+    return (await db.execute(retrieve_item_version_statement(user, collection_id, item_id, version))).first()
+
+
+async def stream_item_version(db: AsyncSession, header) -> AsyncIterator[bytes]:
+    await db.commit()
+    await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    yield item_version_document_head(header)
+    encoder = jsonstream.Base64ChunkEncoder()
+    for ref in (await db.execute(item_version_chunks_statement(header.id))).all():
+        body = (await db.execute(version_chunk_bodies_statement(ref.digest))).first().body
+        chunk_bytes_read.inc(len(body))
+        yield encoder.feed(body)
+    yield encoder.close() + b'"}'
+
+
+async def prune_item_versions(db: AsyncSession, keep: int, before: Optional[datetime], batch_size: int) -> int:
+    expired = (await db.execute(expired_item_versions_statement(keep, before, batch_size))).all()
+    if len(expired) == 0:
+        return 0
+    version_ids = [d.id for d in expired]
+    await db.execute(lock_items_statement(sorted({d.item_id for d in expired})))
+    digests = (await db.execute(item_version_digests_statement(version_ids))).scalars().all()
+    res = (await db.execute(delete_item_versions_statement(version_ids))).rowcount
+    await db.execute(lock_chunk_data_statement())
+    await db.execute(delete_unreferenced_chunk_data_statement(digests))
+    await db.commit()
+    return res
+
+
+async def prune_chunk_data(db: AsyncSession, batch_size: int) -> int:
+    await db.execute(lock_chunk_data_statement())
+    digests = (await db.execute(unreferenced_chunk_data_statement(batch_size))).scalars().all()
+    res = (await db.execute(delete_unreferenced_chunk_data_statement(digests))).rowcount if len(digests) > 0 else 0
+    await db.commit()
+    return res
+
+
+async def keep_referenced_chunk_bodies(db: AsyncSession, items) -> List[schema.ShortUUID]:
+    item_ids = (await db.execute(items.order_by(models.Item.id).with_for_update())).scalars().all()
+    if len(item_ids) > 0:
+        await db.execute(share_chunk_bodies_statement(referenced_chunks_conditions(item_ids)))
+    return item_ids
+
+
+async def delete_item(db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    await keep_referenced_chunk_bodies(db, select(models.Item.id).where(*item_conditions(user, collection_id, item_id)))
+    res = (await db.execute(delete_item_statement(user, collection_id, item_id))).scalar()
+    forget_deleted(db.sync_session, models.Item, res)
+    await db.commit()
+    return res
+
+
+async def list_items(
+    db: AsyncSession,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    cursor: Optional[types.EncodedCursor] = None,
+    page_size: int = 10,
+    contains: Any = None,
+):
+    collection = await retrieve_collection(db, user, collection_id)
+    if collection is None:
+        return None
+    conditions = item_list_conditions(user, collection_id, contains)
+    return await _list_page(db, models.Item, conditions, cursor, page_size)
+
+
+async def retrieve_item_document(
+    db: AsyncSession,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    path: Tuple[str, ...],
+) -> Optional[ItemDocument]:
+    row = (await db.execute(retrieve_item_document_statement(user, collection_id, item_id, path, True))).first()
+    if row is None:
+        return None
+    if row.indexed:
+        return ItemDocument(row.updated_at, row.value if row.found else jsonpointer.missing)
+    if row.data_type != json_data_type:
+        raise ValueError("item is not application/json")
+    item = await retrieve_item(db, user, collection_id, item_id)
+    try:
+        document = await run_in_threadpool(json.loads, item.body)
+    except ValueError:
+        raise ValueError("item body is not valid JSON")
+    return ItemDocument(row.updated_at, jsonpointer.resolve(document, path))
+
+
+async def retrieve_item_derivative(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, variant: str
+):
+    return (await db.execute(retrieve_item_derivative_statement(user, collection_id, item_id, variant))).first()
+
+
+async def store_item_derivative(
+    db: AsyncSession,
+    item_id: schema.ShortUUID,
+    variant: str,
+    source_updated_at: datetime,
+    media_type: str,
+    body: bytes,
+) -> bool:
+    await db.execute(delete_item_derivatives_statement(item_id, variant))
+    try:
+        await db.execute(create_item_derivative_statement(item_id, variant, source_updated_at, media_type, body))
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+
+async def search_items(
+    db: AsyncSession,
+    user: models.User,
+    query: str,
+    collection_id: Optional[schema.ShortUUID] = None,
+    cursor: Optional[types.EncodedCursor] = None,
+    page_size: int = 10,
+):
+    if len(search.query_terms(query)) == 0:
+        raise ValueError("query has no searchable terms")
+    if collection_id is not None and await retrieve_collection(db, user, collection_id) is None:
+        return None
+    ranked = full_text_search_statement(user, collection_id, query)
+    res = (await db.execute(search_page_statement(ranked, cursor, page_size))).all()
+    count = (await db.execute(select(func.count()).select_from(ranked))).scalar()
+    return search_page_response(res, count, page_size)
+
+
+async def stream_collection_archive(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, archive_format: str
+) -> AsyncIterator[bytes]:
+    await db.commit()
+    await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    writer = archives.writers[archive_format]()
+    for item in (await db.execute(archive_items_statement(user, collection_id))).all():
+        yield writer.begin_file(archives.member_name(item.id, item.data_type), item.size, item.updated_at)
+        for index in range(item.chunks):
+            body = (await db.execute(retrieve_chunk_statement(item.id, index))).scalar()
+            chunk_bytes_read.inc(len(body))
+            yield writer.write(body)
+        yield writer.end_file()
+    yield writer.close()
+
+
+async def import_items(
+    db: AsyncSession,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    stream: AsyncIterable[bytes],
+    batch_items: int,
+    batch_bytes: int,
+) -> Optional[List[Dict[str, Any]]]:
+    if await retrieve_collection(db, user, collection_id) is None:
+        return None
+    importer = ArchiveImport(user, collection_id, True, batch_items, batch_bytes)
+    reader = archives.ArchiveReader()
+    try:
+        async for data in stream:
+            await apply_import_writes(db, await run_in_threadpool(plan_import_writes, reader, importer, data))
+        reader.close()
+    except ValueError as e:
+        await db.rollback()
+        raise ValueError(f"{e}; {importer.committed} items were imported before the error") from e
+    await apply_import_writes(db, importer.flush())
+    return importer.results
+
+
+async def apply_import_writes(db: AsyncSession, writes: Iterable[Tuple[str, Any]]):
+    for kind, value in writes:
+        if kind == "commit":
+            await db.commit()
+        elif kind == "chunks":
+            await insert_chunk_rows(db, value)
+        else:
+            await db.execute(value)
+
+
+async def copy_item(
+    db: AsyncSession,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    target_collection_id: schema.ShortUUID,
+    batch_size: int,
+):
+    if await retrieve_item_header(db, user, collection_id, item_id) is None:
+        return None
+    if await retrieve_collection(db, user, target_collection_id) is None:
+        return None
+    (copy_id,) = await copy_item_rows(db, [item_id], target_collection_id, batch_size)
+    await db.commit()
+    return await retrieve_item_header(db, user, target_collection_id, copy_id)
+
+
+async def clone_collection(
+    db: AsyncSession, user: models.User, collection_id: schema.ShortUUID, name: Optional[str], batch_size: int
+):
+    source = await retrieve_collection(db, user, collection_id)
+    if source is None:
+        return None
+    data = schema.CollectionCreateQuery(name=name if name is not None else source.name)
+    collection = (await db.execute(create_collection_statement(data, user))).one()
+    after = None
+    while True:
+        batch = (await db.execute(clone_source_items_statement(user, collection_id, after, batch_size))).all()
+        if len(batch) == 0:
+            break
+        await copy_item_rows(db, [d.id for d in batch], collection.id, batch_size)
+        await db.commit()
+        after = batch[-1].cursor_value
+    await db.commit()
+    return collection
+
+
+async def copy_item_rows(
+    db: AsyncSession, item_ids: List[schema.ShortUUID], target_collection_id: schema.ShortUUID, batch_size: int
+) -> List[schema.ShortUUID]:
+    item_ids_map = [(d, utils.gen_uuid()) for d in item_ids]
+    item_map = id_map_subquery(item_ids_map, "source_id", "id")
+    await db.execute(copy_items_statement(item_map, target_collection_id, utils.gen_datetime()))
+    copies = dict(item_ids_map)
+    await db.execute(lock_items_statement(sorted(item_ids), read=True))
+    chunks = (await db.execute(source_chunks_statement(item_ids))).all()
+    for i in range(0, len(chunks), batch_size):
+        rows = [(d.id, utils.gen_uuid(), copies[d.item_id]) for d in chunks[i : i + batch_size]]
+        await db.execute(copy_chunks_statement(id_map_subquery(rows, "source_id", "id", "item_id")))
+    return [d for _, d in item_ids_map]
+
+
+async def create_job(db: AsyncSession, user: models.User, kind: str, params: Dict[str, Any], max_attempts: int = 3):
+    job = (await db.execute(create_job_statement(user, kind, params, max_attempts))).one()
+    await db.commit()
+    return job
+
+
+async def retrieve_job(db: AsyncSession, user: models.User, job_id: schema.ShortUUID):
+    return (await db.execute(retrieve_job_statement(user, job_id))).first()
+
+
+async def _list_page(db: AsyncSession, model, conditions, cursor: Optional[types.EncodedCursor], page_size: int):
+    res = (await db.execute(page_statement(model, conditions, cursor, page_size))).scalars().all()
+    b0, b1 = None, None
+    if len(res) > 0:
+        res = sort_page(res)
+        b0, b1 = [(await db.execute(d)).scalar() for d in neighbor_statements(model, conditions, res)]
+    return page_response(res, (await db.execute(count_statement(model, conditions))).scalar(), b0, b1)
@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import registry
+
+cache_hits = registry.counter("docserver_cache_hits_total", "Cache lookups that were served from memory.", ("cache",))
+cache_misses = registry.counter("docserver_cache_misses_total", "Cache lookups that missed.", ("cache",))
+cache_evictions = registry.counter(
+    "docserver_cache_evictions_total", "Entries evicted to stay under the size bound.", ("cache",)
+)
+cache_bytes = registry.gauge("docserver_cache_bytes", "Bytes held by the cache.", ("cache",))
+cache_entries = registry.gauge("docserver_cache_entries", "Entries held by the cache.", ("cache",))
+cache_invalidations = registry.counter(
+    "docserver_cache_invalidations_total",
+    "Invalidations exchanged with other workers over the invalidation bus.",
+    ("cache", "direction"),
+)
+
+invalidation_ops = ("delete", "delete_tagged", "clear")
+
+
+class InvalidationBus:
+    """In-process bus; subclasses fan invalidations out to other workers and nodes."""
+
+    def __init__(self):
+        self._caches: Dict[str, Any] = {}
+
+    def attach(self, cache):
+        self._caches[cache.name] = cache
+        cache.bus = self
+
+    def publish(self, name: str, op: str, *args):
+        pass
+
+    def apply(self, name: str, op: str, *args):
+        cache = self._caches.get(name)
+        if cache is None or op not in invalidation_ops:
+            return
+        cache_invalidations.inc(cache=name, direction="received")
+        getattr(cache, op)(*args, propagate=False)
+
+    def clear_all(self):
+        for cache in self._caches.values():
+            cache.clear(propagate=False)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalCache:
+    name = "default"
+    bus: Optional[InvalidationBus] = None
+    # caches that wait on a server set this, so that async callers run their operations in the threadpool
+    blocking = False
+
+    def propagate(self, op: str, *args):
+        if self.bus is not None:
+            cache_invalidations.inc(cache=self.name, direction="sent")
+            self.bus.publish(self.name, op, *args)
+
+    async def _run(self, method: Callable[..., Any], *args, **kwargs) -> Any:
+        if self.blocking:
+            return await run_in_threadpool(method, *args, **kwargs)
+        return method(*args, **kwargs)
+
+    async def aget(self, key: Hashable, *args, **kwargs) -> Any:
+        return await self._run(self.get, key, *args, **kwargs)
+
+    async def aset(self, key: Hashable, *args, **kwargs) -> Any:
+        return await self._run(self.set, key, *args, **kwargs)
+
+    async def adelete(self, key: Hashable):
+        await self._run(self.delete, key)
+
+    async def adelete_tagged(self, tag: Hashable):
+        await self._run(self.delete_tagged, tag)
+
+    async def acontains(self, key: Hashable) -> bool:
+        return await self._run(self.__contains__, key)
+
+
+class TTLCache(LocalCache):
+    def __init__(self, ttl: float, max_entries: int, name: str = "default"):
+        self.name = name
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable, propagate: bool = True):
+        with self._lock:
+            self._entries.pop(key, None)
+        if propagate:
+            self.propagate("delete", key)
+
+    def clear(self, propagate: bool = True):
+        with self._lock:
+            self._entries.clear()
+        if propagate:
+            self.propagate("clear")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ByteLRUCache(LocalCache):
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None, name: str = "default"):
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_bytes if max_entry_bytes is None else min(max_entry_bytes, max_bytes)
+        self._entries: "OrderedDict[Hashable, Tuple[Any, bytes, Optional[float], Tuple[Hashable, ...]]]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.name = name
+        cache_bytes.set_function(lambda: self._bytes, cache=name)
+        cache_entries.set_function(lambda: len(self._entries), cache=name)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, payload, expires_at, _ = entry
+                if expires_at is not None and expires_at < time.monotonic():
+                    self._remove(key)
+                elif entry_version == version:
+                    self._entries.move_to_end(key)
+                    cache_hits.inc(cache=self.name)
+                    return payload
+        cache_misses.inc(cache=self.name)
+        return None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def set(
+        self,
+        key: Hashable,
+        payload: bytes,
+        version: Any = None,
+        ttl: Optional[float] = None,
+        tags: Tuple[Hashable, ...] = (),
+    ) -> bool:
+        if len(payload) > self._max_entry_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            expires_at = None if ttl is None else time.monotonic() + ttl
+            self._entries[key] = (version, payload, expires_at, tags)
+            self._bytes += len(payload)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                cache_evictions.inc(cache=self.name)
+        return True
+
+    def delete(self, key: Hashable, propagate: bool = True):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+        if propagate:
+            self.propagate("delete", key)
+
+    def delete_tagged(self, tag: Hashable, propagate: bool = True):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+        if propagate:
+            self.propagate("delete_tagged", tag)
+
+    def clear(self, propagate: bool = True):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+        if propagate:
+            self.propagate("clear")
+
+    def _remove(self, key: Hashable):
+        _, payload, _, tags = self._entries.pop(key)
+        self._bytes -= len(payload)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._tags[tag]
+
+    def __len__(self) -> int:
+        return len(self._entries)
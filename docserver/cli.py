@@ -0,0 +1,161 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+from . import config, warmup
+
+logger = logging.getLogger(__name__)
+
+
+def per_worker_pool_options(settings: config.Settings, workers: int) -> Dict[str, int]:
+    options = {}
+    if settings.DB_POOL_SIZE_TOTAL is not None:
+        options["DB_POOL_SIZE"] = max(1, settings.DB_POOL_SIZE_TOTAL // workers)
+    if settings.DB_MAX_OVERFLOW_TOTAL is not None:
+        options["DB_MAX_OVERFLOW"] = max(0, settings.DB_MAX_OVERFLOW_TOTAL // workers)
+    return options
+
+
+def bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(args: argparse.Namespace, pool_options: Dict[str, int], sock: Optional[socket.socket]):
+    import uvicorn
+
+    from .app import generate_app
+
+    if sock is None:
+        sock = bind_socket(args.host, args.port, True)
+    app = generate_app(config.get_setting(**pool_options))
+
+    async def warm_worker():
+        await warmup.warmup(app)
+
+    app.router.on_startup.insert(0, warm_worker)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            log_level=args.log_level,
+            timeout_graceful_shutdown=args.graceful_timeout,
+            timeout_keep_alive=args.keep_alive,
+        )
+    )
+    server.run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, args: argparse.Namespace, pool_options: Dict[str, int]):
+        self.args = args
+        self.pool_options = pool_options
+        self.context = multiprocessing.get_context("fork")
+        self.sock = None if args.reuse_port else bind_socket(args.host, args.port, False)
+        self.workers: List[multiprocessing.Process] = []
+        self.stopping = False
+
+    def spawn(self) -> multiprocessing.Process:
+        process = self.context.Process(
+            target=run_worker, args=(self.args, self.pool_options, self.sock), name="docserver-worker"
+        )
+        process.start()
+        return process
+
+    def handle_signal(self, signum, frame):
+        self.stopping = True
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        self.workers = [self.spawn() for _ in range(self.args.workers)]
+        logger.info("started %d workers on %s:%d", len(self.workers), self.args.host, self.args.port)
+        while not self.stopping:
+            for i, process in enumerate(self.workers):
+                if not process.is_alive():
+                    logger.warning("worker %d exited with %s; restarting", process.pid, process.exitcode)
+                    self.workers[i] = self.spawn()
+            time.sleep(0.5)
+        return self.shutdown()
+
+    def shutdown(self) -> int:
+        logger.info("draining %d workers", len(self.workers))
+        for process in self.workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        for process in self.workers:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("worker %d did not drain in time; killing", process.pid)
+                process.kill()
+                process.join()
+        if self.sock is not None:
+            self.sock.close()
+        return 0
+
+
+def run_job_worker(args: argparse.Namespace, settings: config.Settings) -> int:
+    from .app import setup_job_worker
+    from .deps import SessionHandler
+
+    worker = setup_job_worker(settings, SessionHandler(settings), args.concurrency)
+
+    def handle_signal(signum, frame):
+        worker.request_stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    logger.info("job worker %s started with concurrency %d", worker.worker_id, args.concurrency)
+    worker.run_forever()
+    return 0
+
+
+def parse_args(argv: Optional[List[str]], settings: config.Settings) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="docserver", description="Run the document server.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="serve",
+        choices=("serve", "worker"),
+        help="serve HTTP requests or run background jobs",
+    )
+    parser.add_argument("--host", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=settings.SERVER_WORKERS or os.cpu_count() or 1)
+    parser.add_argument(
+        "--reuse-port",
+        action=argparse.BooleanOptionalAction,
+        default=settings.SERVER_REUSE_PORT,
+        help="let every worker bind its own SO_REUSEPORT socket instead of sharing one",
+    )
+    parser.add_argument("--graceful-timeout", type=float, default=settings.SERVER_GRACEFUL_TIMEOUT_SECONDS)
+    parser.add_argument("--keep-alive", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=max(1, settings.JOBS_IN_PROCESS_WORKERS))
+    parser.add_argument("--log-level", default="info")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    settings = config.get_setting()
+    args = parse_args(argv, settings)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(process)d %(levelname)s %(message)s")
+    if args.command == "worker":
+        return run_job_worker(args, settings)
+    return Supervisor(args, per_worker_pool_options(settings, args.workers)).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
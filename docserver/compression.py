@@ -0,0 +1,85 @@
+import gzip
+from typing import Callable, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from .formats import parse_accept
+from .metrics import registry
+
+compressed_bytes_saved = registry.counter(
+    "docserver_compression_saved_bytes_total", "Response bytes saved by content encoding.", ("encoding",)
+)
+
+# bodies up to this size are compressed on the event loop; a threadpool hop would cost more
+inline_max_bytes = 64 * 1024
+compressed_media_types = ("application/zip", "application/gzip", "application/zstd", "application/x-brotli")
+
+
+class Encoding:
+    def __init__(self, name: str, compress: Callable[[bytes], bytes]):
+        self.name = name
+        self.compress = compress
+
+
+def gzip_encoding() -> Encoding:
+    return Encoding("gzip", lambda data: gzip.compress(data, compresslevel=6, mtime=0))
+
+
+def brotli_encoding() -> Encoding:
+    import brotli
+
+    return Encoding("br", lambda data: brotli.compress(data, quality=5))
+
+
+def zstd_encoding() -> Encoding:
+    import zstandard
+
+    # a ZstdCompressor must not be shared between threads, and large bodies are compressed in the threadpool
+    return Encoding("zstd", lambda data: zstandard.ZstdCompressor(level=3).compress(data))
+
+
+def load_encodings() -> Dict[str, Encoding]:
+    """Available encodings, most preferred first when a client accepts several with the same quality."""
+    encodings = {}
+    for factory in (zstd_encoding, brotli_encoding, gzip_encoding):
+        try:
+            encoding = factory()
+        except ImportError:
+            continue
+        encodings[encoding.name] = encoding
+    return encodings
+
+
+encodings = load_encodings()
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[Encoding]:
+    """Returns the encoding the client prefers, or None when the body should be sent as is."""
+    if not accept_encoding:
+        return None
+    qualities = dict(parse_accept(accept_encoding))
+    best, best_q = None, 0.0
+    for name, encoding in encodings.items():
+        q = qualities.get(name, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def is_compressible(media_type: Optional[str]) -> bool:
+    """False for media types that are already compressed, so that PNG or JPEG bodies are never recompressed."""
+    if media_type is None:
+        return True
+    media_type = media_type.partition(";")[0].strip().lower()
+    if media_type.startswith(("image/", "audio/", "video/")):
+        return media_type == "image/svg+xml"
+    return media_type not in compressed_media_types
+
+
+async def compress(encoding: Encoding, data: bytes) -> bytes:
+    if len(data) > inline_max_bytes:
+        res = await run_in_threadpool(encoding.compress, data)
+    else:
+        res = encoding.compress(data)
+    compressed_bytes_saved.inc(max(0, len(data) - len(res)), encoding=encoding.name)
+    return res
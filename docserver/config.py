@@ -21,11 +21,13 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_PORT: str = '5432'
     DB_DBNAME: str = 'postgres'
-    SQLALCHEMY_DATABASE_URI: Optional[PostgresDsn] = None
+    SQLALCHEMY_DATABASE_URI: Optional[str] = None
 
     @validator("SQLALCHEMY_DATABASE_URI", pre=True)
     def assemble_db_connection(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
         if isinstance(v, str):
+            if not v.startswith(("postgres", "sqlite")):
+                raise ValueError("SQLALCHEMY_DATABASE_URI must be a PostgreSQL or SQLite URI")
             return v
         return PostgresDsn.build(
             scheme="postgresql",
@@ -36,12 +38,141 @@ class Settings(BaseSettings):
             path=f"/{values.get('DB_DBNAME') or ''}",
         )
 
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT_SECONDS: float = 30.0
+    DB_POOL_RECYCLE_SECONDS: int = 30 * 60
+    DB_POOL_PRE_PING: bool = False
+    DB_STATEMENT_TIMEOUT_MS: Optional[int] = None
+    DB_POOL_SIZE_TOTAL: Optional[int] = None
+    DB_MAX_OVERFLOW_TOTAL: Optional[int] = None
+    DB_SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    DB_SQLITE_BUSY_TIMEOUT_MS: int = 5000
+
+    DB_ASYNC: bool = False
+    SQLALCHEMY_ASYNC_DATABASE_URI: Optional[str] = None
+
+    @validator("SQLALCHEMY_ASYNC_DATABASE_URI", pre=True, always=True)
+    def assemble_async_db_connection(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
+        if isinstance(v, str):
+            return v
+        uri = values.get("SQLALCHEMY_DATABASE_URI")
+        if uri is None:
+            return None
+        return str(uri).replace("postgresql://", "postgresql+asyncpg://", 1)
+
+    @validator("DB_ASYNC")
+    def check_async_backend(cls, v: bool, values: Dict[str, Any]) -> bool:
+        if v and str(values.get("SQLALCHEMY_DATABASE_URI")).startswith("sqlite"):
+            raise ValueError("DB_ASYNC is not supported with SQLite")
+        return v
+
+    SQLALCHEMY_REPLICA_DATABASE_URIS: List[str] = []
+    SQLALCHEMY_ASYNC_REPLICA_DATABASE_URIS: List[str] = []
+    DB_REPLICA_SELECTION: str = "round_robin"
+    DB_REPLICA_RETRY_SECONDS: float = 30.0
+    DB_READ_YOUR_WRITES_SECONDS: float = 0.0
+    DB_READ_YOUR_WRITES_SIZE: int = 10000
+
+    @validator("SQLALCHEMY_REPLICA_DATABASE_URIS", pre=True)
+    def assemble_replica_uris(cls, v: Union[str, List[str]]) -> Union[List[str], str]:
+        if isinstance(v, str) and not v.startswith("["):
+            return [i.strip() for i in v.split(",") if i.strip()]
+        elif isinstance(v, (list, str)):
+            return v
+        raise ValueError(v)
+
+    @validator("SQLALCHEMY_ASYNC_REPLICA_DATABASE_URIS", pre=True, always=True)
+    def assemble_async_replica_uris(cls, v: Union[str, List[str], None], values: Dict[str, Any]) -> Any:
+        if v:
+            return v
+        return [
+            d.replace("postgresql://", "postgresql+asyncpg://", 1)
+            for d in values.get("SQLALCHEMY_REPLICA_DATABASE_URIS", [])
+        ]
+
+    @validator("DB_REPLICA_SELECTION")
+    def check_replica_selection(cls, v: str) -> str:
+        if v not in ("round_robin", "least_connections"):
+            raise ValueError("DB_REPLICA_SELECTION must be round_robin or least_connections")
+        return v
+
     DEFAULT_PAGE_SIZE: int = 50
 
     SECRET_KEY: str
     ALGORITHM = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES = 30
     REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 30
+    REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS: int = 60 * 60
+    API_KEY_SECRET: Optional[str] = None
+    API_KEY_CACHE_SECONDS: int = 30
+    API_KEY_CACHE_SIZE: int = 10000
+    RESPONSE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    RESPONSE_CACHE_MAX_ENTRY_BYTES: int = 16 * 1024 * 1024
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MINIMUM_SIZE: int = 1024
+    CACHE_BACKEND: str = "memory"
+    CACHE_URL: Optional[str] = None
+    CACHE_INVALIDATION_CHANNEL: str = "docserver:invalidate"
+
+    @validator("CACHE_URL", always=True)
+    def check_cache_url(cls, v: Optional[str], values: Dict[str, Any]) -> Optional[str]:
+        if v is not None and not v.startswith("redis://"):
+            raise ValueError("CACHE_URL must be a redis:// URL")
+        backend = values.get("CACHE_BACKEND")
+        if backend not in ("memory", "redis"):
+            raise ValueError("CACHE_BACKEND must be memory or redis")
+        if backend == "redis" and v is None:
+            raise ValueError("CACHE_URL is required when CACHE_BACKEND is redis")
+        return v
+
+    @validator("API_KEY_SECRET", pre=True, always=True)
+    def default_api_key_secret(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
+        if isinstance(v, str):
+            return v
+        return values.get("SECRET_KEY")
+
+    SERVER_TIMING_ENABLED: bool = True
+    QUERY_REPEAT_WARNING_THRESHOLD: int = 5
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 59019
+    SERVER_WORKERS: Optional[int] = None
+    SERVER_REUSE_PORT: bool = False
+    SERVER_GRACEFUL_TIMEOUT_SECONDS: float = 30.0
+
+    JOBS_IN_PROCESS_WORKERS: int = 1
+    JOBS_POLL_INTERVAL_SECONDS: float = 1.0
+    JOBS_LEASE_SECONDS: float = 300.0
+    JOBS_RETRY_SECONDS: float = 10.0
+    JOBS_MAX_ATTEMPTS: int = 3
+    JOBS_DELETE_BATCH_SIZE: int = 1000
+
+    ITEM_VERSIONS_KEEP: int = 10
+    ITEM_VERSIONS_MAX_AGE_DAYS: Optional[float] = None
+    ITEM_VERSIONS_PRUNE_INTERVAL_SECONDS: int = 60 * 60
+    ITEM_VERSIONS_PRUNE_BATCH_SIZE: int = 500
+
+    ITEM_REQUEST_MAX_BYTES: int = 1024 * 1024 * 1024
+    ITEM_IMPORT_BATCH_ITEMS: int = 100
+    ITEM_IMPORT_BATCH_BYTES: int = 64 * 1024 * 1024
+    ITEM_CLONE_BATCH_SIZE: int = 300
+
+    IMAGE_DERIVATIVE_WORKERS: int = 2
+    IMAGE_DERIVATIVE_MAX_WIDTH: int = 2048
+
+    METRICS_ENABLED: bool = True
+    METRICS_PATH: str = "/metrics"
+    PROFILING_ENABLED: bool = False
+    PROFILING_TOKEN: Optional[str] = None
+    PROFILING_HEADER: str = "X-Docserver-Profile"
+    PROFILING_OUTPUT_DIR: str = "profiles"
+    PROFILING_INTERVAL_SECONDS: float = 0.005
+
+    @validator("PROFILING_TOKEN", always=True)
+    def check_profiling_token(cls, v: Optional[str], values: Dict[str, Any]) -> Optional[str]:
+        if values.get("PROFILING_ENABLED") and not v:
+            raise ValueError("PROFILING_TOKEN is required when PROFILING_ENABLED is set")
+        return v
 
     class Config:
         case_sensitive = True
@@ -1,12 +1,212 @@
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
 from pydantic import PostgresDsn
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from . import sqlite
+from .metrics import registry
+
+pool_checkout_seconds = registry.histogram(
+    "docserver_db_pool_checkout_seconds", "Time spent waiting for a pooled connection.", ("pool",)
+)
+pool_checkout_timeouts = registry.counter(
+    "docserver_db_pool_checkout_timeouts_total", "Checkouts that gave up after the pool timeout.", ("pool",)
+)
+pool_connections_in_use = registry.gauge(
+    "docserver_db_pool_connections_in_use", "Connections currently checked out of the pool.", ("pool",)
+)
+pool_connections_idle = registry.gauge(
+    "docserver_db_pool_connections_idle", "Connections currently idle in the pool.", ("pool",)
+)
+pool_overflow = registry.gauge(
+    "docserver_db_pool_overflow", "Connections open beyond the configured pool size.", ("pool",)
+)
+connection_lifetime_seconds = registry.histogram(
+    "docserver_db_connection_lifetime_seconds",
+    "Lifetime of database connections when they are closed.",
+    ("pool",),
+    buckets=(1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0),
+)
+
+
+class InstrumentedPoolMixin:
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super(InstrumentedPoolMixin, self)._do_get()
+        except TimeoutError:
+            pool_checkout_timeouts.inc(pool=self.logging_name)
+            raise
+        finally:
+            pool_checkout_seconds.observe(time.perf_counter() - started, pool=self.logging_name)
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument_engine(engine: Engine, pool_name: str):
+    pool_connections_in_use.set_function(lambda: engine.pool.checkedout(), pool=pool_name)
+    pool_connections_idle.set_function(lambda: engine.pool.checkedin(), pool=pool_name)
+    pool_overflow.set_function(lambda: max(engine.pool.overflow(), 0), pool=pool_name)
+
+    @event.listens_for(engine, "connect")
+    def record_connected_at(dbapi_connection, connection_record):
+        connection_record.info["connected_at"] = time.monotonic()
+
+    @event.listens_for(engine, "close")
+    def observe_lifetime(dbapi_connection, connection_record):
+        connected_at = connection_record.info.pop("connected_at", None)
+        if connected_at is not None:
+            connection_lifetime_seconds.observe(time.monotonic() - connected_at, pool=pool_name)
+
 
+def engine_options(
+    pool_name: str,
+    pool_size: int,
+    max_overflow: int,
+    pool_timeout: float,
+    pool_recycle: int,
+    pool_pre_ping: bool,
+    connect_args: Dict[str, Any],
+) -> Dict[str, Any]:
+    return {
+        "pool_logging_name": pool_name,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+        "connect_args": connect_args,
+    }
 
-def setup_engine(database_uri: PostgresDsn) -> Engine:
-    return create_engine(database_uri)
+
+def setup_engine(
+    database_uri: PostgresDsn,
+    pool_name: str = "primary",
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30.0,
+    pool_recycle: int = -1,
+    pool_pre_ping: bool = False,
+    statement_timeout_ms: Optional[int] = None,
+) -> Engine:
+    connect_args = {} if statement_timeout_ms is None else {"options": f"-c statement_timeout={statement_timeout_ms}"}
+    engine = create_engine(
+        database_uri,
+        poolclass=InstrumentedQueuePool,
+        **engine_options(pool_name, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping, connect_args),
+    )
+    instrument_engine(engine, pool_name)
+    return engine
+
+
+def setup_sqlite_engine(
+    database_uri: str,
+    writer: bool,
+    pool_name: str = "primary",
+    pool_size: int = 5,
+    pool_timeout: float = 30.0,
+    pool_recycle: int = -1,
+    mmap_size: int = 256 * 1024 * 1024,
+    busy_timeout_ms: int = 5000,
+) -> Engine:
+    engine = create_engine(
+        database_uri,
+        poolclass=InstrumentedQueuePool,
+        **engine_options(
+            pool_name,
+            1 if writer else pool_size,
+            0,
+            pool_timeout,
+            pool_recycle,
+            False,
+            {"check_same_thread": False},
+        ),
+    )
+    sqlite.configure_engine(engine, writer, mmap_size, busy_timeout_ms)
+    instrument_engine(engine, pool_name)
+    return engine
 
 
 def setup_sessionmaker(engine: Engine) -> sessionmaker:
-    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+def setup_async_engine(
+    database_uri: str,
+    pool_name: str = "primary_async",
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30.0,
+    pool_recycle: int = -1,
+    pool_pre_ping: bool = False,
+    statement_timeout_ms: Optional[int] = None,
+) -> AsyncEngine:
+    connect_args = (
+        {} if statement_timeout_ms is None else {"server_settings": {"statement_timeout": str(statement_timeout_ms)}}
+    )
+    engine = create_async_engine(
+        database_uri,
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        **engine_options(pool_name, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping, connect_args),
+    )
+    instrument_engine(engine.sync_engine, pool_name)
+    return engine
+
+
+def setup_async_sessionmaker(engine: AsyncEngine) -> sessionmaker:
+    return sessionmaker(class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+class ReplicaSet:
+    strategies = ("round_robin", "least_connections")
+
+    def __init__(
+        self,
+        engines: List[Any],
+        strategy: str = "round_robin",
+        retry_seconds: float = 30.0,
+        pool_of: Callable[[Any], Any] = lambda engine: engine.pool,
+    ):
+        if strategy not in self.strategies:
+            raise ValueError(f"unknown replica selection strategy: {strategy}")
+        self.engines = engines
+        self.strategy = strategy
+        self.retry_seconds = retry_seconds
+        self._pool_of = pool_of
+        self._counter = itertools.count()
+        self._down_until: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.engines)
+
+    def candidates(self) -> Iterator[Any]:
+        if len(self.engines) == 0:
+            return iter(())
+        now = time.monotonic()
+        with self._lock:
+            up = [i for i in range(len(self.engines)) if self._down_until.get(i, 0.0) <= now]
+        if self.strategy == "least_connections":
+            up.sort(key=lambda i: self._pool_of(self.engines[i]).checkedout())
+        elif len(up) > 0:
+            offset = next(self._counter) % len(up)
+            up = up[offset:] + up[:offset]
+        return (self.engines[i] for i in up)
+
+    def mark_down(self, engine: Any):
+        with self._lock:
+            self._down_until[self.engines.index(engine)] = time.monotonic() + self.retry_seconds
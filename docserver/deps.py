@@ -1,18 +1,65 @@
-from typing import Generator, Optional
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Generator, Iterator, Optional
 
+import anyio
+from fastapi import Request
+from sqlalchemy import event
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
 
-from . import config
-from .db import setup_engine, setup_sessionmaker
+from . import async_operators, config, operators, querystats, sqlite, utils
+from .cache import TTLCache
+from .db import (
+    ReplicaSet,
+    setup_async_engine,
+    setup_async_sessionmaker,
+    setup_engine,
+    setup_sessionmaker,
+    setup_sqlite_engine,
+)
+
+
+class ThreadpoolOperators:
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name: str):
+        module = self._module
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(getattr(module, name), *args, **kwargs)
+
+        return call
+
+
+def iterate_from_thread(stream: AsyncIterator[bytes]) -> Iterator[bytes]:
+    """Lets an operator running in the threadpool pull from an async iterator owned by the event loop."""
+    iterator = stream.__aiter__()
+
+    async def next_part():
+        return await iterator.__anext__()
+
+    while True:
+        try:
+            yield anyio.from_thread.run(next_part)
+        except StopAsyncIteration:
+            return
+
+
+read_methods = ("GET", "HEAD", "OPTIONS")
 
 
 class SessionHandler:
+    operators = ThreadpoolOperators(operators)
+
     def __init__(self, settings: Optional[config.Settings] = None):
         self._settings = settings
         self._engine = None
         self._sessionmaker = None
+        self._replicas = None
+        self._recent_writers = None
 
     @property
     def settings(self) -> config.Settings:
@@ -20,10 +67,41 @@ class SessionHandler:
             self._settings = config.get_setting()
         return self._settings
 
+    @property
+    def engine_options(self) -> Dict[str, Any]:
+        return {
+            "pool_size": self.settings.DB_POOL_SIZE,
+            "max_overflow": self.settings.DB_MAX_OVERFLOW,
+            "pool_timeout": self.settings.DB_POOL_TIMEOUT_SECONDS,
+            "pool_recycle": self.settings.DB_POOL_RECYCLE_SECONDS,
+            "pool_pre_ping": self.settings.DB_POOL_PRE_PING,
+            "statement_timeout_ms": self.settings.DB_STATEMENT_TIMEOUT_MS,
+        }
+
+    @property
+    def is_sqlite(self) -> bool:
+        return sqlite.is_sqlite_uri(self.settings.SQLALCHEMY_DATABASE_URI)
+
+    def setup_sqlite_engine(self, writer: bool, pool_name: str) -> Engine:
+        return setup_sqlite_engine(
+            self.settings.SQLALCHEMY_DATABASE_URI,
+            writer,
+            pool_name=pool_name,
+            pool_size=self.settings.DB_POOL_SIZE,
+            pool_timeout=self.settings.DB_POOL_TIMEOUT_SECONDS,
+            pool_recycle=self.settings.DB_POOL_RECYCLE_SECONDS,
+            mmap_size=self.settings.DB_SQLITE_MMAP_SIZE,
+            busy_timeout_ms=self.settings.DB_SQLITE_BUSY_TIMEOUT_MS,
+        )
+
     @property
     def engine(self) -> Engine:
         if self._engine is None:
-            self._engine = setup_engine(self.settings.SQLALCHEMY_DATABASE_URI)
+            if self.is_sqlite:
+                self._engine = self.setup_sqlite_engine(True, "primary")
+            else:
+                self._engine = setup_engine(self.settings.SQLALCHEMY_DATABASE_URI, **self.engine_options)
+            querystats.attach_query_counter(self._engine, "primary")
         return self._engine
 
     @property
@@ -32,8 +110,63 @@ class SessionHandler:
             self._sessionmaker = setup_sessionmaker(self.engine)
         return self._sessionmaker
 
-    def get_db(self) -> Generator:
+    @property
+    def replicas(self) -> ReplicaSet:
+        if self._replicas is None:
+            if self.is_sqlite:
+                engines = [self.setup_sqlite_engine(False, "reader")]
+            else:
+                engines = [
+                    setup_engine(uri, pool_name=f"replica{i}", **self.engine_options)
+                    for i, uri in enumerate(self.settings.SQLALCHEMY_REPLICA_DATABASE_URIS)
+                ]
+            for engine in engines:
+                querystats.attach_query_counter(engine, engine.pool.logging_name)
+            self._replicas = ReplicaSet(
+                engines,
+                strategy=self.settings.DB_REPLICA_SELECTION,
+                retry_seconds=self.settings.DB_REPLICA_RETRY_SECONDS,
+            )
+        return self._replicas
+
+    @property
+    def recent_writers(self) -> TTLCache:
+        if self._recent_writers is None:
+            self._recent_writers = TTLCache(
+                self.settings.DB_READ_YOUR_WRITES_SECONDS, self.settings.DB_READ_YOUR_WRITES_SIZE
+            )
+        return self._recent_writers
+
+    @staticmethod
+    def _writer_key(request: Request) -> Optional[str]:
+        authorization = request.headers.get("Authorization")
+        return None if authorization is None else utils.calc_token_digest(authorization)
+
+    def record_write(self, request: Request):
+        if self.settings.DB_READ_YOUR_WRITES_SECONDS <= 0 or request.method in read_methods:
+            return
+        key = self._writer_key(request)
+        if key is not None:
+            self.recent_writers.set(key, True)
+
+    def record_write_on_commit(self, db, request: Request):
+        """Records the write as soon as the session commits; teardown after the yield runs after the response."""
+        if self.settings.DB_READ_YOUR_WRITES_SECONDS > 0 and request.method not in read_methods:
+            event.listen(db, "after_commit", lambda session: self.record_write(request))
+
+    def reads_own_writes(self, request: Request) -> bool:
+        if self.settings.DB_READ_YOUR_WRITES_SECONDS <= 0:
+            return False
+        key = self._writer_key(request)
+        return key is not None and self.recent_writers.get(key, False)
+
+    @staticmethod
+    def is_replica_session(db) -> bool:
+        return db.info.get("replica", False)
+
+    def get_db(self, request: Request) -> Generator:
         db = self.sessionmaker()
+        self.record_write_on_commit(db, request)
         try:
             yield db
         except SQLAlchemyError as e:
@@ -41,3 +174,156 @@ class SessionHandler:
             db.rollback()
         finally:
             db.close()
+
+    def _open_read_session(self, request: Request):
+        if not self.reads_own_writes(request):
+            for engine in self.replicas.candidates():
+                db = self.sessionmaker(bind=engine, info={"replica": True})
+                try:
+                    db.connection()
+                except (DBAPIError, OSError):
+                    db.close()
+                    self.replicas.mark_down(engine)
+                    continue
+                return db
+        return self.sessionmaker()
+
+    def get_read_db(self, request: Request) -> Generator:
+        db = self._open_read_session(request)
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            assert e is not None
+            db.rollback()
+        finally:
+            db.close()
+
+    def stream_operator(self, db, name: str, *args, **kwargs) -> Generator:
+        """Iterates a generator operator over the route's session.
+
+        The session stays usable while the body streams, since dependency teardown runs after the response is sent.
+        """
+        yield from getattr(operators, name)(db, *args, **kwargs)
+
+    def body_stream(self, request: Request) -> Iterator[bytes]:
+        return iterate_from_thread(request.stream())
+
+    def job_session(self) -> Session:
+        """Opens a blocking primary session for a job worker thread.
+
+        Workers run outside the event loop, so they use the sync engine even when routes are served by the async one.
+        """
+        return self.sessionmaker()
+
+    async def call_with_primary(self, func, *args, **kwargs):
+        db = self.sessionmaker()
+        try:
+            return await func(db, *args, **kwargs)
+        finally:
+            await run_in_threadpool(db.close)
+
+    async def call_operator(self, name: str, *args, **kwargs):
+        def call():
+            db = self.sessionmaker()
+            try:
+                return getattr(operators, name)(db, *args, **kwargs)
+            finally:
+                db.close()
+
+        return await run_in_threadpool(call)
+
+
+class AsyncSessionHandler(SessionHandler):
+    operators = async_operators
+
+    def __init__(self, settings: Optional[config.Settings] = None):
+        super(AsyncSessionHandler, self).__init__(settings)
+        self._async_engine = None
+        self._async_sessionmaker = None
+        self._async_replicas = None
+
+    @property
+    def async_engine(self) -> AsyncEngine:
+        if self._async_engine is None:
+            self._async_engine = setup_async_engine(self.settings.SQLALCHEMY_ASYNC_DATABASE_URI, **self.engine_options)
+            querystats.attach_query_counter(self._async_engine.sync_engine, "primary_async")
+        return self._async_engine
+
+    @property
+    def async_sessionmaker(self) -> sessionmaker:
+        if self._async_sessionmaker is None:
+            self._async_sessionmaker = setup_async_sessionmaker(self.async_engine)
+        return self._async_sessionmaker
+
+    @property
+    def async_replicas(self) -> ReplicaSet:
+        if self._async_replicas is None:
+            engines = [
+                setup_async_engine(uri, pool_name=f"replica{i}_async", **self.engine_options)
+                for i, uri in enumerate(self.settings.SQLALCHEMY_ASYNC_REPLICA_DATABASE_URIS)
+            ]
+            for engine in engines:
+                querystats.attach_query_counter(engine.sync_engine, engine.sync_engine.pool.logging_name)
+            self._async_replicas = ReplicaSet(
+                engines,
+                strategy=self.settings.DB_REPLICA_SELECTION,
+                retry_seconds=self.settings.DB_REPLICA_RETRY_SECONDS,
+                pool_of=lambda engine: engine.sync_engine.pool,
+            )
+        return self._async_replicas
+
+    async def get_db(self, request: Request) -> AsyncGenerator:
+        db = self.async_sessionmaker()
+        self.record_write_on_commit(db.sync_session, request)
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            assert e is not None
+            await db.rollback()
+        finally:
+            await db.close()
+
+    async def _open_read_session(self, request: Request):
+        if not self.reads_own_writes(request):
+            for engine in self.async_replicas.candidates():
+                db = self.async_sessionmaker(bind=engine, info={"replica": True})
+                try:
+                    await db.connection()
+                except (DBAPIError, OSError):
+                    await db.close()
+                    self.async_replicas.mark_down(engine)
+                    continue
+                return db
+        return self.async_sessionmaker()
+
+    async def get_read_db(self, request: Request) -> AsyncGenerator:
+        db = await self._open_read_session(request)
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            assert e is not None
+            await db.rollback()
+        finally:
+            await db.close()
+
+    async def stream_operator(self, db, name: str, *args, **kwargs) -> AsyncGenerator:
+        async for part in getattr(async_operators, name)(db, *args, **kwargs):
+            yield part
+
+    def body_stream(self, request: Request) -> AsyncIterator[bytes]:
+        return request.stream()
+
+    async def call_with_primary(self, func, *args, **kwargs):
+        async with self.async_sessionmaker() as db:
+            return await func(db, *args, **kwargs)
+
+    async def call_operator(self, name: str, *args, **kwargs):
+        async with self.async_sessionmaker() as db:
+            return await getattr(async_operators, name)(db, *args, **kwargs)
+
+    async def dispose(self):
+        if self._async_engine is not None:
+            await self._async_engine.dispose()
+        if self._async_replicas is not None:
+            for engine in self._async_replicas.engines:
+                await engine.dispose()
@@ -0,0 +1,88 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+json_media_type = "application/json"
+json_wildcards = (json_media_type, "application/*", "*/*")
+
+
+class BinaryFormat:
+    def __init__(
+        self,
+        media_type: str,
+        dumps: Callable[[Any], bytes],
+        loads: Callable[[bytes], Any],
+        aliases: Tuple[str, ...] = (),
+    ):
+        self.media_type = media_type
+        self.dumps = dumps
+        self.loads = loads
+        self.aliases = aliases
+
+
+def msgpack_format() -> BinaryFormat:
+    import msgpack
+
+    return BinaryFormat(
+        "application/msgpack",
+        lambda obj: msgpack.packb(obj, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+        aliases=("application/x-msgpack", "application/vnd.msgpack"),
+    )
+
+
+def cbor_format() -> BinaryFormat:
+    import cbor2
+
+    return BinaryFormat("application/cbor", cbor2.dumps, cbor2.loads)
+
+
+def load_binary_formats() -> Dict[str, BinaryFormat]:
+    formats = {}
+    for factory in (msgpack_format, cbor_format):
+        try:
+            fmt = factory()
+        except ImportError:
+            continue
+        for media_type in (fmt.media_type, *fmt.aliases):
+            formats[media_type] = fmt
+    return formats
+
+
+binary_formats = load_binary_formats()
+
+
+def parse_accept(accept: str) -> List[Tuple[str, float]]:
+    res = []
+    for part in accept.split(","):
+        media_type, *params = [d.strip() for d in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            res.append((media_type.lower(), q))
+    return res
+
+
+def negotiate(accept: Optional[str]) -> Optional[BinaryFormat]:
+    """Returns the binary format the client prefers, or None when JSON should be sent."""
+    if not accept:
+        return None
+    best, best_q = None, 0.0
+    for media_type, q in parse_accept(accept):
+        if media_type in json_wildcards:
+            candidate = None
+        elif media_type in binary_formats:
+            candidate = binary_formats[media_type]
+        else:
+            continue
+        if q > best_q:
+            best, best_q = candidate, q
+    return best
+
+
+def content_format(content_type: Optional[str]) -> Optional[BinaryFormat]:
+    return binary_formats.get((content_type or "").split(";")[0].strip().lower())
@@ -0,0 +1,77 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from .metrics import registry
+
+derivative_renders = registry.counter(
+    "docserver_image_derivatives_rendered_total", "Image derivatives generated from item bodies.", ("format",)
+)
+derivative_seconds = registry.histogram(
+    "docserver_image_derivative_seconds", "Time spent decoding, resizing and encoding derivatives.", ("format",)
+)
+
+source_data_types = ("image/png", "image/jpeg", "image/jpg", "image/gif")
+derivative_formats = {"webp": "image/webp", "png": "image/png", "jpeg": "image/jpeg"}
+
+
+def variant_name(width: int, fmt: str) -> str:
+    return f"w{width}.{fmt}"
+
+
+def render_derivative(body: bytes, width: int, fmt: str) -> bytes:
+    """Downscales body to at most width pixels wide and encodes it as fmt; ValueError if it is not an image."""
+    from PIL import Image
+
+    started = time.monotonic()
+    try:
+        with Image.open(io.BytesIO(body)) as img:
+            # lets the JPEG decoder skip DCT scales we are about to throw away
+            img.draft("RGB", (width, width))
+            if img.mode not in ("RGB", "RGBA", "L"):
+                img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+            if fmt == "jpeg" and img.mode == "RGBA":
+                img = img.convert("RGB")
+            if img.width > width:
+                img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, format=fmt.upper())
+    except (OSError, Image.DecompressionBombError):
+        raise ValueError("item body is not a decodable image")
+    derivative_renders.inc(format=fmt)
+    derivative_seconds.observe(time.monotonic() - started, format=fmt)
+    return out.getvalue()
+
+
+class DerivativeRenderer:
+    """Runs render_derivative on a bounded thread pool; concurrent requests for one variant share a single render."""
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[Hashable, "asyncio.Future[bytes]"] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="derivatives")
+        return self._executor
+
+    async def render(self, key: Hashable, load_body: Callable[[], Awaitable[bytes]], width: int, fmt: str) -> bytes:
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._render(load_body, width, fmt))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _render(self, load_body: Callable[[], Awaitable[bytes]], width: int, fmt: str) -> bytes:
+        body = await load_body()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, render_derivative, body, width, fmt)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
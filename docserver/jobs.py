@@ -0,0 +1,165 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from . import models, operators
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+job_runs = registry.counter("docserver_jobs_total", "Job attempts finished by workers.", ("kind", "status"))
+job_seconds = registry.histogram("docserver_job_seconds", "Time spent running a job attempt.", ("kind",))
+
+handlers: Dict[str, Callable[..., Optional[Dict[str, Any]]]] = {}
+
+
+def handler(kind: str):
+    def register(func):
+        handlers[kind] = func
+        return func
+
+    return register
+
+
+class JobLost(Exception):
+    pass
+
+
+class JobContext:
+    def __init__(self, worker: "Worker", db: Session, job):
+        self.worker = worker
+        self.db = db
+        self.job = job
+        self.owner = models.User(id=job.owner_id)
+
+    def report_progress(self, progress: float):
+        if not operators.report_job_progress(
+            self.db, self.job.id, self.worker.worker_id, min(max(progress, 0.0), 1.0), self.worker.lease
+        ):
+            raise JobLost(self.job.id)
+
+
+@handler("delete_collection")
+def delete_collection(ctx: JobContext, collection_id: str, batch_size: int = 1000):
+    total = operators.count_collection_items(ctx.db, ctx.owner, collection_id)
+    deleted = 0
+    while True:
+        n = operators.delete_collection_items(ctx.db, ctx.owner, collection_id, batch_size)
+        if n == 0:
+            break
+        deleted += n
+        ctx.report_progress(deleted / max(total, deleted, 1))
+    operators.delete_collection(ctx.db, ctx.owner, collection_id)
+    return {"deletedItems": deleted}
+
+
+class Worker:
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        concurrency: int = 1,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 300.0,
+        retry_seconds: float = 10.0,
+        worker_id: Optional[str] = None,
+    ):
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry_delay = timedelta(seconds=retry_seconds)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._last_sweep = 0.0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run_once(self) -> bool:
+        db = self.session_factory()
+        try:
+            job = operators.claim_job(db, self.worker_id, self.lease)
+            if job is None:
+                self._sweep(db)
+                return False
+            self.run_job(db, job)
+            return True
+        finally:
+            db.close()
+
+    def run_job(self, db: Session, job):
+        func = handlers.get(job.kind)
+        started = time.monotonic()
+        try:
+            if func is None:
+                raise LookupError(f"unknown job kind {job.kind!r}")
+            result = func(JobContext(self, db, job), **job.params)
+        except JobLost:
+            db.rollback()
+            logger.warning("job %s (%s) was taken over by another worker", job.id, job.kind)
+            job_runs.inc(kind=job.kind, status="lost")
+        except Exception as e:
+            db.rollback()
+            logger.exception("job %s (%s) failed on attempt %d", job.id, job.kind, job.attempts)
+            res = operators.fail_job(db, job, self.worker_id, f"{type(e).__name__}: {e}", self.retry_delay)
+            job_runs.inc(kind=job.kind, status="retried" if res == "queued" else "failed")
+        else:
+            operators.complete_job(db, job.id, self.worker_id, result)
+            job_runs.inc(kind=job.kind, status="succeeded")
+        finally:
+            job_seconds.observe(time.monotonic() - started, kind=job.kind)
+
+    def _sweep(self, db: Session):
+        now = time.monotonic()
+        if now - self._last_sweep < self.lease.total_seconds():
+            return
+        self._last_sweep = now
+        n = operators.fail_abandoned_jobs(db)
+        if n > 0:
+            logger.warning("marked %d abandoned jobs as failed", n)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.run_once()
+            except Exception:
+                logger.exception("job worker iteration failed")
+                busy = False
+            if not busy:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"docserver-jobs-{i}", daemon=True) for i in range(self.concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def request_stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def stop(self, timeout: Optional[float] = None):
+        self.request_stop()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        finally:
+            self.stop()
@@ -0,0 +1,29 @@
+from typing import Any, Tuple
+
+missing = object()
+
+
+def parse_pointer(pointer: str) -> Tuple[str, ...]:
+    """Splits an RFC 6901 JSON Pointer into unescaped reference tokens."""
+    if pointer == "":
+        return ()
+    if not pointer.startswith("/"):
+        raise ValueError("JSON pointer must be empty or start with '/'")
+    return tuple(d.replace("~1", "/").replace("~0", "~") for d in pointer[1:].split("/"))
+
+
+def resolve(document: Any, path: Tuple[str, ...]) -> Any:
+    """Returns the value at path, or `missing` when the pointer does not reference anything."""
+    value = document
+    for token in path:
+        if isinstance(value, dict):
+            value = value.get(token, missing)
+        elif isinstance(value, list):
+            if not token.isdigit() or (len(token) > 1 and token[0] == "0") or int(token) >= len(value):
+                return missing
+            value = value[int(token)]
+        else:
+            return missing
+        if value is missing:
+            return missing
+    return value
@@ -0,0 +1,254 @@
+import binascii
+import json
+import re
+from base64 import urlsafe_b64encode
+from typing import Any, Dict, List, Optional
+
+from .types import ChunkedBinaryData
+
+base64_alphabet = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+urlsafe_translation = bytes.maketrans(b"-_", b"+/")
+# everything b64decode would discard; removed up front so that streamed groups of four stay aligned
+non_alphabet = bytes(d for d in range(256) if d not in base64_alphabet + b"-_")
+whitespace = b" \t\r\n"
+body_special = re.compile(rb'["\\]')
+value_max_bytes = 64 * 1024
+
+
+class Base64ChunkDecoder:
+    """Decodes base64 text fed in arbitrary pieces straight into chunk-sized buffers."""
+
+    def __init__(self, chunk_size: int):
+        self.chunk_size = chunk_size
+        self.chunks: List[bytearray] = []
+        self._pending = b""
+        self._current = bytearray(chunk_size)
+        self._filled = 0
+        self._size = 0
+
+    def feed(self, text: bytes):
+        text = self._pending + text.translate(urlsafe_translation, non_alphabet)
+        aligned = len(text) - len(text) % 4
+        self._pending = text[aligned:]
+        if aligned > 0:
+            try:
+                self._write(binascii.a2b_base64(text[:aligned]))
+            except binascii.Error:
+                raise ValueError("invalid data")
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while len(view) > 0:
+            n = min(self.chunk_size - self._filled, len(view))
+            self._current[self._filled : self._filled + n] = view[:n]
+            self._filled += n
+            self._size += n
+            view = view[n:]
+            if self._filled == self.chunk_size:
+                self.chunks.append(self._current)
+                self._current = bytearray(self.chunk_size)
+                self._filled = 0
+
+    def close(self) -> ChunkedBinaryData:
+        if len(self._pending) > 0:
+            raise ValueError("invalid data")
+        if self._filled > 0:
+            # truncating in place keeps the last chunk from being copied
+            del self._current[self._filled :]
+            self.chunks.append(self._current)
+        return ChunkedBinaryData(self.chunks, self._size)
+
+
+class Base64ChunkEncoder:
+    """Encodes a body fed one chunk at a time as urlsafe base64, carrying over the bytes that do not fill a group of
+    three."""
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data: bytes) -> bytes:
+        if len(self._pending) > 0:
+            data = self._pending + data
+        view = memoryview(data)
+        aligned = len(view) - len(view) % 3
+        self._pending = bytes(view[aligned:])
+        return urlsafe_b64encode(view[:aligned])
+
+    def close(self) -> bytes:
+        res = urlsafe_b64encode(self._pending)
+        self._pending = b""
+        return res
+
+
+class ItemJsonParser:
+    """Incremental parser for a JSON object whose "body" member is a large base64 string.
+
+    Every other member is small and parsed with json.loads once complete; the body is decoded while it
+    arrives, so neither the request nor the base64 text is ever held in full.
+    """
+
+    def __init__(self, chunk_size: int, body_key: str = "body"):
+        self.chunk_size = chunk_size
+        self.body_key = body_key
+        self.result: Dict[str, Any] = {}
+        self._buffer = bytearray()
+        self._state = "start"
+        self._key: Optional[str] = None
+        self._decoder: Optional[Base64ChunkDecoder] = None
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        pos = 0
+        while pos < len(self._buffer):
+            next_pos = getattr(self, f"_read_{self._state}")(pos)
+            if next_pos is None:
+                break
+            pos = next_pos
+        del self._buffer[:pos]
+        if len(self._buffer) > value_max_bytes:
+            raise ValueError("malformed request body")
+
+    def close(self) -> Dict[str, Any]:
+        if self._state != "done" or len(self._buffer.strip(whitespace)) > 0:
+            raise ValueError("malformed request body")
+        return self.result
+
+    def _skip_whitespace(self, pos: int) -> int:
+        while pos < len(self._buffer) and self._buffer[pos] in whitespace:
+            pos += 1
+        return pos
+
+    def _expect(self, pos: int, tokens: bytes) -> Optional[int]:
+        pos = self._skip_whitespace(pos)
+        if pos == len(self._buffer):
+            return None
+        if self._buffer[pos] not in tokens:
+            raise ValueError("malformed request body")
+        return pos
+
+    def _read_start(self, pos: int) -> Optional[int]:
+        pos = self._expect(pos, b"{")
+        if pos is None:
+            return None
+        self._state = "first_key"
+        return pos + 1
+
+    def _read_first_key(self, pos: int) -> Optional[int]:
+        pos = self._expect(pos, b'"}')
+        if pos is None:
+            return None
+        if self._buffer[pos] == ord("}"):
+            self._state = "done"
+            return pos + 1
+        self._state = "key"
+        return pos
+
+    def _read_key(self, pos: int) -> Optional[int]:
+        pos = self._expect(pos, b'"')
+        if pos is None:
+            return None
+        end = self._string_end(pos)
+        if end is None:
+            return None
+        self._key = json.loads(self._buffer[pos:end])
+        self._state = "colon"
+        return end
+
+    def _read_colon(self, pos: int) -> Optional[int]:
+        pos = self._expect(pos, b":")
+        if pos is None:
+            return None
+        self._state = "value"
+        return pos + 1
+
+    def _read_value(self, pos: int) -> Optional[int]:
+        pos = self._skip_whitespace(pos)
+        if pos == len(self._buffer):
+            return None
+        if self._key == self.body_key and self._buffer[pos] == ord('"'):
+            self._decoder = Base64ChunkDecoder(self.chunk_size)
+            self._state = "body"
+            return pos + 1
+        end = self._value_end(pos)
+        if end is None:
+            return None
+        try:
+            self.result[self._key] = json.loads(self._buffer[pos:end])
+        except ValueError:
+            raise ValueError("malformed request body")
+        self._state = "separator"
+        return end
+
+    def _read_body(self, pos: int) -> Optional[int]:
+        match = body_special.search(self._buffer, pos)
+        if match is None:
+            self._decoder.feed(bytes(self._buffer[pos:]))
+            return len(self._buffer)
+        special = match.start()
+        self._decoder.feed(bytes(self._buffer[pos:special]))
+        if self._buffer[special] == ord('"'):
+            self.result[self._key] = self._decoder.close()
+            self._decoder = None
+            self._state = "separator"
+            return special + 1
+        if special + 1 == len(self._buffer):
+            return None if special == pos else special
+        escaped = self._buffer[special + 1]
+        if escaped == ord("/"):
+            self._decoder.feed(b"/")
+        elif escaped not in b"nrt":
+            raise ValueError("invalid data")
+        return special + 2
+
+    def _read_separator(self, pos: int) -> Optional[int]:
+        pos = self._expect(pos, b",}")
+        if pos is None:
+            return None
+        self._state = "key" if self._buffer[pos] == ord(",") else "done"
+        return pos + 1
+
+    def _read_done(self, pos: int) -> Optional[int]:
+        pos = self._skip_whitespace(pos)
+        if pos < len(self._buffer):
+            raise ValueError("malformed request body")
+        return pos
+
+    def _string_end(self, pos: int) -> Optional[int]:
+        """Position just past the string starting at pos, or None when it is not complete yet."""
+        i = pos + 1
+        while i < len(self._buffer):
+            c = self._buffer[i]
+            if c == ord("\\"):
+                i += 2
+                continue
+            if c == ord('"'):
+                return i + 1
+            i += 1
+        return None
+
+    def _value_end(self, pos: int) -> Optional[int]:
+        """Position just past the JSON value starting at pos, found by bracket depth outside of strings."""
+        depth = 0
+        i = pos
+        while i < len(self._buffer):
+            c = self._buffer[i]
+            if c == ord('"'):
+                end = self._string_end(i)
+                if end is None:
+                    return None
+                i = end
+                if depth == 0:
+                    return i
+                continue
+            if c in b"[{":
+                depth += 1
+            elif c in b"]}":
+                if depth == 0:
+                    return i
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            elif depth == 0 and (c == ord(",") or c in whitespace):
+                return i
+            i += 1
+        return None
@@ -0,0 +1,246 @@
+import hmac
+import logging
+import threading
+import time
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import compression, profiling
+from .metrics import Registry, registry
+from .querystats import RequestStats, request_stats
+
+logger = logging.getLogger(__name__)
+
+size_buckets = (64.0, 256.0, 1024.0, 4096.0, 16384.0, 65536.0, 262144.0, 1048576.0, 4194304.0, 16777216.0)
+query_count_buckets = (0.0, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 21.0, 34.0, 55.0)
+
+
+def route_label(scope: Scope) -> str:
+    return getattr(scope.get("route"), "path", "unmatched")
+
+
+def body_size(message: Message) -> int:
+    """Length of an ASGI message body; 0 when the body is missing or not bytes-like."""
+    body = message.get("body")
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return len(body)
+    return 0
+
+
+class QueryStatsMiddleware:
+    def __init__(self, app: ASGIApp, server_timing: bool = True, repeated_query_threshold: int = 0):
+        self.app = app
+        self.server_timing = server_timing
+        self.repeated_query_threshold = repeated_query_threshold
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = {"code": 500}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if self.server_timing:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", stats.server_timing(time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+            self.log(scope, status["code"], stats, time.perf_counter() - started)
+
+    def log(self, scope: Scope, status: int, stats: RequestStats, duration: float):
+        route = route_label(scope)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "%s %s %d queries=%d db_ms=%.1f rows=%d",
+                scope["method"],
+                route,
+                status,
+                stats.queries,
+                stats.query_seconds * 1000,
+                stats.rows,
+                extra={
+                    "method": scope["method"],
+                    "route": route,
+                    "status": status,
+                    "queries": stats.queries,
+                    "db_ms": stats.query_seconds * 1000,
+                    "rows": stats.rows,
+                    "duration_ms": duration * 1000,
+                },
+            )
+        if self.repeated_query_threshold > 0:
+            for statement, count in stats.repeated_statements(self.repeated_query_threshold):
+                logger.warning(
+                    "possible N+1 query on %s %s: statement ran %d times: %s",
+                    scope["method"],
+                    route,
+                    count,
+                    statement,
+                    extra={"method": scope["method"], "route": route, "count": count, "statement": statement},
+                )
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp, registry: Registry = registry):
+        self.app = app
+        self.request_seconds = registry.histogram(
+            "docserver_http_request_seconds", "Request latency by route.", ("method", "route", "status")
+        )
+        self.request_bytes = registry.histogram(
+            "docserver_http_request_bytes", "Request body size by route.", ("method", "route"), size_buckets
+        )
+        self.response_bytes = registry.histogram(
+            "docserver_http_response_bytes", "Response body size by route.", ("method", "route"), size_buckets
+        )
+        self.request_queries = registry.histogram(
+            "docserver_http_request_db_queries",
+            "SQL statements executed per request.",
+            ("method", "route"),
+            query_count_buckets,
+        )
+        self.request_query_seconds = registry.histogram(
+            "docserver_http_request_db_seconds", "Time spent in SQL per request.", ("method", "route")
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        sizes = {"request": 0, "response": 0}
+        status = {"code": 500}
+
+        async def receive_wrapper() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["request"] += body_size(message)
+            return message
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes["response"] += body_size(message)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            labels = {"method": scope["method"], "route": route_label(scope)}
+            self.request_seconds.observe(time.perf_counter() - started, status=str(status["code"]), **labels)
+            self.request_bytes.observe(sizes["request"], **labels)
+            self.response_bytes.observe(sizes["response"], **labels)
+            stats = request_stats.get()
+            if stats is not None:
+                self.request_queries.observe(stats.queries, **labels)
+                self.request_query_seconds.observe(stats.query_seconds, **labels)
+
+
+class CompressionMiddleware:
+    """Compresses complete responses per Accept-Encoding; streamed bodies and routes that encode their own pass."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    def should_compress(self, scope: Scope, headers: MutableHeaders, body: bytes) -> bool:
+        return (
+            len(body) >= self.minimum_size
+            and "content-encoding" not in headers
+            and not scope.get("state", {}).get("encoded", False)
+            and compression.is_compressible(headers.get("content-type"))
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = compression.negotiate(Headers(scope=scope).get("Accept-Encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        pending = {}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                # held back until the first body message shows whether the body is complete
+                pending["start"] = message
+                return
+            if message["type"] != "http.response.body" or "start" not in pending:
+                await send(message)
+                return
+            start = pending.pop("start")
+            headers = MutableHeaders(scope=start)
+            body = message.get("body", b"")
+            if not message.get("more_body", False) and self.should_compress(scope, headers, body):
+                compressed = await compression.compress(encoding, body)
+                if len(compressed) < len(body):
+                    headers["Content-Encoding"] = encoding.name
+                    headers["Content-Length"] = str(len(compressed))
+                    message = {"type": "http.response.body", "body": compressed}
+                headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        token: str,
+        output_dir: str,
+        header: str = "X-Docserver-Profile",
+        interval: float = 0.005,
+    ):
+        self.app = app
+        self.token = token
+        self.output_dir = output_dir
+        self.header = header
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    def is_authorized(self, scope: Scope) -> bool:
+        value: Optional[str] = Headers(scope=scope).get(self.header)
+        return value is not None and hmac.compare_digest(value.encode("utf-8"), self.token.encode("utf-8"))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.is_authorized(scope):
+            await self.app(scope, receive, send)
+            return
+        if not self._lock.acquire(blocking=False):
+            logger.warning("profiling skipped for %s %s: another profile is running", scope["method"], scope["path"])
+            await self.app(scope, receive, send)
+            return
+        profiler = profiling.SamplingProfiler(self.interval)
+        filename = {}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                filename["value"] = profiling.profile_filename(
+                    route_label(scope), scope.get("state", {}).get("user_id")
+                )
+                MutableHeaders(scope=message).append(f"{self.header}-Id", filename["value"])
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            samples = profiler.stop()
+            self._lock.release()
+            if "value" in filename:
+                await run_in_threadpool(profiling.store_profile, self.output_dir, filename["value"], samples)
@@ -1,30 +1,48 @@
-import math
-
 from sqlalchemy import (
+    JSON,
+    BigInteger,
     Boolean,
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Index,
     Integer,
     LargeBinary,
     String,
+    Text,
+    event,
+    func,
+    select,
 )
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm import backref, column_property, deferred, relationship
+from sqlalchemy.schema import DDL
 
-from .utils import format_cursor_value, gen_datetime, gen_uuid, suuid_generator
+from .types import ChunkedBinaryData
+from .utils import calc_chunk_digest, format_cursor_value, gen_datetime, gen_uuid, suuid_generator
 
 id_type = String(suuid_generator.encoded_length())
 
 chunk_size = 1024 * 1024 * 16
 
+document_type = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql")
+search_vector_type = Text().with_variant(TSVECTOR(), "postgresql")
+
 
 def id_column_type():
     return Column(id_type, primary_key=True, default=gen_uuid)
 
 
+def split_into_chunks(value: bytes):
+    if isinstance(value, ChunkedBinaryData):
+        return value.chunks
+    view = memoryview(value)
+    return [view[i : i + chunk_size] for i in range(0, len(view), chunk_size)]
+
+
 class CursorValueFormatter:
     def __init__(self, target: str):
         self._target = target
@@ -56,12 +74,30 @@ class RefreshToken(Base):
     __tablename__ = "refresh_tokens"
 
     id = id_column_type()
-    user_id = Column(id_type, ForeignKey(User.id, ondelete="CASCADE"))
-    token = Column(String, nullable=False, unique=True)
+    user_id = Column(id_type, ForeignKey(User.id, ondelete="CASCADE"), nullable=False)
+    family_id = Column(id_type, nullable=False, index=True)
+    digest = Column(String(32), nullable=False, unique=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    rotated_at = Column(DateTime)
+    created_at = Column(DateTime, nullable=False, default=gen_datetime)
+    updated_at = Column(DateTime, nullable=False, default=gen_datetime, onupdate=gen_datetime)
+
+    user = relationship("User", backref=backref("refresh_tokens"))
+
+
+class ApiKey(Base):
+    __tablename__ = "api_keys"
+
+    id = id_column_type()
+    user_id = Column(id_type, ForeignKey(User.id, ondelete="CASCADE"), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    prefix = Column(String(12), nullable=False, unique=True)
+    digest = Column(String(64), nullable=False)
+    expires_at = Column(DateTime)
     created_at = Column(DateTime, nullable=False, default=gen_datetime)
     updated_at = Column(DateTime, nullable=False, default=gen_datetime, onupdate=gen_datetime)
 
-    user = relationship("User", backref=backref("token", uselist=False))
+    user = relationship("User", backref=backref("api_keys"))
 
 
 class Collection(Base):
@@ -101,6 +137,8 @@ class Item(Base):
         unique=True,
         nullable=False,
     )
+    document = deferred(Column(document_type))
+    search_vector = deferred(Column(search_vector_type))
 
     chunks = relationship(
         "Chunk", cascade="all, delete", order_by="Chunk.index", backref='item', lazy=True, uselist=True
@@ -112,20 +150,133 @@ class Item(Base):
 
     @body.setter
     def body(self, value: bytes):
-        self.chunks = [
-            Chunk(item=self, index=i, body=value[(i * chunk_size) : min(len(value), (i + 1) * chunk_size)])
-            for i in range(math.ceil(len(value) / chunk_size))
-        ]
+        self.chunks = [Chunk(item=self, index=i, stored_body=d) for i, d in enumerate(split_into_chunks(value))]
         if self.updated_at is not None:
             self.updated_at = gen_datetime()
 
 
+event.listen(
+    Item.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_items_document ON items USING gin (document jsonb_path_ops)").execute_if(dialect="postgresql"),
+)
+event.listen(
+    Item.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_items_search_vector ON items USING gin (search_vector)").execute_if(dialect="postgresql"),
+)
+
+
+class ItemTerm(Base):
+    """Inverted index of item text for databases without full-text search; PostgreSQL uses Item.search_vector."""
+
+    __tablename__ = "item_terms"
+
+    item_id = Column(id_type, ForeignKey(Item.id, ondelete="CASCADE"), primary_key=True)
+    term = Column(String(64), primary_key=True)
+    owner_id = Column(id_type, nullable=False)
+    collection_id = Column(id_type, nullable=False)
+    weight = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_item_terms_owner_id_term", "owner_id", "term", "collection_id"),)
+
+
+class ItemDerivative(Base):
+    __tablename__ = "item_derivatives"
+
+    id = id_column_type()
+    item_id = Column(id_type, ForeignKey(Item.id, ondelete="CASCADE"), nullable=False)
+    variant = Column(String, nullable=False)
+    media_type = Column(String, nullable=False)
+    source_updated_at = Column(DateTime, nullable=False)
+    body = deferred(Column(LargeBinary, nullable=False))
+    created_at = Column(DateTime, nullable=False, default=gen_datetime)
+
+    __table_args__ = (Index("uk_item_derivative_item_id_variant", "item_id", "variant", unique=True),)
+
+
+def chunk_digest_default(context):
+    return calc_chunk_digest(context.get_current_parameters()["body"])
+
+
+class ChunkData(Base):
+    """Chunk bodies that no chunk stores any more but that copies or previous versions still reference by digest."""
+
+    __tablename__ = "chunk_data"
+
+    digest = Column(String(64), primary_key=True)
+    body = Column(LargeBinary, nullable=False)
+
+
 class Chunk(Base):
     __tablename__ = "chunks"
 
     id = id_column_type()
     item_id = Column(id_type, ForeignKey(Item.id, ondelete="CASCADE"))
     index = Column(Integer)
-    body = Column(LargeBinary)
+    # NULL for copies, which find the body by digest in chunk_data or in any chunk that stores it
+    stored_body = Column("body", LargeBinary)
+    digest = Column(String(64), nullable=False, default=chunk_digest_default)
+
+    __table_args__ = (
+        Index("uk_chunk_item_id_index", "item_id", "index", unique=True),
+        Index("ix_chunks_digest", "digest"),
+    )
+
+
+chunk_holders = Chunk.__table__.alias("chunk_holders")
+
+Chunk.body = column_property(
+    func.coalesce(
+        Chunk.stored_body,
+        select(ChunkData.body).where(ChunkData.digest == Chunk.digest).scalar_subquery(),
+        select(chunk_holders.c.body)
+        .where(chunk_holders.c.digest == Chunk.digest, chunk_holders.c.body.isnot(None))
+        .limit(1)
+        .scalar_subquery(),
+    )
+)
+
+
+class ItemVersion(Base):
+    __tablename__ = "item_versions"
+
+    id = id_column_type()
+    item_id = Column(id_type, ForeignKey(Item.id, ondelete="CASCADE"), nullable=False)
+    version = Column(Integer, nullable=False)
+    data_type = Column(String)
+    size = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=gen_datetime)
+
+    __table_args__ = (Index("uk_item_version_item_id_version", "item_id", "version", unique=True),)
+
+
+class ItemVersionChunk(Base):
+    __tablename__ = "item_version_chunks"
+
+    version_id = Column(id_type, ForeignKey(ItemVersion.id, ondelete="CASCADE"), primary_key=True)
+    index = Column(Integer, primary_key=True)
+    digest = Column(String(64), nullable=False, index=True)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = id_column_type()
+    owner_id = Column(id_type, ForeignKey(User.id, ondelete="CASCADE"), index=True)
+    kind = Column(String, nullable=False)
+    params = Column(JSON, nullable=False, default=dict)
+    status = Column(String(16), nullable=False, default="queued")
+    progress = Column(Float, nullable=False, default=0.0)
+    result = Column(JSON)
+    error = Column(String)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime, nullable=False, default=gen_datetime)
+    locked_by = Column(String)
+    locked_until = Column(DateTime)
+    created_at = Column(DateTime, nullable=False, default=gen_datetime)
+    updated_at = Column(DateTime, nullable=False, default=gen_datetime, onupdate=gen_datetime)
 
-    __table_args__ = (Index("uk_chunk_item_id_index", "item_id", "index", unique=True),)
+    __table_args__ = (Index("ix_jobs_status_run_after", "status", "run_after"),)
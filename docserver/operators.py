@@ -1,69 +1,165 @@
+import hmac
+import json
 import re
 from collections.abc import Mapping
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError
-from sqlalchemy.orm import Session
-from sqlalchemy.sql.expression import or_
+from sqlalchemy import (
+    DateTime,
+    String,
+    and_,
+    case,
+    cast,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    literal_column,
+    null,
+    or_,
+    select,
+    text,
+    type_coerce,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION, JSONB
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from . import models, schema, types
+from . import archives, jsonpointer, jsonstream, models, schema, search, sqlite, types, utils
+from .metrics import registry
+
+user_columns = (
+    models.User.id,
+    models.User.username,
+    models.User.email,
+    models.User.created_at,
+    models.User.updated_at,
+)
+
+api_key_columns = (
+    models.ApiKey.id,
+    models.ApiKey.name,
+    models.ApiKey.prefix,
+    models.ApiKey.expires_at,
+    models.ApiKey.created_at,
+)
+
+collection_columns = (
+    models.Collection.id,
+    models.Collection.owner_id,
+    models.Collection.name,
+    models.Collection.created_at,
+    models.Collection.updated_at,
+    models.Collection.cursor_value,
+)
+
+item_header_columns = (
+    models.Item.id,
+    models.Item.owner_id,
+    models.Item.collection_id,
+    models.Item.data_type,
+    models.Item.created_at,
+    models.Item.updated_at,
+    models.Item.cursor_value,
+)
+
+job_columns = (
+    models.Job.id,
+    models.Job.owner_id,
+    models.Job.kind,
+    models.Job.params,
+    models.Job.status,
+    models.Job.progress,
+    models.Job.result,
+    models.Job.error,
+    models.Job.attempts,
+    models.Job.max_attempts,
+    models.Job.created_at,
+    models.Job.updated_at,
+)
+
+access_token_decode_seconds = registry.histogram(
+    "docserver_access_token_decode_seconds", "Time spent decoding and verifying access tokens."
+)
+chunk_bytes_written = registry.counter("docserver_chunk_bytes_written_total", "Item body bytes written to chunks.")
+chunk_bytes_read = registry.counter("docserver_chunk_bytes_read_total", "Item body bytes read from chunks.")
+
+json_data_type = "application/json"
+json_document_max_bytes = 16 * 1024 * 1024
+postgresql_text_array = ARRAY(String())
+
+
+class ItemDocument(NamedTuple):
+    updated_at: datetime
+    value: Any
+
+
+def parse_json_document(data_type: Optional[str], body: Optional[bytes]) -> Any:
+    """Parsed body of JSON items, stored alongside the chunks; None for other types or oversized bodies."""
+    if data_type not in (None, json_data_type) or body is None or len(body) > json_document_max_bytes:
+        return None
+    try:
+        return json.loads(body_head(body))
+    except ValueError:
+        return None
+
+
+def body_head(body):
+    """A body as contiguous bytes; streamed bodies are joined only up to the size of a JSON document."""
+    if isinstance(body, types.ChunkedBinaryData):
+        return body.prefix(json_document_max_bytes)
+    return body
+
+
+def extract_body_text(data_type: Optional[str], body) -> Optional[str]:
+    if body is None or not search.is_searchable(data_type):
+        return None
+    return search.extract_text(data_type, body_head(body))
 
 
 def create_user(db: Session, query: schema.UserCreateQuery) -> schema.UserRetrieveResponse:
-    if db.query(
-        db.query(models.User)
-        .filter(or_(models.User.username == query.username, models.User.email == query.email))
-        .exists()
-    ).scalar():
+    try:
+        user = execute_returning(db, create_user_statement(query, query.password.get_hashed_value())).one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
         raise ValueError("username and/or email already exists.")
-    user = models.User(username=query.username, hashed_password=query.password.get_hashed_value(), email=query.email)
-    db.add(user)
-    db.commit()
-    db.refresh(user)
     return schema.UserRetrieveResponse.from_orm(user)
 
 
 def authenticate_user(db: Session, query: schema.UserLoginQuery) -> Union[models.User, None]:
-    if query.is_username():
-        user = db.query(models.User).filter(models.User.username == query.login_id).first()
-    else:
-        user = db.query(models.User).filter(models.User.email == query.login_id).first()
+    user = db.execute(find_user_statement(query)).scalar()
     if user is None:
         return None
     if query.password.verify_with_hashed_value(user.hashed_password):
-        return schema.UserRetrieveResponse(
-            id=user.id, username=user.username, email=user.email, created_at=user.created_at, updated_at=user.updated_at
-        )
+        return schema.UserRetrieveResponse.from_orm(user)
     return None
 
 
-def get_user_by_refresh_token(
-    db: Session, refresh_token: str, secret_key: str, algorithm: str
+def get_user_by_access_token(
+    db: Session, access_token: str, secret_key: str, algorithm: str
 ) -> Union[models.User, None]:
-    refresh_token_record = db.query(models.RefreshToken).filter(models.RefreshToken.token == refresh_token).first()
-    if refresh_token_record is None:
-        return None
-    try:
-        payload = jwt.decode(refresh_token, key=secret_key, algorithms=[algorithm])
-        uid_in_payload = re.sub("^userId:", "", payload.get("sub"))
-        if refresh_token_record.user_id != uid_in_payload:
-            return None
-    except ExpiredSignatureError:
+    uid_in_payload = decode_access_token(access_token, secret_key, algorithm)
+    if uid_in_payload is None:
         return None
-    return db.query(models.User).get(refresh_token_record.user_id)
+    return db.get(models.User, uid_in_payload)
 
 
-def get_user_by_access_token(
-    db: Session, access_token: str, secret_key: str, algorithm: str
-) -> Union[models.User, None]:
+def decode_access_token(access_token: str, secret_key: str, algorithm: str) -> Union[str, None]:
     try:
-        payload = jwt.decode(access_token, key=secret_key, algorithms=[algorithm])
-        uid_in_payload = re.sub("^userId:", "", payload.get("sub"))
+        with access_token_decode_seconds.time():
+            payload = jwt.decode(access_token, key=secret_key, algorithms=[algorithm])
     except ExpiredSignatureError:
         return None
-    return db.query(models.User).get(uid_in_payload)
+    return re.sub("^userId:", "", payload.get("sub"))
 
 
 def create_access_token(data: Mapping[str, str], expires_delta: timedelta, secret_key: str, algorithm: str) -> str:
@@ -74,136 +170,141 @@ def create_access_token(data: Mapping[str, str], expires_delta: timedelta, secre
     return encoded_jwt
 
 
-def get_or_create_refresh_token(
-    db: Session, user_id: schema.ShortUUID, expires_delta: timedelta, secret_key: str, algorithm: str
+def create_refresh_token(
+    db: Session, user_id: schema.ShortUUID, expires_delta: timedelta, family_id: Optional[schema.ShortUUID] = None
 ) -> str:
-    refresh_token_record = db.query(models.RefreshToken).filter_by(user_id=user_id).one_or_none()
-    if refresh_token_record is not None:
-        try:
-            payload = jwt.decode(refresh_token_record.token, key=secret_key, algorithms=[algorithm])
-            uid_in_payload = re.sub("^userId:", "", payload.get("sub"))
-            assert user_id == uid_in_payload
-            return refresh_token_record.token
-        except ExpiredSignatureError:
-            pass
-    encoded_jwt = create_access_token(
-        {"sub": f"userId:{user_id}"}, expires_delta=expires_delta, secret_key=secret_key, algorithm=algorithm
-    )
-    if refresh_token_record is None:
-        refresh_token_record = models.RefreshToken(user_id=user_id, token=encoded_jwt)
-        db.add(refresh_token_record)
-    else:
-        refresh_token_record.token = encoded_jwt
+    token = utils.gen_refresh_token()
+    db.execute(create_refresh_token_statement(token, user_id, expires_delta, family_id))
     db.commit()
-    db.refresh(refresh_token_record)
-    return refresh_token_record.token
+    return token
+
+
+def rotate_refresh_token(
+    db: Session, refresh_token: str, expires_delta: timedelta
+) -> Union[Tuple[schema.ShortUUID, str], None]:
+    digest = utils.calc_token_digest(refresh_token)
+    record = execute_returning(db, consume_refresh_token_statement(digest)).first()
+    if record is None:
+        revoke_reused_refresh_token(db, digest)
+        return None
+    return record.user_id, create_refresh_token(db, record.user_id, expires_delta, family_id=record.family_id)
 
 
-def create_collection(db: Session, data: schema.CollectionCreateQuery, user: models.User) -> models.Collection:
-    collection = models.Collection(name=data.name, owner_id=user.id)
-    db.add(collection)
+def revoke_reused_refresh_token(db: Session, digest: str) -> int:
+    family_id = db.execute(find_rotated_refresh_token_family_statement(digest)).scalar()
+    if family_id is None:
+        return 0
+    res = db.execute(delete_refresh_token_family_statement(family_id)).rowcount
     db.commit()
-    db.refresh(collection)
-    return collection
+    return res
 
 
-def list_collections(db: Session, user: models.User, cursor: Optional[types.EncodedCursor] = None, page_size: int = 10):
-    q = db.query(models.Collection).filter(models.Collection.owner_id == user.id)
-    if cursor is not None:
-        decoded_cursor = cursor.decode_cursor()
-        if decoded_cursor.direction == "n":
-            res = list(
-                q.filter(models.Collection.cursor_value <= decoded_cursor.cursor_value)
-                .order_by(models.Collection.cursor_value.desc())
-                .limit(page_size)
-            )
-        elif decoded_cursor.direction == "p":
-            res = sorted(
-                q.filter(models.Collection.cursor_value >= decoded_cursor.cursor_value)
-                .order_by(models.Collection.cursor_value)
-                .limit(page_size),
-                key=lambda d: d.cursor_value,
-                reverse=True,
-            )
-        else:
-            raise ValueError("invalid direction")
-    else:
-        res = list(q.order_by(models.Collection.cursor_value.desc()).limit(page_size))
+def delete_expired_refresh_tokens(db: Session, now: Optional[datetime] = None) -> int:
+    res = db.execute(delete_expired_refresh_tokens_statement(now or utils.gen_datetime())).rowcount
+    db.commit()
+    return res
 
-    if len(res) == 0:
-        b0 = None
-        b1 = None
-    else:
-        b0 = (
-            q.filter(models.Collection.cursor_value < res[-1].cursor_value)
-            .order_by(models.Collection.cursor_value.desc())
-            .first()
-        )
-        b1 = (
-            q.filter(models.Collection.cursor_value > res[0].cursor_value)
-            .order_by(models.Collection.cursor_value)
-            .first()
-        )
-    res = {
-        "meta": {
-            "count": q.count(),
-            "next_cursor": types.DecodedCursor("n", b0.cursor_value) if b0 is not None else None,
-            "prev_cursor": types.DecodedCursor("p", b1.cursor_value) if b1 is not None else None,
-        },
-        "results": list(res),
-    }
+
+def create_api_key(
+    db: Session, user: models.User, data: schema.ApiKeyCreateQuery, secret_key: str
+) -> schema.ApiKeyCreateResponse:
+    api_key = utils.gen_api_key()
+    record = execute_returning(db, create_api_key_statement(user, data, api_key, secret_key)).one()
+    db.commit()
+    return schema.ApiKeyCreateResponse(api_key=api_key, **record._mapping)
+
+
+def list_api_keys(db: Session, user: models.User):
+    return db.execute(list_api_keys_statement(user)).all()
+
+
+def delete_api_key(db: Session, user: models.User, api_key_id: schema.ShortUUID) -> Union[str, None]:
+    res = execute_returning(db, delete_api_key_statement(user, api_key_id)).scalar()
+    db.commit()
     return res
 
 
+def authenticate_api_key(db: Session, api_key: str, digest: str):
+    prefix = utils.parse_api_key_prefix(api_key)
+    if prefix is None:
+        return None
+    return verify_api_key_record(db.execute(find_api_key_statement(prefix)).first(), digest)
+
+
+def verify_api_key_record(record, digest: str):
+    if record is None or not hmac.compare_digest(record.digest, digest):
+        return None
+    if record.expires_at is not None and record.expires_at <= utils.gen_datetime():
+        return None
+    return record
+
+
+def create_collection(db: Session, data: schema.CollectionCreateQuery, user: models.User):
+    collection = execute_returning(db, create_collection_statement(data, user)).one()
+    db.commit()
+    return collection
+
+
+def list_collections(db: Session, user: models.User, cursor: Optional[types.EncodedCursor] = None, page_size: int = 10):
+    conditions = (models.Collection.owner_id == user.id,)
+    res = db.execute(page_statement(models.Collection, conditions, cursor, page_size)).scalars().all()
+    b0, b1 = None, None
+    if len(res) > 0:
+        res = sort_page(res)
+        b0, b1 = (db.execute(d).scalar() for d in neighbor_statements(models.Collection, conditions, res))
+    return page_response(res, db.execute(count_statement(models.Collection, conditions)).scalar(), b0, b1)
+
+
 def retrieve_collection(db: Session, user: models.User, collection_id: schema.ShortUUID):
-    return (
-        db.query(models.Collection)
-        .filter(models.Collection.owner_id == user.id, models.Collection.id == collection_id)
-        .first()
-    )
+    return db.execute(retrieve_collection_statement(user, collection_id)).scalar()
 
 
 def update_collection(
     db: Session, user: models.User, collection_id: schema.ShortUUID, data: schema.CollectionUpdateQuery
 ):
-    collection = retrieve_collection(db, user, collection_id)
-    if collection is None:
-        return None
-    collection.name = data.name
-    db.add(collection)
+    collection = execute_returning(db, update_collection_statement(user, collection_id, data)).first()
     db.commit()
-    db.refresh(collection)
     return collection
 
 
 def delete_collection(db: Session, user: models.User, collection_id: schema.ShortUUID):
-    collection = retrieve_collection(db, user, collection_id)
-    if collection is None:
-        return None
-    res = collection.id
-    db.delete(collection)
+    keep_referenced_chunk_bodies(db, collection_items_statement(user, collection_id))
+    res = execute_returning(db, delete_collection_statement(user, collection_id)).scalar()
+    forget_deleted(db, models.Collection, res)
     db.commit()
     return res
 
 
 def create_item(db: Session, user: models.User, collection_id: schema.ShortUUID, data: schema.ItemCreateQuery):
-    collection = retrieve_collection(db, user, collection_id)
-    if collection is None:
+    body = data.body.decode_to_binary()
+    document = parse_json_document(data.data_type, body)
+    search_text = extract_body_text(data.data_type, body)
+    full_text = is_full_text_session(db)
+    item = execute_returning(
+        db, create_item_statement(user, collection_id, data, document, search_text if full_text else None)
+    ).first()
+    if item is None:
         return None
-    item = models.Item(collection_id=collection.id, owner_id=user.id, data_type=data.data_type)
-    item.body = data.body.decode_to_binary()
-    db.add(item)
+    insert_chunks(db, item.id, body)
+    if not full_text:
+        insert_item_terms(db, item, search_text)
     db.commit()
-    db.refresh(item)
     return item
 
 
 def retrieve_item(db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
-    return (
-        db.query(models.Item)
-        .filter(models.Item.collection_id == collection_id, models.Item.id == item_id, models.Item.owner_id == user.id)
-        .first()
-    )
+    if sqlite.is_sqlite_session(db):
+        item = retrieve_item_header(db, user, collection_id, item_id)
+        if item is None:
+            return None
+        body = sqlite.read_chunks(db, item.id)
+        chunk_bytes_read.inc(len(body))
+        return schema.ItemDetailResponse(body=body, **item._mapping)
+    return count_chunk_bytes_read(db.execute(retrieve_item_statement(user, collection_id, item_id)).scalar())
+
+
+def retrieve_item_header(db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return db.execute(retrieve_item_header_statement(user, collection_id, item_id)).first()
 
 
 def update_item(
@@ -213,78 +314,1380 @@ def update_item(
     item_id: schema.ShortUUID,
     data: schema.ItemUpdateQuery,
 ):
-    item = retrieve_item(db, user, collection_id, item_id)
-    if item is None:
+    body = data.body.decode_to_binary() if data.body is not None else None
+    if data.data_type is None and body is None:
+        return retrieve_item_header(db, user, collection_id, item_id)
+    live = db.execute(lock_item_chunks_statement(user, collection_id, item_id)).all()
+    if len(live) == 0:
+        db.rollback()
         return None
-    mutated = False
-    if data.data_type is not None:
-        item.data_type = data.data_type
-        mutated = True
-    if data.body is not None:
-        item.body = data.body.decode_to_binary()
-        mutated = True
-    if mutated:
-        db.add(item)
-        db.commit()
-        db.refresh(item)
+    archive_item_version(db, live)
+    document = parse_json_document(data.data_type, body)
+    item = execute_returning(db, update_item_statement(user, collection_id, item_id, data, document)).first()
+    if body is not None:
+        replace_chunks(db, item.id, body, live_chunk_digests(live))
+    elif search.is_searchable(data.data_type):
+        body = db.execute(retrieve_item_statement(user, collection_id, item_id)).scalar().body
+        if data.data_type == json_data_type:
+            db.execute(update_item_document_statement(item.id, parse_json_document(json_data_type, body)))
+    search_text = extract_body_text(item.data_type, body)
+    if search_text is not None or data.data_type is not None:
+        index_item_text(db, item, search_text)
+    db.execute(delete_item_derivatives_statement(item.id))
+    db.commit()
     return item
 
 
-def delete_item(db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
-    item = retrieve_item(db, user, collection_id, item_id)
-    if item is None:
+def archive_item_version(db: Session, live):
+    """Records the locked, still current revision as a version that references its chunks by digest."""
+    version_id = utils.gen_uuid()
+    db.execute(create_item_version_statement(version_id, live))
+    refs = item_version_chunk_rows(version_id, live)
+    if len(refs) > 0:
+        db.execute(insert(models.ItemVersionChunk), refs)
+
+
+def replace_chunks(db: Session, item_id: schema.ShortUUID, body: bytes, live: Dict[int, str]):
+    """Writes only the chunks whose digest changed; replaced bodies move to chunk_data for older versions."""
+    changed, stale = diff_chunks(item_id, body, live)
+    if len(stale) > 0:
+        archived = [models.Chunk.item_id == item_id, models.Chunk.index.in_(archived_chunk_indexes(live, stale))]
+        db.execute(share_chunk_bodies_statement(archived))
+        db.execute(delete_chunks_statement(item_id, stale))
+    insert_chunk_rows(db, changed)
+
+
+def list_item_versions(db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    if retrieve_item_header(db, user, collection_id, item_id) is None:
         return None
-    res = item.id
-    db.delete(item)
+    return db.execute(list_item_versions_statement(item_id)).all()
+
+
+def retrieve_item_version_header(
+    db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, version: int
+):
+    return db.execute(retrieve_item_version_statement(user, collection_id, item_id, version)).first()
+
+
+def stream_item_version(db: Session, header) -> Iterator[bytes]:
+    """Yields the JSON response of a version, reading and base64-encoding its body one chunk at a time."""
+    use_snapshot(db)
+    yield item_version_document_head(header)
+    encoder = jsonstream.Base64ChunkEncoder()
+    for ref in db.execute(item_version_chunks_statement(header.id)).all():
+        body = db.execute(version_chunk_bodies_statement(ref.digest)).first().body
+        chunk_bytes_read.inc(len(body))
+        yield encoder.feed(body)
+    yield encoder.close() + b'"}'
+
+
+def item_version_document_head(header) -> bytes:
+    """The version's JSON response up to the opening quote of its body."""
+    document = schema.ItemVersionResponse.from_orm(header).json(by_alias=True, separators=(",", ":"))
+    return f'{document[:-1]},"body":"'.encode("utf-8")
+
+
+def prune_item_versions(db: Session, keep: int, before: Optional[datetime], batch_size: int) -> int:
+    """Deletes up to batch_size expired versions and the archived chunk bodies nothing references any more."""
+    expired = db.execute(expired_item_versions_statement(keep, before, batch_size)).all()
+    if len(expired) == 0:
+        return 0
+    version_ids = [d.id for d in expired]
+    db.execute(lock_items_statement(sorted({d.item_id for d in expired})))
+    digests = db.execute(item_version_digests_statement(version_ids)).scalars().all()
+    res = db.execute(delete_item_versions_statement(version_ids)).rowcount
+    lock_chunk_data(db)
+    db.execute(delete_unreferenced_chunk_data_statement(digests))
     db.commit()
     return res
 
 
+def prune_chunk_data(db: Session, batch_size: int) -> int:
+    """Deletes up to batch_size shared chunk bodies left behind by deleted items."""
+    lock_chunk_data(db)
+    digests = db.execute(unreferenced_chunk_data_statement(batch_size)).scalars().all()
+    res = db.execute(delete_unreferenced_chunk_data_statement(digests)).rowcount if len(digests) > 0 else 0
+    db.commit()
+    return res
+
+
+def keep_referenced_chunk_bodies(db: Session, items) -> List[schema.ShortUUID]:
+    """Locks the items about to be deleted and moves the bodies their chunks store that copies or previous
+    versions of other items still reference into chunk_data. Returns the ids of the locked items.
+
+    Copies hold their sources with a share lock, so once the lock is granted every reference is committed.
+    """
+    item_ids = db.execute(items.order_by(models.Item.id).with_for_update()).scalars().all()
+    if len(item_ids) > 0:
+        db.execute(share_chunk_bodies_statement(referenced_chunks_conditions(item_ids)))
+    return item_ids
+
+
+def lock_chunk_data(db: Session):
+    """Waits for the transactions that move chunk bodies and holds off new ones until this one ends.
+
+    A body only becomes referenced through chunk_data in a transaction that inserts into it, and copies hold
+    their sources, so once the lock is held no uncommitted reference can point at a row that looks
+    unreferenced. SQLite has a single writer anyway.
+    """
+    if not sqlite.is_sqlite_session(db):
+        db.execute(lock_chunk_data_statement())
+
+
+def delete_item(db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    keep_referenced_chunk_bodies(db, select(models.Item.id).where(*item_conditions(user, collection_id, item_id)))
+    res = execute_returning(db, delete_item_statement(user, collection_id, item_id)).scalar()
+    forget_deleted(db, models.Item, res)
+    db.commit()
+    return res
+
+
+def forget_deleted(db: Session, model: Any, ident: Optional[str]):
+    """Detaches the session's instance of a row removed by a Core DELETE so that it is never refreshed.
+
+    The primary key stays readable on the detached instance, as it does after Session.delete.
+    """
+    if ident is None:
+        return
+    obj = db.identity_map.get(Session.identity_key(model, ident))
+    if obj is not None:
+        set_committed_value(obj, "id", ident)
+        db.expunge(obj)
+
+
 def list_items(
     db: Session,
     user: models.User,
     collection_id: schema.ShortUUID,
     cursor: Optional[types.EncodedCursor] = None,
     page_size: int = 10,
+    contains: Any = None,
 ):
+    if contains is not None and db.get_bind().dialect.name != "postgresql":
+        raise ValueError("containment filters require PostgreSQL")
     collection = retrieve_collection(db, user, collection_id)
     if collection is None:
         return None
 
-    q = db.query(models.Item).filter(models.Item.owner_id == user.id, models.Item.collection_id == collection_id)
-    if cursor is not None:
-        decoded_cursor = cursor.decode_cursor()
-        if decoded_cursor.direction == "n":
-            res = list(
-                q.filter(models.Item.cursor_value <= decoded_cursor.cursor_value)
-                .order_by(models.Item.cursor_value.desc())
-                .limit(page_size)
-            )
-        elif decoded_cursor.direction == "p":
-            res = sorted(
-                q.filter(models.Item.cursor_value >= decoded_cursor.cursor_value)
-                .order_by(models.Item.cursor_value)
-                .limit(page_size),
-                key=lambda d: d.cursor_value,
-                reverse=True,
-            )
-        else:
-            raise ValueError("invalid direction")
+    conditions = item_list_conditions(user, collection_id, contains)
+    res = db.execute(page_statement(models.Item, conditions, cursor, page_size)).scalars().all()
+    b0, b1 = None, None
+    if len(res) > 0:
+        res = sort_page(res)
+        b0, b1 = (db.execute(d).scalar() for d in neighbor_statements(models.Item, conditions, res))
+    return page_response(res, db.execute(count_statement(models.Item, conditions)).scalar(), b0, b1)
+
+
+def retrieve_item_document(
+    db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, path: Tuple[str, ...]
+) -> Optional[ItemDocument]:
+    """Projects the JSON value at path; ValueError if the item is not a parseable application/json document."""
+    in_database = db.get_bind().dialect.name == "postgresql"
+    row = db.execute(retrieve_item_document_statement(user, collection_id, item_id, path, in_database)).first()
+    if row is None:
+        return None
+    if row.indexed and in_database:
+        return ItemDocument(row.updated_at, row.value if row.found else jsonpointer.missing)
+    if row.indexed:
+        document = row.document
+    elif row.data_type == json_data_type:
+        item = db.execute(retrieve_item_statement(user, collection_id, item_id)).scalar()
+        try:
+            document = json.loads(item.body)
+        except ValueError:
+            raise ValueError("item body is not valid JSON")
     else:
-        res = list(q.order_by(models.Item.cursor_value.desc()).limit(page_size))
+        raise ValueError("item is not application/json")
+    return ItemDocument(row.updated_at, jsonpointer.resolve(document, path))
+
+
+def retrieve_item_derivative(
+    db: Session, user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, variant: str
+):
+    """Item updated_at and data_type, with the body of the variant if it was rendered from this revision."""
+    return db.execute(retrieve_item_derivative_statement(user, collection_id, item_id, variant)).first()
+
+
+def store_item_derivative(
+    db: Session, item_id: schema.ShortUUID, variant: str, source_updated_at: datetime, media_type: str, body: bytes
+) -> bool:
+    db.execute(delete_item_derivatives_statement(item_id, variant))
+    try:
+        db.execute(create_item_derivative_statement(item_id, variant, source_updated_at, media_type, body))
+        db.commit()
+    except IntegrityError:
+        # another request stored the same variant first, or the item is gone
+        db.rollback()
+        return False
+    return True
 
-    if len(res) == 0:
-        b0 = None
-        b1 = None
+
+def search_items(
+    db: Session,
+    user: models.User,
+    query: str,
+    collection_id: Optional[schema.ShortUUID] = None,
+    cursor: Optional[types.EncodedCursor] = None,
+    page_size: int = 10,
+):
+    """Ranked item headers matching every term of query; ValueError if query has no searchable terms."""
+    terms = search.query_terms(query)
+    if len(terms) == 0:
+        raise ValueError("query has no searchable terms")
+    if collection_id is not None and retrieve_collection(db, user, collection_id) is None:
+        return None
+    if is_full_text_session(db):
+        ranked = full_text_search_statement(user, collection_id, query)
     else:
-        b0 = q.filter(models.Item.cursor_value < res[-1].cursor_value).order_by(models.Item.cursor_value.desc()).first()
-        b1 = q.filter(models.Item.cursor_value > res[0].cursor_value).order_by(models.Item.cursor_value).first()
-    res = {
-        "meta": {
-            "count": q.count(),
-            "next_cursor": types.DecodedCursor("n", b0.cursor_value) if b0 is not None else None,
-            "prev_cursor": types.DecodedCursor("p", b1.cursor_value) if b1 is not None else None,
-        },
-        "results": list(res),
-    }
+        ranked = term_search_statement(user, collection_id, terms)
+    res = db.execute(search_page_statement(ranked, cursor, page_size)).all()
+    return search_page_response(res, db.execute(select(func.count()).select_from(ranked)).scalar(), page_size)
+
+
+def execute_returning(db: Session, statement):
+    if sqlite.is_sqlite_session(db):
+        return sqlite.execute_returning(db, statement)
+    return db.execute(statement)
+
+
+def is_full_text_session(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def index_item_text(db: Session, item, search_text: Optional[str]):
+    if is_full_text_session(db):
+        db.execute(update_item_search_vector_statement(item.id, search_text))
+        return
+    db.execute(delete_item_terms_statement(item.id))
+    insert_item_terms(db, item, search_text)
+
+
+def insert_item_terms(db: Session, item, search_text: Optional[str]):
+    rows = item_term_rows(item, search_text)
+    if len(rows) > 0:
+        db.execute(insert(models.ItemTerm), rows)
+
+
+def stream_collection_archive(
+    db: Session, user: models.User, collection_id: schema.ShortUUID, archive_format: str
+) -> Iterator[bytes]:
+    """Yields a tar or zip of the collection, one member per item, reading one chunk at a time."""
+    use_snapshot(db)
+    writer = archives.writers[archive_format]()
+    for item in db.execute(archive_items_statement(user, collection_id)).all():
+        yield writer.begin_file(archives.member_name(item.id, item.data_type), item.size, item.updated_at)
+        for body in iter_item_chunks(db, item.id, item.chunks):
+            yield writer.write(body)
+        yield writer.end_file()
+    yield writer.close()
+
+
+def use_snapshot(db: Session):
+    """Pins every statement of the session to one snapshot, so that sizes read up front match the chunks."""
+    if db.get_bind().dialect.name == "postgresql":
+        # the isolation level only applies to a connection checked out after the probe of the read session
+        db.commit()
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+
+
+def iter_item_chunks(db: Session, item_id: schema.ShortUUID, chunks: int) -> Iterator[bytes]:
+    if sqlite.is_sqlite_session(db):
+        for body in sqlite.iter_chunks(db, item_id):
+            chunk_bytes_read.inc(len(body))
+            yield body
+        return
+    for index in range(chunks):
+        body = db.execute(retrieve_chunk_statement(item_id, index)).scalar()
+        chunk_bytes_read.inc(len(body))
+        yield body
+
+
+class ArchiveImport:
+    """Turns archive member events into item and chunk writes, committing after every batch of members.
+
+    The first chunk of a member decides its data type, so nothing but the current chunk is held in memory. The
+    search text and the JSON document come from that chunk too: they cover the same json_document_max_bytes prefix
+    create_item indexes as long as chunk_size is at least that large, and a JSON member that does not fit in one
+    chunk gets no document.
+    """
+
+    def __init__(
+        self, user: models.User, collection_id: schema.ShortUUID, full_text: bool, batch_items: int, batch_bytes: int
+    ):
+        self.user = user
+        self.collection_id = collection_id
+        self.full_text = full_text
+        self.batch_items = batch_items
+        self.batch_bytes = batch_bytes
+        self.results: List[Dict[str, Any]] = []
+        self.committed = 0
+        self._pending_items = 0
+        self._pending_bytes = 0
+        self._name = ""
+        self._buffer = bytearray()
+        self._item: Optional[Dict[str, Any]] = None
+        self._index = 0
+
+    def handle(self, event: archives.ArchiveEvent) -> Iterator[Tuple[str, Any]]:
+        if event.kind == "start":
+            self._name = event.value
+            self._buffer = bytearray()
+            self._item = None
+            self._index = 0
+        elif event.kind == "data":
+            self._buffer += event.value
+            while len(self._buffer) >= models.chunk_size:
+                body = bytes(self._buffer[: models.chunk_size])
+                del self._buffer[: models.chunk_size]
+                yield from self._write_chunk(body, complete=False)
+        else:
+            if self._item is None or len(self._buffer) > 0:
+                yield from self._write_chunk(bytes(self._buffer), complete=self._item is None)
+            self.results.append(self._item)
+            self._pending_items += 1
+            if self._pending_items >= self.batch_items or self._pending_bytes >= self.batch_bytes:
+                yield from self.flush()
+
+    def flush(self) -> Iterator[Tuple[str, Any]]:
+        if self._pending_items > 0:
+            self.committed += self._pending_items
+            self._pending_items = 0
+            self._pending_bytes = 0
+            yield ("commit", None)
+
+    def _write_chunk(self, body: bytes, complete: bool) -> Iterator[Tuple[str, Any]]:
+        if self._item is None:
+            yield from self._create_item(body, complete)
+        if len(body) > 0:
+            yield ("chunks", [chunk_row(self._item["id"], self._index, body)])
+        self._index += 1
+        self._item["size"] += len(body)
+        self._pending_bytes += len(body)
+
+    def _create_item(self, head: bytes, complete: bool) -> Iterator[Tuple[str, Any]]:
+        item_id = utils.gen_uuid()
+        data_type = archives.guess_data_type(self._name, head)
+        document = parse_json_document(data_type, head) if complete else None
+        search_text = search.extract_text(data_type, head[:json_document_max_bytes])
+        yield (
+            "item",
+            import_item_statement(
+                self.user, self.collection_id, item_id, data_type, document, search_text if self.full_text else None
+            ),
+        )
+        if not self.full_text:
+            item = models.Item(id=item_id, owner_id=self.user.id, collection_id=self.collection_id)
+            yield ("terms", item_term_rows(item, search_text))
+        self._item = {"name": self._name, "id": item_id, "data_type": data_type, "size": 0}
+
+
+def import_items(
+    db: Session,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    stream: Iterable[bytes],
+    batch_items: int,
+    batch_bytes: int,
+) -> Optional[List[Dict[str, Any]]]:
+    """Creates an item for every regular file of a tar or zip read from stream, never holding more than a chunk.
+
+    Batches are committed as they fill up, so a malformed archive keeps the items imported before the error.
+    """
+    if retrieve_collection(db, user, collection_id) is None:
+        return None
+    importer = ArchiveImport(user, collection_id, is_full_text_session(db), batch_items, batch_bytes)
+    reader = archives.ArchiveReader()
+    try:
+        for data in stream:
+            apply_import_writes(db, plan_import_writes(reader, importer, data))
+        reader.close()
+    except ValueError as e:
+        db.rollback()
+        raise ValueError(f"{e}; {importer.committed} items were imported before the error") from e
+    apply_import_writes(db, importer.flush())
+    return importer.results
+
+
+def plan_import_writes(reader: archives.ArchiveReader, importer: ArchiveImport, data: bytes) -> List[Tuple[str, Any]]:
+    return [d for event in reader.feed(data) for d in importer.handle(event)]
+
+
+def apply_import_writes(db: Session, writes: Iterable[Tuple[str, Any]]):
+    for kind, value in writes:
+        if kind == "commit":
+            db.commit()
+        elif kind == "chunks":
+            insert_chunk_rows(db, value)
+        elif kind == "terms":
+            if len(value) > 0:
+                db.execute(insert(models.ItemTerm), value)
+        else:
+            db.execute(value)
+
+
+def copy_item(
+    db: Session,
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    target_collection_id: schema.ShortUUID,
+    batch_size: int,
+):
+    if retrieve_item_header(db, user, collection_id, item_id) is None:
+        return None
+    if retrieve_collection(db, user, target_collection_id) is None:
+        return None
+    (copy_id,) = copy_item_rows(db, [item_id], target_collection_id, batch_size)
+    db.commit()
+    return retrieve_item_header(db, user, target_collection_id, copy_id)
+
+
+def clone_collection(
+    db: Session, user: models.User, collection_id: schema.ShortUUID, name: Optional[str], batch_size: int
+):
+    """Copies the collection and all of its items without moving a body through Python.
+
+    Each batch of items is committed on its own, so a clone that fails part way keeps the items copied so far.
+    """
+    source = retrieve_collection(db, user, collection_id)
+    if source is None:
+        return None
+    data = schema.CollectionCreateQuery(name=name if name is not None else source.name)
+    collection = execute_returning(db, create_collection_statement(data, user)).one()
+    after = None
+    while True:
+        batch = db.execute(clone_source_items_statement(user, collection_id, after, batch_size)).all()
+        if len(batch) == 0:
+            break
+        copy_item_rows(db, [d.id for d in batch], collection.id, batch_size)
+        db.commit()
+        after = batch[-1].cursor_value
+    db.commit()
+    return collection
+
+
+def copy_item_rows(
+    db: Session, item_ids: List[schema.ShortUUID], target_collection_id: schema.ShortUUID, batch_size: int
+) -> List[schema.ShortUUID]:
+    item_ids_map = [(d, utils.gen_uuid()) for d in item_ids]
+    item_map = id_map_subquery(item_ids_map, "source_id", "id")
+    db.execute(copy_items_statement(item_map, target_collection_id, utils.gen_datetime()))
+    copies = dict(item_ids_map)
+    # the copied chunks only carry digests; holding the sources keeps their bodies until the copies commit
+    db.execute(lock_items_statement(sorted(item_ids), read=True))
+    chunks = db.execute(source_chunks_statement(item_ids)).all()
+    for i in range(0, len(chunks), batch_size):
+        rows = [(d.id, utils.gen_uuid(), copies[d.item_id]) for d in chunks[i : i + batch_size]]
+        db.execute(copy_chunks_statement(id_map_subquery(rows, "source_id", "id", "item_id")))
+    if not is_full_text_session(db):
+        db.execute(copy_item_terms_statement(item_map, target_collection_id))
+    return [d for _, d in item_ids_map]
+
+
+def delete_collection_items(db: Session, user: models.User, collection_id: schema.ShortUUID, batch_size: int) -> int:
+    item_ids = keep_referenced_chunk_bodies(db, collection_items_statement(user, collection_id).limit(batch_size))
+    res = db.execute(delete_items_statement(item_ids)).rowcount
+    db.commit()
+    return res
+
+
+def count_collection_items(db: Session, user: models.User, collection_id: schema.ShortUUID) -> int:
+    conditions = (models.Item.owner_id == user.id, models.Item.collection_id == collection_id)
+    return db.execute(count_statement(models.Item, conditions)).scalar()
+
+
+def create_job(db: Session, user: models.User, kind: str, params: Dict[str, Any], max_attempts: int = 3):
+    job = execute_returning(db, create_job_statement(user, kind, params, max_attempts)).one()
+    db.commit()
+    return job
+
+
+def retrieve_job(db: Session, user: models.User, job_id: schema.ShortUUID):
+    return db.execute(retrieve_job_statement(user, job_id)).first()
+
+
+def claim_job(db: Session, worker_id: str, lease: timedelta):
+    job = execute_returning(db, claim_job_statement(worker_id, utils.gen_datetime(), lease)).first()
+    db.commit()
+    return job
+
+
+def report_job_progress(db: Session, job_id: schema.ShortUUID, worker_id: str, progress: float, lease: timedelta):
+    values = {"progress": progress, "locked_until": utils.gen_datetime() + lease}
+    res = db.execute(update_job_statement(job_id, worker_id, values)).rowcount
+    db.commit()
+    return res > 0
+
+
+def complete_job(db: Session, job_id: schema.ShortUUID, worker_id: str, result: Optional[Dict[str, Any]]) -> bool:
+    values = {"status": "succeeded", "progress": 1.0, "result": result, "error": None}
+    res = db.execute(update_job_statement(job_id, worker_id, values, release=True)).rowcount
+    db.commit()
+    return res > 0
+
+
+def fail_job(db: Session, job, worker_id: str, error: str, retry_delay: timedelta) -> str:
+    values: Dict[str, Any] = {"status": "failed", "error": error}
+    if job.attempts < job.max_attempts:
+        values.update(status="queued", run_after=utils.gen_datetime() + retry_delay * 2 ** (job.attempts - 1))
+    db.execute(update_job_statement(job.id, worker_id, values, release=True))
+    db.commit()
+    return values["status"]
+
+
+def fail_abandoned_jobs(db: Session) -> int:
+    res = db.execute(fail_abandoned_jobs_statement(utils.gen_datetime())).rowcount
+    db.commit()
     return res
+
+
+def create_user_statement(query: schema.UserCreateQuery, hashed_password: str):
+    return (
+        insert(models.User)
+        .values(username=query.username, hashed_password=hashed_password, email=query.email)
+        .returning(*user_columns)
+    )
+
+
+def find_user_statement(query: schema.UserLoginQuery):
+    if query.is_username():
+        return select(models.User).where(models.User.username == query.login_id).limit(1)
+    return select(models.User).where(models.User.email == query.login_id).limit(1)
+
+
+def create_refresh_token_statement(
+    token: str, user_id: schema.ShortUUID, expires_delta: timedelta, family_id: Optional[schema.ShortUUID]
+):
+    return insert(models.RefreshToken).values(
+        user_id=user_id,
+        family_id=family_id or utils.gen_uuid(),
+        digest=utils.calc_token_digest(token),
+        expires_at=utils.gen_datetime() + expires_delta,
+    )
+
+
+def consume_refresh_token_statement(digest: str):
+    now = utils.gen_datetime()
+    return (
+        update(models.RefreshToken)
+        .where(
+            models.RefreshToken.digest == digest,
+            models.RefreshToken.rotated_at.is_(None),
+            models.RefreshToken.expires_at > now,
+        )
+        .values(rotated_at=now)
+        .returning(models.RefreshToken.user_id, models.RefreshToken.family_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def find_rotated_refresh_token_family_statement(digest: str):
+    return select(models.RefreshToken.family_id).where(
+        models.RefreshToken.digest == digest, models.RefreshToken.rotated_at.isnot(None)
+    )
+
+
+def delete_refresh_token_family_statement(family_id: schema.ShortUUID):
+    return (
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.family_id == family_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_expired_refresh_tokens_statement(now: datetime):
+    return (
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.expires_at <= now)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def create_api_key_statement(user: models.User, data: schema.ApiKeyCreateQuery, api_key: str, secret_key: str):
+    expires_at = None
+    if data.expires_in_days is not None:
+        expires_at = utils.gen_datetime() + timedelta(days=data.expires_in_days)
+    return (
+        insert(models.ApiKey)
+        .values(
+            user_id=user.id,
+            name=data.name,
+            prefix=utils.parse_api_key_prefix(api_key),
+            digest=utils.calc_api_key_digest(api_key, secret_key),
+            expires_at=expires_at,
+        )
+        .returning(*api_key_columns)
+    )
+
+
+def list_api_keys_statement(user: models.User):
+    return select(*api_key_columns).where(models.ApiKey.user_id == user.id).order_by(models.ApiKey.created_at.desc())
+
+
+def delete_api_key_statement(user: models.User, api_key_id: schema.ShortUUID):
+    return (
+        delete(models.ApiKey)
+        .where(models.ApiKey.user_id == user.id, models.ApiKey.id == api_key_id)
+        .returning(models.ApiKey.digest)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def find_api_key_statement(prefix: str):
+    return (
+        select(models.ApiKey.digest, models.ApiKey.expires_at, *user_columns)
+        .join(models.User, models.User.id == models.ApiKey.user_id)
+        .where(models.ApiKey.prefix == prefix)
+    )
+
+
+def create_collection_statement(data: schema.CollectionCreateQuery, user: models.User):
+    return insert(models.Collection).values(name=data.name, owner_id=user.id).returning(*collection_columns)
+
+
+def retrieve_collection_statement(user: models.User, collection_id: schema.ShortUUID):
+    return select(models.Collection).where(models.Collection.owner_id == user.id, models.Collection.id == collection_id)
+
+
+def update_collection_statement(user: models.User, collection_id: schema.ShortUUID, data: schema.CollectionUpdateQuery):
+    now = utils.gen_datetime()
+    return (
+        update(models.Collection)
+        .where(models.Collection.owner_id == user.id, models.Collection.id == collection_id)
+        .values(name=data.name, updated_at=now, cursor_value=cursor_value_expression(now, models.Collection.id))
+        .returning(*collection_columns)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_collection_statement(user: models.User, collection_id: schema.ShortUUID):
+    return (
+        delete(models.Collection)
+        .where(models.Collection.owner_id == user.id, models.Collection.id == collection_id)
+        .returning(models.Collection.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def create_item_statement(
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    data: schema.ItemCreateQuery,
+    document: Any = None,
+    search_text: Optional[str] = None,
+):
+    item_id = utils.gen_uuid()
+    now = utils.gen_datetime()
+    owned_collection = select(
+        literal(item_id, models.id_type),
+        models.Collection.owner_id,
+        models.Collection.id,
+        literal(data.data_type, String()),
+        literal(now, DateTime()),
+        literal(now, DateTime()),
+        literal(utils.format_cursor_value(now, item_id), String()),
+        literal(document, models.document_type),
+        search_vector_expression(search_text),
+    ).where(models.Collection.owner_id == user.id, models.Collection.id == collection_id)
+    return (
+        insert(models.Item)
+        .from_select(
+            [
+                "id",
+                "owner_id",
+                "collection_id",
+                "data_type",
+                "created_at",
+                "updated_at",
+                "cursor_value",
+                "document",
+                "search_vector",
+            ],
+            owned_collection,
+        )
+        .returning(*item_header_columns)
+    )
+
+
+def import_item_statement(
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    data_type: str,
+    document: Any = None,
+    search_text: Optional[str] = None,
+):
+    now = utils.gen_datetime()
+    return insert(models.Item).values(
+        id=item_id,
+        owner_id=user.id,
+        collection_id=collection_id,
+        data_type=data_type,
+        created_at=now,
+        updated_at=now,
+        cursor_value=utils.format_cursor_value(now, item_id),
+        document=literal(document, models.document_type),
+        search_vector=search_vector_expression(search_text),
+    )
+
+
+def item_conditions(user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return (models.Item.collection_id == collection_id, models.Item.id == item_id, models.Item.owner_id == user.id)
+
+
+def retrieve_item_statement(user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return (
+        select(models.Item)
+        .where(*item_conditions(user, collection_id, item_id))
+        .options(selectinload(models.Item.chunks))
+    )
+
+
+def retrieve_item_header_statement(user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return select(*item_header_columns).where(*item_conditions(user, collection_id, item_id))
+
+
+def update_item_statement(
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    data: schema.ItemUpdateQuery,
+    document: Any = None,
+):
+    now = utils.gen_datetime()
+    values = {"updated_at": now, "cursor_value": cursor_value_expression(now, models.Item.id)}
+    if data.data_type is not None:
+        values["data_type"] = data.data_type
+    if data.body is not None and data.data_type in (None, json_data_type):
+        document = literal(document, models.document_type)
+        if data.data_type is None:
+            # a typed ELSE makes PostgreSQL resolve the CASE as jsonb; with two untyped branches it would be text
+            document = case(
+                (models.Item.data_type == json_data_type, document), else_=cast(null(), models.document_type)
+            )
+        values["document"] = document
+    elif data.data_type is not None and data.data_type != json_data_type:
+        values["document"] = null()
+    return (
+        update(models.Item)
+        .where(*item_conditions(user, collection_id, item_id))
+        .values(**values)
+        .returning(*item_header_columns)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_item_statement(user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return (
+        delete(models.Item)
+        .where(*item_conditions(user, collection_id, item_id))
+        .returning(models.Item.id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_chunks_statement(item_id: schema.ShortUUID, indexes: Optional[List[int]] = None):
+    q = delete(models.Chunk).where(models.Chunk.item_id == item_id)
+    if indexes is not None:
+        q = q.where(models.Chunk.index.in_(indexes))
+    return q.execution_options(synchronize_session=False)
+
+
+def count_chunk_bytes_read(item: Optional[models.Item]) -> Optional[models.Item]:
+    if item is not None:
+        chunk_bytes_read.inc(sum(len(d.body) for d in item.chunks))
+    return item
+
+
+def chunk_row(item_id: schema.ShortUUID, index: int, body: bytes) -> Dict[str, Any]:
+    return {
+        "id": utils.gen_uuid(),
+        "item_id": item_id,
+        "index": index,
+        "body": body,
+        "digest": utils.calc_chunk_digest(body),
+    }
+
+
+def chunk_rows(item_id: schema.ShortUUID, body: bytes):
+    return [chunk_row(item_id, i, d) for i, d in enumerate(models.split_into_chunks(body))]
+
+
+def insert_chunks(db: Session, item_id: schema.ShortUUID, body: bytes):
+    insert_chunk_rows(db, chunk_rows(item_id, body))
+
+
+def insert_chunk_rows(db: Session, chunks: List[Dict[str, Any]]):
+    if len(chunks) == 0:
+        return
+    chunk_bytes_written.inc(sum(len(d["body"]) for d in chunks))
+    if sqlite.is_sqlite_session(db):
+        sqlite.insert_chunks(db, chunks)
+    else:
+        db.execute(insert(models.Chunk), chunks)
+
+
+def diff_chunks(item_id: schema.ShortUUID, body: bytes, live: Dict[int, str]):
+    """New chunk rows whose digest differs from the live chunk at that index, and the live indexes they replace."""
+    rows = chunk_rows(item_id, body)
+    changed = [d for d in rows if live.get(d["index"]) != d["digest"]]
+    stale = sorted(i for i, digest in live.items() if i >= len(rows) or rows[i]["digest"] != digest)
+    return changed, stale
+
+
+def archived_chunk_indexes(live: Dict[int, str], stale: List[int]) -> List[int]:
+    return list({live[i]: i for i in stale}.values())
+
+
+def live_chunk_digests(live) -> Dict[int, str]:
+    return {d.index: d.digest for d in live if d.index is not None}
+
+
+def item_version_chunk_rows(version_id: schema.ShortUUID, live):
+    return [{"version_id": version_id, "index": d.index, "digest": d.digest} for d in live if d.index is not None]
+
+
+def cursor_value_expression(dt: datetime, id_column):
+    return literal(f"{utils.format_timestamp(dt)}|", String()) + id_column
+
+
+def id_map_subquery(rows: List[Tuple[schema.ShortUUID, ...]], *names: str):
+    """Inline table of source and fresh ids, so that INSERT ... SELECT copies get new primary keys."""
+    return union_all(
+        *(select(*(literal(v, models.id_type).label(k) for v, k in zip(row, names))) for row in rows)
+    ).subquery()
+
+
+def clone_source_items_statement(
+    user: models.User, collection_id: schema.ShortUUID, after: Optional[str], batch_size: int
+):
+    q = select(models.Item.id, models.Item.cursor_value).where(
+        models.Item.owner_id == user.id, models.Item.collection_id == collection_id
+    )
+    if after is not None:
+        q = q.where(models.Item.cursor_value > after)
+    return q.order_by(models.Item.cursor_value).limit(batch_size)
+
+
+def source_chunks_statement(item_ids: List[schema.ShortUUID]):
+    return select(models.Chunk.id, models.Chunk.item_id).where(models.Chunk.item_id.in_(item_ids))
+
+
+def copy_items_statement(item_map, collection_id: schema.ShortUUID, now: datetime):
+    copies = select(
+        item_map.c.id,
+        models.Item.owner_id,
+        literal(collection_id, models.id_type),
+        models.Item.data_type,
+        literal(now, DateTime()),
+        literal(now, DateTime()),
+        cursor_value_expression(now, item_map.c.id),
+        models.Item.document,
+        models.Item.search_vector,
+    ).join_from(item_map, models.Item, models.Item.id == item_map.c.source_id)
+    return insert(models.Item).from_select(
+        [
+            "id",
+            "owner_id",
+            "collection_id",
+            "data_type",
+            "created_at",
+            "updated_at",
+            "cursor_value",
+            "document",
+            "search_vector",
+        ],
+        copies,
+    )
+
+
+def copy_chunks_statement(chunk_map):
+    copies = select(chunk_map.c.id, chunk_map.c.item_id, models.Chunk.index, models.Chunk.digest).join_from(
+        chunk_map, models.Chunk, models.Chunk.id == chunk_map.c.source_id
+    )
+    return insert(models.Chunk).from_select(["id", "item_id", "index", "digest"], copies)
+
+
+def copy_item_terms_statement(item_map, collection_id: schema.ShortUUID):
+    copies = select(
+        item_map.c.id,
+        models.ItemTerm.term,
+        models.ItemTerm.owner_id,
+        literal(collection_id, models.id_type),
+        models.ItemTerm.weight,
+    ).join_from(item_map, models.ItemTerm, models.ItemTerm.item_id == item_map.c.source_id)
+    return insert(models.ItemTerm).from_select(["item_id", "term", "owner_id", "collection_id", "weight"], copies)
+
+
+def page_statement(model, conditions, cursor: Optional[types.EncodedCursor], page_size: int):
+    q = select(model).where(*conditions)
+    if cursor is None:
+        return q.order_by(model.cursor_value.desc()).limit(page_size)
+    decoded_cursor = cursor.decode_cursor()
+    if decoded_cursor.direction == "n":
+        return (
+            q.where(model.cursor_value <= decoded_cursor.cursor_value)
+            .order_by(model.cursor_value.desc())
+            .limit(page_size)
+        )
+    if decoded_cursor.direction == "p":
+        return q.where(model.cursor_value >= decoded_cursor.cursor_value).order_by(model.cursor_value).limit(page_size)
+    raise ValueError("invalid direction")
+
+
+def sort_page(res):
+    return sorted(res, key=lambda d: d.cursor_value, reverse=True)
+
+
+def neighbor_statements(model, conditions, res):
+    return (
+        select(model.cursor_value)
+        .where(*conditions, model.cursor_value < res[-1].cursor_value)
+        .order_by(model.cursor_value.desc())
+        .limit(1),
+        select(model.cursor_value)
+        .where(*conditions, model.cursor_value > res[0].cursor_value)
+        .order_by(model.cursor_value)
+        .limit(1),
+    )
+
+
+def count_statement(model, conditions):
+    return select(func.count()).select_from(model).where(*conditions)
+
+
+def page_response(res, count: int, next_cursor_value: Optional[str], prev_cursor_value: Optional[str]):
+    return {
+        "meta": {
+            "count": count,
+            "next_cursor": types.DecodedCursor("n", next_cursor_value) if next_cursor_value is not None else None,
+            "prev_cursor": types.DecodedCursor("p", prev_cursor_value) if prev_cursor_value is not None else None,
+        },
+        "results": list(res),
+    }
+
+
+def collection_items_statement(user: models.User, collection_id: schema.ShortUUID):
+    return select(models.Item.id).where(models.Item.owner_id == user.id, models.Item.collection_id == collection_id)
+
+
+def delete_items_statement(item_ids: List[schema.ShortUUID]):
+    return delete(models.Item).where(models.Item.id.in_(item_ids)).execution_options(synchronize_session=False)
+
+
+def create_job_statement(user: models.User, kind: str, params: Dict[str, Any], max_attempts: int):
+    now = utils.gen_datetime()
+    return (
+        insert(models.Job)
+        .values(
+            id=utils.gen_uuid(),
+            owner_id=user.id,
+            kind=kind,
+            params=params,
+            status="queued",
+            progress=0.0,
+            attempts=0,
+            max_attempts=max_attempts,
+            run_after=now,
+            created_at=now,
+            updated_at=now,
+        )
+        .returning(*job_columns)
+    )
+
+
+def retrieve_job_statement(user: models.User, job_id: schema.ShortUUID):
+    return select(*job_columns).where(models.Job.owner_id == user.id, models.Job.id == job_id)
+
+
+def claim_job_statement(worker_id: str, now: datetime, lease: timedelta):
+    claimable = (
+        select(models.Job.id)
+        .where(
+            models.Job.attempts < models.Job.max_attempts,
+            or_(
+                and_(models.Job.status == "queued", models.Job.run_after <= now),
+                and_(models.Job.status == "running", models.Job.locked_until < now),
+            ),
+        )
+        .order_by(models.Job.run_after)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    return (
+        update(models.Job)
+        .where(models.Job.id == claimable)
+        .values(
+            status="running",
+            attempts=models.Job.attempts + 1,
+            locked_by=worker_id,
+            locked_until=now + lease,
+            updated_at=now,
+        )
+        .returning(*job_columns)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_job_statement(job_id: schema.ShortUUID, worker_id: str, values: Dict[str, Any], release: bool = False):
+    if release:
+        values = {**values, "locked_by": None, "locked_until": None}
+    return (
+        update(models.Job)
+        .where(models.Job.id == job_id, models.Job.locked_by == worker_id, models.Job.status == "running")
+        .values(updated_at=utils.gen_datetime(), **values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def fail_abandoned_jobs_statement(now: datetime):
+    return (
+        update(models.Job)
+        .where(
+            models.Job.status == "running",
+            models.Job.locked_until < now,
+            models.Job.attempts >= models.Job.max_attempts,
+        )
+        .values(status="failed", error="worker lease expired", locked_by=None, locked_until=None, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_item_document_statement(item_id: schema.ShortUUID, document: Any):
+    return (
+        update(models.Item)
+        .where(models.Item.id == item_id)
+        .values(document=literal(document, models.document_type))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def retrieve_item_document_statement(
+    user: models.User,
+    collection_id: schema.ShortUUID,
+    item_id: schema.ShortUUID,
+    path: Tuple[str, ...],
+    in_database: bool,
+):
+    columns = [models.Item.updated_at, models.Item.data_type, models.Item.document.is_not(None).label("indexed")]
+    if in_database:
+        value = type_coerce(models.Item.document, JSONB).op("#>")(literal(list(path), postgresql_text_array))
+        columns += [type_coerce(value, JSONB).label("value"), value.is_not(None).label("found")]
+    else:
+        columns.append(models.Item.document)
+    return select(*columns).where(*item_conditions(user, collection_id, item_id))
+
+
+def item_list_conditions(user: models.User, collection_id: schema.ShortUUID, contains: Any = None):
+    conditions = (models.Item.owner_id == user.id, models.Item.collection_id == collection_id)
+    if contains is None:
+        return conditions
+    return conditions + (type_coerce(models.Item.document, JSONB).contains(contains),)
+
+
+def search_vector_expression(search_text: Optional[str]):
+    if search_text is None:
+        return literal(None, models.search_vector_type)
+    return func.to_tsvector(text_search_config(), literal(search_text, String()))
+
+
+def text_search_config():
+    # asyncpg binds a plain string as varchar, and there is no to_tsvector(varchar, ...) to resolve it against
+    return literal_column(f"'{search.text_search_config}'::regconfig")
+
+
+def update_item_search_vector_statement(item_id: schema.ShortUUID, search_text: Optional[str]):
+    return (
+        update(models.Item)
+        .where(models.Item.id == item_id)
+        .values(search_vector=search_vector_expression(search_text))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def item_term_rows(item, search_text: Optional[str]):
+    return [
+        {"item_id": item.id, "term": k, "owner_id": item.owner_id, "collection_id": item.collection_id, "weight": v}
+        for k, v in search.term_weights(search_text).items()
+    ]
+
+
+def delete_item_terms_statement(item_id: schema.ShortUUID):
+    return (
+        delete(models.ItemTerm).where(models.ItemTerm.item_id == item_id).execution_options(synchronize_session=False)
+    )
+
+
+def full_text_search_statement(user: models.User, collection_id: Optional[schema.ShortUUID], query: str):
+    tsquery = func.plainto_tsquery(text_search_config(), literal(query, String()))
+    conditions = [models.Item.owner_id == user.id, models.Item.search_vector.bool_op("@@")(tsquery)]
+    if collection_id is not None:
+        conditions.append(models.Item.collection_id == collection_id)
+    # ts_rank_cd returns real; widened to the double precision the cursor is bound as, so that ties compare equal
+    rank = cast(func.ts_rank_cd(models.Item.search_vector, tsquery), DOUBLE_PRECISION)
+    return select(*item_header_columns, rank.label("rank")).where(*conditions).subquery()
+
+
+def term_search_statement(user: models.User, collection_id: Optional[schema.ShortUUID], terms: List[str]):
+    conditions = [models.ItemTerm.owner_id == user.id, models.ItemTerm.term.in_(terms)]
+    if collection_id is not None:
+        conditions.append(models.ItemTerm.collection_id == collection_id)
+    scores = (
+        select(models.ItemTerm.item_id, func.sum(models.ItemTerm.weight).label("rank"))
+        .where(*conditions)
+        .group_by(models.ItemTerm.item_id)
+        .having(func.count() == len(terms))
+        .subquery()
+    )
+    return (
+        select(*item_header_columns, scores.c.rank)
+        .join_from(models.Item, scores, models.Item.id == scores.c.item_id)
+        .subquery()
+    )
+
+
+def search_page_statement(ranked, cursor: Optional[types.EncodedCursor], page_size: int):
+    q = select(ranked).order_by(ranked.c.rank.desc(), ranked.c.cursor_value.desc()).limit(page_size + 1)
+    if cursor is None:
+        return q
+    decoded_cursor = cursor.decode_cursor()
+    if decoded_cursor.direction != "n":
+        raise ValueError("invalid direction")
+    rank, cursor_value = search.parse_search_cursor_value(decoded_cursor.cursor_value)
+    return q.where(or_(ranked.c.rank < rank, and_(ranked.c.rank == rank, ranked.c.cursor_value <= cursor_value)))
+
+
+def search_page_response(res, count: int, page_size: int):
+    next_cursor = None
+    if len(res) > page_size:
+        last = res[page_size]
+        next_cursor = types.DecodedCursor("n", search.format_search_cursor_value(last.rank, last.cursor_value))
+    return {"meta": {"count": count, "next_cursor": next_cursor}, "results": res[:page_size]}
+
+
+def retrieve_item_derivative_statement(
+    user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, variant: str
+):
+    current_variant = and_(
+        models.ItemDerivative.item_id == models.Item.id,
+        models.ItemDerivative.variant == variant,
+        models.ItemDerivative.source_updated_at == models.Item.updated_at,
+    )
+    return (
+        select(models.Item.updated_at, models.Item.data_type, models.ItemDerivative.body)
+        .outerjoin_from(models.Item, models.ItemDerivative, current_variant)
+        .where(*item_conditions(user, collection_id, item_id))
+    )
+
+
+def create_item_derivative_statement(
+    item_id: schema.ShortUUID, variant: str, source_updated_at: datetime, media_type: str, body: bytes
+):
+    return insert(models.ItemDerivative).values(
+        id=utils.gen_uuid(),
+        item_id=item_id,
+        variant=variant,
+        media_type=media_type,
+        source_updated_at=source_updated_at,
+        body=body,
+        created_at=utils.gen_datetime(),
+    )
+
+
+def delete_item_derivatives_statement(item_id: schema.ShortUUID, variant: Optional[str] = None):
+    q = delete(models.ItemDerivative).where(models.ItemDerivative.item_id == item_id)
+    if variant is not None:
+        q = q.where(models.ItemDerivative.variant == variant)
+    return q.execution_options(synchronize_session=False)
+
+
+def lock_item_chunks_statement(user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID):
+    return (
+        select(
+            models.Item.id,
+            models.Item.data_type,
+            models.Item.updated_at,
+            models.Chunk.index,
+            models.Chunk.digest,
+            func.length(models.Chunk.body).label("size"),
+        )
+        .outerjoin_from(models.Item, models.Chunk, models.Chunk.item_id == models.Item.id)
+        .where(*item_conditions(user, collection_id, item_id))
+        .with_for_update(of=models.Item)
+    )
+
+
+def lock_items_statement(item_ids: List[schema.ShortUUID], read: bool = False):
+    return (
+        select(models.Item.id)
+        .where(models.Item.id.in_(item_ids))
+        .order_by(models.Item.id)
+        .with_for_update(read=read, key_share=read)
+    )
+
+
+def create_item_version_statement(version_id: schema.ShortUUID, live):
+    head = live[0]
+    next_version = (
+        select(func.coalesce(func.max(models.ItemVersion.version), 0) + 1)
+        .where(models.ItemVersion.item_id == head.id)
+        .scalar_subquery()
+    )
+    return insert(models.ItemVersion).values(
+        id=version_id,
+        item_id=head.id,
+        version=next_version,
+        data_type=head.data_type,
+        size=sum(d.size or 0 for d in live),
+        updated_at=head.updated_at,
+        archived_at=utils.gen_datetime(),
+    )
+
+
+def share_chunk_bodies_statement(conditions):
+    """Copies the bodies the matching chunks store themselves into chunk_data, once per digest."""
+    shared = exists().where(models.ChunkData.digest == models.Chunk.digest)
+    bodies = select(models.Chunk.digest, models.Chunk.stored_body).where(
+        models.Chunk.stored_body.isnot(None), ~shared, *conditions
+    )
+    return (
+        postgresql.insert(models.ChunkData)
+        .from_select(["digest", "body"], bodies)
+        .on_conflict_do_nothing(index_elements=[models.ChunkData.digest])
+    )
+
+
+def referenced_chunks_conditions(item_ids: List[schema.ShortUUID]):
+    """Chunks of the items whose digest a copy or a previous version of another item refers to, and that no
+    other item stores as well."""
+    others = aliased(models.Chunk)
+    other_chunks = and_(others.digest == models.Chunk.digest, others.item_id.notin_(item_ids))
+    copied = exists().where(other_chunks, others.stored_body.is_(None))
+    stored = exists().where(other_chunks, others.stored_body.isnot(None))
+    versioned = (
+        select(models.ItemVersionChunk.digest)
+        .join_from(
+            models.ItemVersionChunk, models.ItemVersion, models.ItemVersion.id == models.ItemVersionChunk.version_id
+        )
+        .where(models.ItemVersionChunk.digest == models.Chunk.digest, models.ItemVersion.item_id.notin_(item_ids))
+        .exists()
+    )
+    return [models.Chunk.item_id.in_(item_ids), or_(copied, versioned), ~stored]
+
+
+item_version_columns = (
+    models.ItemVersion.id,
+    models.ItemVersion.item_id,
+    models.ItemVersion.version,
+    models.ItemVersion.data_type,
+    models.ItemVersion.size,
+    models.ItemVersion.updated_at,
+    models.ItemVersion.archived_at,
+)
+
+
+def list_item_versions_statement(item_id: schema.ShortUUID):
+    return (
+        select(*item_version_columns)
+        .where(models.ItemVersion.item_id == item_id)
+        .order_by(models.ItemVersion.version.desc())
+    )
+
+
+def retrieve_item_version_statement(
+    user: models.User, collection_id: schema.ShortUUID, item_id: schema.ShortUUID, version: int
+):
+    return (
+        select(*item_version_columns)
+        .join_from(models.ItemVersion, models.Item, models.Item.id == models.ItemVersion.item_id)
+        .where(*item_conditions(user, collection_id, item_id), models.ItemVersion.version == version)
+    )
+
+
+def item_version_chunks_statement(version_id: schema.ShortUUID):
+    return (
+        select(models.ItemVersionChunk.index, models.ItemVersionChunk.digest)
+        .where(models.ItemVersionChunk.version_id == version_id)
+        .order_by(models.ItemVersionChunk.index)
+    )
+
+
+def version_chunk_bodies_statement(digest: str):
+    """The body in chunk_data plus the chunks still storing it, read in one statement so that a concurrent
+    update moving a chunk into chunk_data cannot make it disappear between two reads."""
+    return union_all(
+        select(models.ChunkData.body).where(models.ChunkData.digest == digest),
+        select(models.Chunk.stored_body).where(models.Chunk.digest == digest, models.Chunk.stored_body.isnot(None)),
+    )
+
+
+def expired_item_versions_statement(keep: int, before: Optional[datetime], batch_size: int):
+    ranked = select(
+        models.ItemVersion.id,
+        models.ItemVersion.item_id,
+        models.ItemVersion.archived_at,
+        func.row_number()
+        .over(partition_by=models.ItemVersion.item_id, order_by=models.ItemVersion.version.desc())
+        .label("position"),
+    ).subquery()
+    # the newest version always survives so that version numbers keep increasing
+    expired = ranked.c.position > max(keep, 1)
+    if before is not None:
+        expired = or_(expired, and_(ranked.c.position > 1, ranked.c.archived_at < before))
+    return select(ranked.c.id, ranked.c.item_id).where(expired).limit(batch_size)
+
+
+def delete_item_versions_statement(version_ids: List[schema.ShortUUID]):
+    return (
+        delete(models.ItemVersion)
+        .where(models.ItemVersion.id.in_(version_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def item_version_digests_statement(version_ids: List[schema.ShortUUID]):
+    return select(models.ItemVersionChunk.digest).where(models.ItemVersionChunk.version_id.in_(version_ids)).distinct()
+
+
+def lock_chunk_data_statement():
+    return text(f"LOCK TABLE {models.ChunkData.__tablename__} IN EXCLUSIVE MODE")
+
+
+def chunk_data_referenced():
+    return or_(
+        exists().where(models.Chunk.digest == models.ChunkData.digest),
+        exists().where(models.ItemVersionChunk.digest == models.ChunkData.digest),
+    )
+
+
+def unreferenced_chunk_data_statement(batch_size: int):
+    return select(models.ChunkData.digest).where(~chunk_data_referenced()).limit(batch_size)
+
+
+def delete_unreferenced_chunk_data_statement(digests: List[str]):
+    return (
+        delete(models.ChunkData)
+        .where(models.ChunkData.digest.in_(digests), ~chunk_data_referenced())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def archive_items_statement(user: models.User, collection_id: schema.ShortUUID):
+    return (
+        select(
+            models.Item.id,
+            models.Item.data_type,
+            models.Item.updated_at,
+            func.count(models.Chunk.id).label("chunks"),
+            func.coalesce(func.sum(func.length(models.Chunk.body)), 0).label("size"),
+        )
+        .outerjoin_from(models.Item, models.Chunk, models.Chunk.item_id == models.Item.id)
+        .where(models.Item.owner_id == user.id, models.Item.collection_id == collection_id)
+        .group_by(models.Item.id, models.Item.data_type, models.Item.updated_at, models.Item.cursor_value)
+        .order_by(models.Item.cursor_value)
+    )
+
+
+def retrieve_chunk_statement(item_id: schema.ShortUUID, index: int):
+    return select(models.Chunk.body).where(models.Chunk.item_id == item_id, models.Chunk.index == index)
@@ -0,0 +1,61 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from . import utils
+
+
+def fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="docserver-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.samples[fold_stack(frame)] += 1
+            time.sleep(self.interval)
+
+
+def render_folded(samples: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def profile_filename(route: str, user_id: Optional[str]) -> str:
+    route_tag = re.sub(r"[^0-9A-Za-z]+", "_", route).strip("_") or "root"
+    return (
+        f"{utils.format_timestamp(utils.gen_datetime())}-{route_tag}-{user_id or 'anonymous'}-{utils.gen_uuid()}.folded"
+    )
+
+
+def store_profile(output_dir: str, filename: str, samples: Counter):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, filename), "w") as fp:
+        fp.write(render_folded(samples))
@@ -0,0 +1,102 @@
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+from .metrics import registry
+
+query_seconds = registry.histogram("docserver_db_query_seconds", "Time spent executing SQL statements.", ("pool",))
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_seconds", "rows", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+        self.statements: Counter = Counter()
+
+    def record_query(self, statement: str, seconds: float):
+        self.queries += 1
+        self.query_seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated_statements(self, threshold: int):
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    def server_timing(self, total_seconds: float) -> str:
+        return (
+            f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries, {self.rows} rows", '
+            f"app;dur={total_seconds * 1000:.1f}"
+        )
+
+
+class CountingCursor:
+    """Proxies a DBAPI cursor and adds the rows each fetch returns to the request's count.
+
+    cursor.rowcount cannot stand in for it: it is -1 for SELECTs on several drivers and counts affected rows for DML.
+    """
+
+    __slots__ = ("_cursor", "_stats")
+
+    def __init__(self, cursor, stats: RequestStats):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_stats", stats)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats.rows += 1
+            yield row
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self._cursor, name, value)
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def attach_query_counter(engine: Engine, pool_name: str):
+    # keyed by execution context, so that a failed statement never hands its start time to the next one
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", {})[id(context)] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started_at"].pop(id(context))
+        query_seconds.observe(elapsed, pool=pool_name)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.record_query(statement, elapsed)
+            # the result reads rows through context.cursor, which is only set up after this event
+            if context is not None and cursor.description is not None:
+                context.cursor = CountingCursor(cursor, stats)
+
+    @event.listens_for(engine, "handle_error")
+    def discard_query_timer(exception_context):
+        conn = exception_context.connection
+        if conn is not None:
+            conn.info.get("query_started_at", {}).pop(id(exception_context.execution_context), None)
@@ -0,0 +1,309 @@
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Hashable, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from .cache import InvalidationBus, LocalCache, cache_hits, cache_misses
+
+logger = logging.getLogger(__name__)
+
+
+class RespError(Exception):
+    pass
+
+
+def parse_url(url: str) -> Tuple[str, int, int, Optional[str]]:
+    parsed = urlparse(url)
+    if parsed.scheme != "redis":
+        raise ValueError("cache url must start with redis://")
+    db = int(parsed.path.lstrip("/") or 0)
+    password = unquote(parsed.password) if parsed.password else None
+    return parsed.hostname or "localhost", parsed.port or 6379, db, password
+
+
+def encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, int):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+class RespConnection:
+    def __init__(self, url: str, timeout: Optional[float] = 5.0):
+        self.host, self.port, self.db, self.password = parse_url(url)
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._file = None
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile("rb")
+        if self.password is not None:
+            self.execute("AUTH", self.password)
+        if self.db:
+            self.execute("SELECT", self.db)
+
+    def send(self, *args):
+        if self._sock is None:
+            self.connect()
+        self._sock.sendall(encode_command(*args))
+
+    def execute(self, *args) -> Any:
+        self.send(*args)
+        return self.read_reply()
+
+    def read_reply(self) -> Any:
+        line = self._file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RespError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = self._file.read(size + 2)
+            if len(data) != size + 2:
+                raise ConnectionError("connection closed by server")
+            return data[:-2]
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [self.read_reply() for _ in range(size)]
+        raise RespError(f"unexpected reply {line!r}")
+
+    def close(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class RespClient:
+    def __init__(self, url: str, timeout: Optional[float] = 5.0):
+        self.url = url
+        self.timeout = timeout
+        self._connection: Optional[RespConnection] = None
+        self._lock = threading.Lock()
+
+    def execute(self, *args) -> Any:
+        with self._lock:
+            for attempt in range(2):
+                if self._connection is None:
+                    self._connection = RespConnection(self.url, self.timeout)
+                try:
+                    return self._connection.execute(*args)
+                except (OSError, ConnectionError):
+                    self._connection.close()
+                    self._connection = None
+                    if attempt == 1:
+                        raise
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def encode_key(key: Hashable) -> str:
+    return json.dumps(key, separators=(",", ":"))
+
+
+def decode_key(value: Any) -> Hashable:
+    if isinstance(value, list):
+        return tuple(decode_key(d) for d in value)
+    return value
+
+
+class RespCache(LocalCache):
+    """ByteLRUCache-compatible cache kept in a Redis-protocol server shared by all workers."""
+
+    blocking = True
+
+    def __init__(
+        self, client: RespClient, name: str = "default", max_entry_bytes: Optional[int] = None, prefix="docserver"
+    ):
+        self.client = client
+        self.name = name
+        self._max_entry_bytes = max_entry_bytes
+        self._prefix = f"{prefix}:{name}"
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self._prefix}:k:{encode_key(key)}"
+
+    def _tag(self, tag: Hashable) -> str:
+        return f"{self._prefix}:t:{encode_key(tag)}"
+
+    def _execute(self, *args) -> Any:
+        try:
+            return self.client.execute(*args)
+        except (OSError, ConnectionError, RespError):
+            logger.warning("cache %s: %s failed", self.name, args[0], exc_info=True)
+            return None
+
+    def get(self, key: Hashable, version: Any = None) -> Optional[bytes]:
+        value = self._execute("GET", self._key(key))
+        if value is not None:
+            entry_version, _, payload = value.partition(b"\n")
+            if entry_version.decode("utf-8") == ("" if version is None else str(version)):
+                cache_hits.inc(cache=self.name)
+                return payload
+        cache_misses.inc(cache=self.name)
+        return None
+
+    def __contains__(self, key: Hashable) -> bool:
+        return bool(self._execute("EXISTS", self._key(key)))
+
+    def set(
+        self,
+        key: Hashable,
+        payload: bytes,
+        version: Any = None,
+        ttl: Optional[float] = None,
+        tags: Tuple[Hashable, ...] = (),
+    ) -> bool:
+        if self._max_entry_bytes is not None and len(payload) > self._max_entry_bytes:
+            return False
+        value = ("" if version is None else str(version)).encode("utf-8") + b"\n" + payload
+        args: List[Any] = ["SET", self._key(key), value]
+        if ttl is not None:
+            args.extend(["PX", max(1, int(ttl * 1000))])
+        if self._execute(*args) is None:
+            return False
+        for tag in tags:
+            self._execute("SADD", self._tag(tag), self._key(key))
+        return True
+
+    def delete(self, key: Hashable, propagate: bool = True):
+        self._execute("DEL", self._key(key))
+
+    def delete_tagged(self, tag: Hashable, propagate: bool = True):
+        keys = self._execute("SMEMBERS", self._tag(tag)) or []
+        self._execute("DEL", self._tag(tag), *keys)
+
+    def clear(self, propagate: bool = True):
+        cursor = b"0"
+        while True:
+            res = self._execute("SCAN", cursor, "MATCH", f"{self._prefix}:*", "COUNT", 1000)
+            if res is None:
+                return
+            cursor, keys = res
+            if keys:
+                self._execute("DEL", *keys)
+            if cursor == b"0":
+                return
+
+
+class RespInvalidationBus(InvalidationBus):
+    """Publishes invalidations on a pub/sub channel and applies the ones other workers publish."""
+
+    def __init__(self, url: str, channel: str = "docserver:invalidate", retry_seconds: float = 1.0):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self.retry_seconds = retry_seconds
+        self.origin = uuid.uuid4().hex
+        self.client = RespClient(url)
+        self._subscriber: Optional[RespConnection] = None
+        self._stop = threading.Event()
+        self._subscribed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._outbox: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._publisher: Optional[threading.Thread] = None
+
+    def publish(self, name: str, op: str, *args):
+        """Queues the invalidation for the publisher thread; callers on the event loop never wait on the socket."""
+        message = json.dumps({"origin": self.origin, "cache": name, "op": op, "args": args}, separators=(",", ":"))
+        if self._publisher is None:
+            self._send(message)
+        else:
+            self._outbox.put(message)
+
+    def _send(self, message: str):
+        try:
+            self.client.execute("PUBLISH", self.channel, message)
+        except (OSError, ConnectionError, RespError):
+            logger.warning("failed to publish invalidation %s", message, exc_info=True)
+
+    def _run_publisher(self):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            self._send(message)
+
+    def receive(self, raw: bytes):
+        message = json.loads(raw)
+        if message.get("origin") == self.origin:
+            return
+        self.apply(message["cache"], message["op"], *(decode_key(d) for d in message.get("args", ())))
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="docserver-invalidation", daemon=True)
+        self._thread.start()
+        self._publisher = threading.Thread(
+            target=self._run_publisher, name="docserver-invalidation-publisher", daemon=True
+        )
+        self._publisher.start()
+
+    def wait_subscribed(self, timeout: Optional[float] = None) -> bool:
+        return self._subscribed.wait(timeout)
+
+    def close(self):
+        self._stop.set()
+        if self._publisher is not None:
+            # queued invalidations are still sent before the client closes
+            self._outbox.put(None)
+            self._publisher.join(timeout=5)
+            self._publisher = None
+        if self._subscriber is not None:
+            self._subscriber.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.client.close()
+
+    def _run(self):
+        first = True
+        while not self._stop.is_set():
+            try:
+                self._subscriber = RespConnection(self.url, timeout=None)
+                self._subscriber.execute("SUBSCRIBE", self.channel)
+                if not first:
+                    # messages published while we were disconnected are lost
+                    self.clear_all()
+                first = False
+                self._subscribed.set()
+                while not self._stop.is_set():
+                    reply = self._subscriber.read_reply()
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        self.receive(reply[2])
+            except (OSError, ConnectionError, RespError, ValueError, KeyError):
+                self._subscribed.clear()
+                if self._stop.is_set():
+                    break
+                logger.warning("invalidation bus disconnected; retrying", exc_info=True)
+                time.sleep(self.retry_seconds)
+            finally:
+                if self._subscriber is not None:
+                    self._subscriber.close()
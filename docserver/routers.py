@@ -1,72 +1,244 @@
+import json
 from datetime import timedelta
-from typing import Optional, Union
+from typing import List, Optional, Union
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import jwt
-from jose.exceptions import JWTError
 from pydantic import ValidationError
 from sqlalchemy.orm import Session
 
-from . import config, deps, models, operators, schema, types
+from . import (
+    archives,
+    cache,
+    compression,
+    config,
+    deps,
+    formats,
+    images,
+    jobs,
+    jsonpointer,
+    jsonstream,
+    models,
+    operators,
+    schema,
+    types,
+    utils,
+)
 
 
 def generate_router(
-    settings: config.Settings, session_handler: deps.SessionHandler, oauth2_scheme: OAuth2PasswordBearer
+    settings: config.Settings,
+    session_handler: deps.SessionHandler,
+    oauth2_scheme: OAuth2PasswordBearer,
+    api_key_cache: Optional[cache.TTLCache] = None,
+    response_cache: Optional[cache.ByteLRUCache] = None,
+    job_worker: Optional[jobs.Worker] = None,
+    image_renderer: Optional[images.DerivativeRenderer] = None,
 ):
     router = APIRouter()
+    ops = session_handler.operators
+    if api_key_cache is None:
+        api_key_cache = cache.TTLCache(settings.API_KEY_CACHE_SECONDS, settings.API_KEY_CACHE_SIZE)
+    if response_cache is None:
+        response_cache = cache.ByteLRUCache(
+            settings.RESPONSE_CACHE_MAX_BYTES, settings.RESPONSE_CACHE_MAX_ENTRY_BYTES, name="responses"
+        )
+    if image_renderer is None:
+        image_renderer = images.DerivativeRenderer(settings.IMAGE_DERIVATIVE_WORKERS)
+
+    def json_response(payload: bytes) -> Response:
+        return Response(payload, media_type=formats.json_media_type)
+
+    def render_json(model) -> bytes:
+        return json.dumps(
+            jsonable_encoder(model, by_alias=True), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+    def negotiated_response(
+        payload: bytes,
+        fmt: Optional[formats.BinaryFormat],
+        encoding: Optional[str] = None,
+        vary_encoding: bool = False,
+    ) -> Response:
+        """vary_encoding marks an uncompressed response that another Accept-Encoding would have compressed."""
+        media_type = formats.json_media_type if fmt is None else fmt.media_type
+        if encoding is None:
+            vary = "Accept, Accept-Encoding" if vary_encoding else "Accept"
+            return Response(payload, media_type=media_type, headers={"Vary": vary})
+        headers = {"Vary": "Accept, Accept-Encoding", "Content-Encoding": encoding}
+        return Response(payload, media_type=media_type, headers=headers)
+
+    async def encoded_item_response(
+        request: Request, key: tuple, payload: bytes, header, fmt: Optional[formats.BinaryFormat]
+    ) -> Response:
+        """Sends an item per Accept-Encoding, compressing each revision once per encoding through the cache."""
+        request.state.encoded = True
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding"))
+        compressible = settings.COMPRESSION_ENABLED and compression.is_compressible(header.data_type)
+        if not compressible or encoding is None or len(payload) < settings.COMPRESSION_MINIMUM_SIZE:
+            return negotiated_response(payload, fmt, vary_encoding=compressible)
+        encoded_key = (*key, encoding.name)
+        encoded = await response_cache.aget(encoded_key, version=header.updated_at)
+        if encoded is None:
+            encoded = await compression.compress(encoding, payload)
+            await response_cache.aset(
+                encoded_key, encoded, version=header.updated_at, tags=(header.collection_id, header.id)
+            )
+        return negotiated_response(encoded, fmt, encoding.name)
+
+    def binary_response(model, fmt: formats.BinaryFormat) -> Response:
+        return negotiated_response(fmt.dumps(jsonable_encoder(model, by_alias=True)), fmt)
+
+    def render_item(res, fmt: Optional[formats.BinaryFormat]) -> bytes:
+        if fmt is None:
+            return render_json(schema.ItemDetailResponse.from_orm(res))
+        document = jsonable_encoder(schema.ItemHeaderResponse.from_orm(res), by_alias=True)
+        document["body"] = item_body(res)
+        return fmt.dumps(document)
+
+    def item_body(res) -> bytes:
+        body = res.body
+        return body.decode_to_binary() if isinstance(body, types.Base64EncodedData) else bytes(body)
+
+    def request_too_large() -> HTTPException:
+        return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="request body is too large")
+
+    async def iter_limited_body(request: Request):
+        length = request.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > settings.ITEM_REQUEST_MAX_BYTES:
+            raise request_too_large()
+        received = 0
+        async for part in request.stream():
+            received += len(part)
+            if received > settings.ITEM_REQUEST_MAX_BYTES:
+                raise request_too_large()
+            yield part
+
+    async def parse_item_json(request: Request):
+        """Parses a JSON item request as it arrives, decoding the base64 body straight into chunks."""
+        parser = jsonstream.ItemJsonParser(models.chunk_size)
+        async for part in iter_limited_body(request):
+            parser.feed(part)
+        return parser.close()
+
+    def item_query(model):
+        async def parse(request: Request):
+            fmt = formats.content_format(request.headers.get("Content-Type"))
+            if fmt is None:
+                try:
+                    data = await parse_item_json(request)
+                except ValueError as e:
+                    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+            else:
+                raw = b"".join([d async for d in iter_limited_body(request)])
+                try:
+                    data = fmt.loads(raw)
+                except ValueError:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="malformed request body"
+                    )
+            if fmt is not None and isinstance(data, dict) and isinstance(data.get("body"), (bytes, bytearray)):
+                data["body"] = types.RawBinaryData(data["body"])
+            try:
+                return model.parse_obj(data)
+            except ValidationError as e:
+                raise RequestValidationError(e.raw_errors)
+
+        return parse
+
+    def item_request_body(model) -> dict:
+        content = {formats.json_media_type: {"schema": model.schema(by_alias=True)}}
+        for media_type in formats.binary_formats:
+            content[media_type] = {"schema": model.schema(by_alias=True)}
+        return {"requestBody": {"content": content, "required": True}}
+
+    async def get_user_by_api_key(db: Session, api_key: str):
+        digest = utils.calc_api_key_digest(api_key, settings.API_KEY_SECRET)
+        cached = api_key_cache.get(digest)
+        if cached is not None:
+            user, expires_at = cached
+            if expires_at is None or expires_at > utils.gen_datetime():
+                return user
+            api_key_cache.delete(digest)
+            return None
+        record = await ops.authenticate_api_key(db, api_key, digest)
+        if record is None:
+            return None
+        user = schema.UserRetrieveResponse.from_orm(record)
+        api_key_cache.set(digest, (user, record.expires_at))
+        return user
+
+    async def get_user_by_token(db: Session, token: str):
+        if utils.is_api_key(token):
+            return await get_user_by_api_key(db, token)
+        return await ops.get_user_by_access_token(db, token, settings.SECRET_KEY, settings.ALGORITHM)
 
-    async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(session_handler.get_db)):
-        user = operators.get_user_by_access_token(db, token, settings.SECRET_KEY, settings.ALGORITHM)
+    def ensure_authenticated(request: Request, user):
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid authentication credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        request.state.user_id = user.id
         return user
 
+    async def get_current_user(
+        request: Request, token: str = Depends(oauth2_scheme), db: Session = Depends(session_handler.get_db)
+    ):
+        return ensure_authenticated(request, await get_user_by_token(db, token))
+
+    async def get_current_reader(
+        request: Request, token: str = Depends(oauth2_scheme), db: Session = Depends(session_handler.get_read_db)
+    ):
+        user = await get_user_by_token(db, token)
+        if not user and session_handler.is_replica_session(db):
+            user = await session_handler.call_with_primary(get_user_by_token, token)
+        return ensure_authenticated(request, user)
+
     @router.post("/users", response_model=schema.UserRetrieveResponse)
-    def create_user(data: schema.UserCreateQuery, db: Session = Depends(session_handler.get_db)):
+    async def create_user(data: schema.UserCreateQuery, db: Session = Depends(session_handler.get_db)):
         try:
-            return operators.create_user(db, data)
+            return await ops.create_user(db, data)
         except ValueError as e:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
     @router.post("/token", response_model=schema.TokenResponse)
-    def get_token(
+    async def get_token(
         data: Union[schema.UserLoginQuery, schema.RefreshTokenQuery],
         db: Session = Depends(session_handler.get_db),
     ):
         if isinstance(data, schema.UserLoginQuery):
-            user = operators.authenticate_user(db, data)
+            user = await ops.authenticate_user(db, data)
             if not user:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Incorrect login_id or password",
                     headers={"WWW-Authenticate": "Bearer"},
                 )
-            refresh_token = operators.get_or_create_refresh_token(
+            user_id = user.id
+            refresh_token = await ops.create_refresh_token(
                 db,
-                user_id=user.id,
-                expires_delta=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
-                secret_key=settings.SECRET_KEY,
-                algorithm=settings.ALGORITHM,
+                user_id=user_id,
+                expires_delta=timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES),
             )
         else:
-            user = operators.get_user_by_refresh_token(
-                db, data.refresh_token, secret_key=settings.SECRET_KEY, algorithm=settings.ALGORITHM
+            rotated = await ops.rotate_refresh_token(
+                db, data.refresh_token, expires_delta=timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES)
             )
-            if not user:
+            if rotated is None:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid authentication credentials",
                     headers={"WWW-Authenticate": "Bearer"},
                 )
-            refresh_token = data.refresh_token
+            user_id, refresh_token = rotated
 
         access_token = operators.create_access_token(
-            data={"sub": f"userId:{user.id}"},
+            data={"sub": f"userId:{user_id}"},
             expires_delta=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
             secret_key=settings.SECRET_KEY,
             algorithm=settings.ALGORITHM,
@@ -74,10 +246,10 @@ def generate_router(
         return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
     @router.post("/login", response_model=schema.LoginResponse)
-    def login_by_password(
+    async def login_by_password(
         db: Session = Depends(session_handler.get_db), form_data: OAuth2PasswordRequestForm = Depends()
     ):
-        user = operators.authenticate_user(
+        user = await ops.authenticate_user(
             db, schema.UserLoginQuery(login_id=form_data.username, password=form_data.password)
         )
         if user is None:
@@ -86,12 +258,10 @@ def generate_router(
                 detail="Incorrect login_id or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        refresh_token = operators.get_or_create_refresh_token(
+        refresh_token = await ops.create_refresh_token(
             db,
             user_id=user.id,
-            expires_delta=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
-            secret_key=settings.SECRET_KEY,
-            algorithm=settings.ALGORITHM,
+            expires_delta=timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES),
         )
         access_token = operators.create_access_token(
             data={"sub": f"userId:{user.id}"},
@@ -102,8 +272,8 @@ def generate_router(
         return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
     @router.get("/users/me", response_model=schema.UserRetrieveResponse)
-    def get_users_me(
-        db: Session = Depends(session_handler.get_db), current_user: models.User = Depends(get_current_user)
+    async def get_users_me(
+        db: Session = Depends(session_handler.get_read_db), current_user: models.User = Depends(get_current_reader)
     ):
         if current_user is None:
             raise HTTPException(
@@ -119,119 +289,436 @@ def generate_router(
             updated_at=current_user.updated_at,
         )
 
+    @router.post("/users/me/api-keys", response_model=schema.ApiKeyCreateResponse)
+    async def create_api_key(
+        data: schema.ApiKeyCreateQuery,
+        db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_user),
+    ):
+        return await ops.create_api_key(db, current_user, data, settings.API_KEY_SECRET)
+
+    @router.get("/users/me/api-keys", response_model=List[schema.ApiKeyRetrieveResponse])
+    async def list_api_keys(
+        db: Session = Depends(session_handler.get_read_db), current_user: models.User = Depends(get_current_reader)
+    ):
+        return await ops.list_api_keys(db, current_user)
+
+    @router.delete("/users/me/api-keys/{api_key_id}")
+    async def delete_api_key(
+        api_key_id: schema.ShortUUID,
+        db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_user),
+    ):
+        res = await ops.delete_api_key(db, current_user, api_key_id)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such api key")
+        api_key_cache.delete(res)
+
     @router.post("/collections", response_model=schema.CollectionRetrieveResponse)
-    def create_collection(
+    async def create_collection(
         data: schema.CollectionCreateQuery,
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
-        return operators.create_collection(db, data, current_user)
+        return await ops.create_collection(db, data, current_user)
 
     @router.put("/collections/{collection_id}", response_model=schema.CollectionRetrieveResponse)
-    def update_collection(
+    async def update_collection(
         collection_id: schema.ShortUUID,
         data: schema.CollectionUpdateQuery,
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
-        res = operators.update_collection(db, current_user, collection_id, data)
+        res = await ops.update_collection(db, current_user, collection_id, data)
+        await response_cache.adelete(("collection", collection_id))
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
+        return schema.CollectionRetrieveResponse.from_orm(res)
+
+    @router.post("/collections/{collection_id}:clone", response_model=schema.CollectionRetrieveResponse)
+    async def clone_collection(
+        collection_id: schema.ShortUUID,
+        data: Optional[schema.CollectionCloneQuery] = None,
+        db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_user),
+    ):
+        name = data.name if data is not None else None
+        res = await ops.clone_collection(db, current_user, collection_id, name, settings.ITEM_CLONE_BATCH_SIZE)
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
         return schema.CollectionRetrieveResponse.from_orm(res)
 
+    async def enqueue_job(db: Session, response: Response, current_user: models.User, kind: str, **params):
+        res = await ops.create_job(db, current_user, kind, params, max_attempts=settings.JOBS_MAX_ATTEMPTS)
+        if job_worker is not None:
+            job_worker.wake()
+        response.status_code = status.HTTP_202_ACCEPTED
+        response.headers["Location"] = f"{settings.API_V1_STR}/jobs/{res.id}"
+        return schema.JobRetrieveResponse.from_orm(res)
+
     @router.delete("/collections/{collection_id}")
-    def delete_collection(
+    async def delete_collection(
         collection_id: schema.ShortUUID,
+        response: Response,
+        background: bool = False,
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
-        res = operators.delete_collection(db, current_user, collection_id)
+        if background:
+            if await ops.retrieve_collection(db, current_user, collection_id=collection_id) is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
+            await response_cache.adelete(("collection", collection_id))
+            await response_cache.adelete_tagged(collection_id)
+            return await enqueue_job(
+                db,
+                response,
+                current_user,
+                "delete_collection",
+                collection_id=collection_id,
+                batch_size=settings.JOBS_DELETE_BATCH_SIZE,
+            )
+        res = await ops.delete_collection(db, current_user, collection_id)
+        await response_cache.adelete(("collection", collection_id))
+        await response_cache.adelete_tagged(collection_id)
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
 
     @router.get("/collections", response_model=schema.CollectionListResponse)
-    def list_collections(
+    async def list_collections(
         cursor: Optional[types.EncodedCursor] = None,
-        db: Session = Depends(session_handler.get_db),
-        current_user: models.User = Depends(get_current_user),
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
     ):
-        return operators.list_collections(db, current_user, cursor=cursor)
+        return await ops.list_collections(db, current_user, cursor=cursor)
 
     @router.get("/collections/{collection_id}", response_model=schema.CollectionRetrieveResponse)
-    def retrieve_collection(
+    async def retrieve_collection(
+        collection_id: schema.ShortUUID,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        res = await ops.retrieve_collection(db, current_user, collection_id=collection_id)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
+        # versioned like items, so that a payload rendered from a row read before a concurrent update never matches
+        key = ("collection", collection_id)
+        payload = await response_cache.aget(key, version=res.updated_at)
+        if payload is None:
+            payload = render_json(schema.CollectionRetrieveResponse.from_orm(res))
+            await response_cache.aset(key, payload, version=res.updated_at, tags=(collection_id,))
+        return json_response(payload)
+
+    @router.get("/collections/{collection_id}/archive")
+    async def retrieve_collection_archive(
         collection_id: schema.ShortUUID,
+        format: str = Query("tar", regex=f"^({'|'.join(archives.writers)})$"),
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        if await ops.retrieve_collection(db, current_user, collection_id=collection_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
+        return StreamingResponse(
+            session_handler.stream_operator(db, "stream_collection_archive", current_user, collection_id, format),
+            media_type=archives.writers[format].media_type,
+            headers={"Content-Disposition": f'attachment; filename="{collection_id}.{format}"'},
+        )
+
+    @router.post("/collections/{collection_id}/archive", response_model=schema.ItemImportResponse)
+    async def import_collection_archive(
+        collection_id: schema.ShortUUID,
+        request: Request,
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
-        res = operators.retrieve_collection(db, current_user, collection_id=collection_id)
+        try:
+            res = await ops.import_items(
+                db,
+                current_user,
+                collection_id,
+                session_handler.body_stream(request),
+                batch_items=settings.ITEM_IMPORT_BATCH_ITEMS,
+                batch_bytes=settings.ITEM_IMPORT_BATCH_BYTES,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
-        return schema.CollectionRetrieveResponse.from_orm(res)
+        return {"count": len(res), "results": res}
 
     @router.get("/collections/{collection_id}/items", response_model=schema.ItemListResponse)
-    def list_items(
+    async def list_items(
         collection_id: schema.ShortUUID,
+        request: Request,
         cursor: Optional[types.EncodedCursor] = None,
-        db: Session = Depends(session_handler.get_db),
-        current_user: models.User = Depends(get_current_user),
+        contains: Optional[str] = None,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
     ):
-        res = operators.list_items(db, current_user, collection_id, cursor=cursor)
+        if contains is not None:
+            try:
+                contains = json.loads(contains)
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="contains must be JSON")
+        try:
+            res = await ops.list_items(db, current_user, collection_id, cursor=cursor, contains=contains)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
-        return res
+        fmt = formats.negotiate(request.headers.get("Accept"))
+        if fmt is None:
+            return res
+        return binary_response(schema.ItemListResponse.parse_obj(res), fmt)
 
-    @router.post("/collections/{collection_id}/items", response_model=schema.ItemHeaderResponse)
-    def create_item(
+    @router.post(
+        "/collections/{collection_id}/items",
+        response_model=schema.ItemHeaderResponse,
+        openapi_extra=item_request_body(schema.ItemCreateQuery),
+    )
+    async def create_item(
         collection_id: schema.ShortUUID,
-        data: schema.ItemCreateQuery,
+        request: Request,
+        data: schema.ItemCreateQuery = Depends(item_query(schema.ItemCreateQuery)),
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
         try:
-            res = operators.create_item(db, current_user, collection_id, data)
+            res = await ops.create_item(db, current_user, collection_id, data)
         except ValueError:
             raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="invalid data")
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
-        return res
+        fmt = formats.negotiate(request.headers.get("Accept"))
+        if fmt is None:
+            return res
+        return binary_response(schema.ItemHeaderResponse.from_orm(res), fmt)
 
     @router.get("/collections/{collection_id}/items/{item_id}", response_model=schema.ItemDetailResponse)
-    def retrieve_item(
+    async def retrieve_item(
         collection_id: schema.ShortUUID,
         item_id: schema.ShortUUID,
-        db: Session = Depends(session_handler.get_db),
-        current_user: models.User = Depends(get_current_user),
+        request: Request,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        fmt = formats.negotiate(request.headers.get("Accept"))
+        key = ("item", item_id) if fmt is None else ("item", item_id, fmt.media_type)
+        if await response_cache.acontains(key):
+            header = await ops.retrieve_item_header(db, current_user, collection_id, item_id)
+            if header is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+            payload = await response_cache.aget(key, version=header.updated_at)
+            if payload is not None:
+                return await encoded_item_response(request, key, payload, header, fmt)
+        res = await ops.retrieve_item(db, current_user, collection_id, item_id)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+        payload = render_item(res, fmt)
+        await response_cache.aset(key, payload, version=res.updated_at, tags=(collection_id, item_id))
+        return await encoded_item_response(request, key, payload, res, fmt)
+
+    @router.get("/collections/{collection_id}/items/{item_id}/document")
+    async def retrieve_item_document(
+        collection_id: schema.ShortUUID,
+        item_id: schema.ShortUUID,
+        pointer: str = "",
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        try:
+            path = jsonpointer.parse_pointer(pointer)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        key = ("document", item_id, pointer)
+        if await response_cache.acontains(key):
+            header = await ops.retrieve_item_header(db, current_user, collection_id, item_id)
+            if header is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+            payload = await response_cache.aget(key, version=header.updated_at)
+            if payload is not None:
+                return json_response(payload)
+        try:
+            res = await ops.retrieve_item_document(db, current_user, collection_id, item_id, path)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e))
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+        if res.value is jsonpointer.missing:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such JSON pointer")
+        payload = json.dumps(res.value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        await response_cache.aset(key, payload, version=res.updated_at, tags=(collection_id, item_id))
+        return json_response(payload)
+
+    @router.get("/collections/{collection_id}/items/{item_id}/derivative")
+    async def retrieve_item_derivative(
+        collection_id: schema.ShortUUID,
+        item_id: schema.ShortUUID,
+        w: int = Query(..., ge=1, le=settings.IMAGE_DERIVATIVE_MAX_WIDTH),
+        format: str = Query("webp", regex=f"^({'|'.join(images.derivative_formats)})$"),
+        db: Session = Depends(session_handler.get_read_db),
+        primary_db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_reader),
     ):
-        res = operators.retrieve_item(db, current_user, collection_id, item_id)
+        variant = images.variant_name(w, format)
+        media_type = images.derivative_formats[format]
+        key = ("derivative", item_id, variant)
+        if await response_cache.acontains(key):
+            header = await ops.retrieve_item_header(db, current_user, collection_id, item_id)
+            if header is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+            payload = await response_cache.aget(key, version=header.updated_at)
+            if payload is not None:
+                return Response(payload, media_type=media_type)
+        res = await ops.retrieve_item_derivative(db, current_user, collection_id, item_id, variant)
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
-        return schema.ItemDetailResponse.from_orm(res)
+        if res.data_type not in images.source_data_types:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="item is not an image")
+        payload = res.body
+        if payload is None:
+
+            async def load_body() -> bytes:
+                item = await ops.retrieve_item(db, current_user, collection_id, item_id)
+                if item is None:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+                return item_body(item)
+
+            try:
+                payload = await image_renderer.render((item_id, res.updated_at, variant), load_body, w, format)
+            except ImportError:
+                raise HTTPException(
+                    status_code=status.HTTP_501_NOT_IMPLEMENTED, detail="image derivatives require Pillow"
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+            await ops.store_item_derivative(primary_db, item_id, variant, res.updated_at, media_type, payload)
+        payload = bytes(payload)
+        await response_cache.aset(key, payload, version=res.updated_at, tags=(collection_id, item_id))
+        return Response(payload, media_type=media_type)
 
-    @router.put("/collections/{collection_id}/items/{item_id}", response_model=schema.ItemHeaderResponse)
-    def retrieve_item(
+    @router.put(
+        "/collections/{collection_id}/items/{item_id}",
+        response_model=schema.ItemHeaderResponse,
+        openapi_extra=item_request_body(schema.ItemUpdateQuery),
+    )
+    async def update_item(
         collection_id: schema.ShortUUID,
         item_id: schema.ShortUUID,
-        data: schema.ItemUpdateQuery,
+        request: Request,
+        data: schema.ItemUpdateQuery = Depends(item_query(schema.ItemUpdateQuery)),
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
         try:
-            res = operators.update_item(db, current_user, collection_id, item_id, data)
+            res = await ops.update_item(db, current_user, collection_id, item_id, data)
         except ValueError:
             raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="invalid data")
+        await response_cache.adelete_tagged(item_id)
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+        fmt = formats.negotiate(request.headers.get("Accept"))
+        if fmt is None:
+            return schema.ItemHeaderResponse.from_orm(res)
+        return binary_response(schema.ItemHeaderResponse.from_orm(res), fmt)
+
+    @router.post("/collections/{collection_id}/items/{item_id}:copy", response_model=schema.ItemHeaderResponse)
+    async def copy_item(
+        collection_id: schema.ShortUUID,
+        item_id: schema.ShortUUID,
+        data: Optional[schema.ItemCopyQuery] = None,
+        db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_user),
+    ):
+        target = data.collection_id if data is not None and data.collection_id is not None else collection_id
+        res = await ops.copy_item(db, current_user, collection_id, item_id, target, settings.ITEM_CLONE_BATCH_SIZE)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item or collection")
         return schema.ItemHeaderResponse.from_orm(res)
 
+    @router.get("/collections/{collection_id}/items/{item_id}/versions", response_model=schema.ItemVersionListResponse)
+    async def list_item_versions(
+        collection_id: schema.ShortUUID,
+        item_id: schema.ShortUUID,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        res = await ops.list_item_versions(db, current_user, collection_id, item_id)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
+        return {"results": res}
+
+    @router.get(
+        "/collections/{collection_id}/items/{item_id}/versions/{version}",
+        response_model=schema.ItemVersionDetailResponse,
+    )
+    async def retrieve_item_version(
+        collection_id: schema.ShortUUID,
+        item_id: schema.ShortUUID,
+        version: int,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        header = await ops.retrieve_item_version_header(db, current_user, collection_id, item_id, version)
+        if header is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such version")
+        return StreamingResponse(
+            session_handler.stream_operator(db, "stream_item_version", header), media_type=formats.json_media_type
+        )
+
     @router.delete("/collections/{collection_id}/items/{item_id}")
-    def delete_item(
+    async def delete_item(
         collection_id: schema.ShortUUID,
         item_id: schema.ShortUUID,
         db: Session = Depends(session_handler.get_db),
         current_user: models.User = Depends(get_current_user),
     ):
-        res = operators.delete_item(db, current_user, collection_id, item_id)
+        res = await ops.delete_item(db, current_user, collection_id, item_id)
+        await response_cache.adelete_tagged(item_id)
         if res is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such item")
 
+    async def search_response(request: Request, db: Session, current_user: models.User, **kwargs):
+        try:
+            res = await ops.search_items(db, current_user, **kwargs)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such collection")
+        fmt = formats.negotiate(request.headers.get("Accept"))
+        if fmt is None:
+            return res
+        return binary_response(schema.ItemSearchResponse.parse_obj(res), fmt)
+
+    @router.get("/search", response_model=schema.ItemSearchResponse)
+    async def search_items(
+        q: str,
+        request: Request,
+        cursor: Optional[types.EncodedCursor] = None,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        return await search_response(request, db, current_user, query=q, cursor=cursor)
+
+    @router.get("/collections/{collection_id}/search", response_model=schema.ItemSearchResponse)
+    async def search_collection_items(
+        collection_id: schema.ShortUUID,
+        q: str,
+        request: Request,
+        cursor: Optional[types.EncodedCursor] = None,
+        db: Session = Depends(session_handler.get_read_db),
+        current_user: models.User = Depends(get_current_reader),
+    ):
+        return await search_response(request, db, current_user, query=q, collection_id=collection_id, cursor=cursor)
+
+    @router.get("/jobs/{job_id}", response_model=schema.JobRetrieveResponse)
+    async def retrieve_job(
+        job_id: schema.ShortUUID,
+        db: Session = Depends(session_handler.get_db),
+        current_user: models.User = Depends(get_current_user),
+    ):
+        res = await ops.retrieve_job(db, current_user, job_id)
+        if res is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such job")
+        return schema.JobRetrieveResponse.from_orm(res)
+
     return router
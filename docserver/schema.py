@@ -1,16 +1,17 @@
 import re
 from datetime import datetime
 from json import JSONEncoder
-from typing import Any, List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 from humps import camelize
 from passlib.context import CryptContext
-from pydantic import BaseModel, EmailStr, SecretStr, constr
+from pydantic import BaseModel, EmailStr, SecretStr, conint, constr
 from pydantic.generics import GenericModel
 
 from docserver import utils
 
-from .types import Base64EncodedData, DataTypeString, EncodedCursor
+from .metrics import registry
+from .types import Base64EncodedData, BinaryData, DataTypeString, EncodedCursor
 
 password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -34,6 +35,11 @@ UsernameString = constr(regex=r"^[a-zA-Z][0-9a-zA-Z_-]{2,31}$")
 ShortUUID = constr(regex=r"^[0-9a-zA-Z]{22}$")
 
 
+password_verify_seconds = registry.histogram(
+    "docserver_password_verify_seconds", "Time spent verifying password hashes."
+)
+
+
 class PasswordString(SecretStr):
     @classmethod
     def validate(cls, value: Any) -> 'PasswordString':
@@ -53,7 +59,8 @@ class PasswordString(SecretStr):
         return _get_hashed_value(self.get_secret_value())
 
     def verify_with_hashed_value(self, hashed_password: str) -> bool:
-        return _verify_password(self.get_secret_value(), hashed_password)
+        with password_verify_seconds.time():
+            return _verify_password(self.get_secret_value(), hashed_password)
 
 
 class UserCreateQuery(GenericCamelModel):
@@ -70,16 +77,29 @@ class CollectionUpdateQuery(CollectionCreateQuery):
     ...
 
 
+class CollectionCloneQuery(GenericCamelModel):
+    name: Optional[str]
+
+
 class ItemCreateQuery(GenericCamelModel):
-    body: Base64EncodedData
+    body: BinaryData
     data_type: DataTypeString
 
 
+class ItemCopyQuery(GenericCamelModel):
+    collection_id: Optional[ShortUUID]
+
+
 class ItemUpdateQuery(GenericCamelModel):
-    body: Optional[Base64EncodedData]
+    body: Optional[BinaryData]
     data_type: Optional[DataTypeString]
 
 
+class ApiKeyCreateQuery(GenericCamelModel):
+    name: constr(min_length=1, max_length=64)
+    expires_in_days: Optional[conint(gt=0)]
+
+
 class UserLoginQuery(GenericCamelModel):
     login_id: Union[UsernameString, EmailStr]
     password: PasswordString
@@ -131,6 +151,21 @@ class LoginResponse(BaseModel):
     refresh_token: str
 
 
+class ApiKeyRetrieveResponse(GenericCamelModel):
+    id: ShortUUID
+    name: str
+    prefix: str
+    expires_at: Optional[datetime]
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class ApiKeyCreateResponse(ApiKeyRetrieveResponse):
+    api_key: str
+
+
 class CollectionRetrieveResponse(GenericCamelModel):
     id: ShortUUID
     name: str
@@ -158,6 +193,38 @@ class ItemDetailResponse(ItemHeaderResponse):
     body: Base64EncodedData
 
 
+class ItemVersionResponse(GenericCamelModel):
+    version: int
+    item_id: ShortUUID
+    data_type: DataTypeString
+    size: int
+    updated_at: datetime
+    archived_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class ItemVersionDetailResponse(ItemVersionResponse):
+    body: Base64EncodedData
+
+
+class ItemVersionListResponse(GenericCamelModel):
+    results: List[ItemVersionResponse]
+
+
+class ItemImportResult(GenericCamelModel):
+    name: str
+    id: ShortUUID
+    data_type: DataTypeString
+    size: int
+
+
+class ItemImportResponse(GenericCamelModel):
+    count: int
+    results: List[ItemImportResult]
+
+
 class CollectionListMeta(GenericCamelModel):
     count: int
     next_cursor: Optional[EncodedCursor]
@@ -180,6 +247,35 @@ class ItemListResponse(GenericCamelModel):
     results: List[ItemHeaderResponse]
 
 
+class ItemSearchResult(ItemHeaderResponse):
+    rank: float
+
+
+class ItemSearchMeta(GenericCamelModel):
+    count: int
+    next_cursor: Optional[EncodedCursor]
+
+
+class ItemSearchResponse(GenericCamelModel):
+    meta: ItemSearchMeta
+    results: List[ItemSearchResult]
+
+
+class JobRetrieveResponse(GenericCamelModel):
+    id: ShortUUID
+    kind: str
+    status: str
+    progress: float
+    attempts: int
+    error: Optional[str]
+    result: Optional[Dict[str, Any]]
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
 class DocServerJSONEncoder(JSONEncoder):
     def default(self, o):
         if isinstance(o, SecretStr):
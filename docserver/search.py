@@ -0,0 +1,102 @@
+import json
+import math
+import re
+from collections import Counter
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional
+
+text_search_config = "simple"
+search_text_max_chars = 256 * 1024
+term_max_length = 64
+term_weight_scale = 1000
+
+markup_data_types = ("text/html", "text/xml", "application/xml", "application/xhtml+xml")
+term_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def is_searchable(data_type: Optional[str]) -> bool:
+    if data_type is None:
+        return False
+    return (
+        data_type.startswith("text/")
+        or data_type == "application/json"
+        or data_type in markup_data_types
+        or data_type.endswith("+xml")
+    )
+
+
+class MarkupTextExtractor(HTMLParser):
+    skipped_tags = ("script", "style")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped_tags:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped_tags and self._skipping > 0:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if self._skipping == 0:
+            self.parts.append(data)
+
+
+def json_strings(value: Any):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield k
+            yield from json_strings(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from json_strings(v)
+    elif value is not None and not isinstance(value, bool):
+        yield str(value)
+
+
+def extract_text(data_type: Optional[str], body: Optional[bytes]) -> Optional[str]:
+    """Searchable text of an item body; None when the data type is not indexed."""
+    if body is None or not is_searchable(data_type):
+        return None
+    text = body.decode("utf-8", errors="replace")
+    if data_type == "application/json":
+        try:
+            text = " ".join(json_strings(json.loads(text)))
+        except ValueError:
+            pass
+    elif data_type in markup_data_types or data_type.endswith("+xml"):
+        parser = MarkupTextExtractor()
+        parser.feed(text)
+        parser.close()
+        text = " ".join(parser.parts)
+    return text[:search_text_max_chars].replace("\x00", " ")
+
+
+def tokenize(text: str) -> List[str]:
+    return [d for d in term_pattern.findall(text.lower()) if len(d) <= term_max_length]
+
+
+def term_weights(text: Optional[str]) -> Dict[str, int]:
+    """Log-scaled term frequencies as integers, so that summed ranks compare exactly across pages."""
+    if not text:
+        return {}
+    return {k: round(term_weight_scale * (1 + math.log(v))) for k, v in Counter(tokenize(text)).items()}
+
+
+def query_terms(query: str) -> List[str]:
+    return sorted(set(tokenize(query)))
+
+
+def format_search_cursor_value(rank: float, cursor_value: str) -> str:
+    return f"{rank!r}|{cursor_value}"
+
+
+def parse_search_cursor_value(value: str):
+    rank, _, cursor_value = value.partition("|")
+    return float(rank), cursor_value
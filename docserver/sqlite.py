@@ -0,0 +1,172 @@
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import event, func, insert, literal_column, select
+from sqlalchemy.engine import Result
+from sqlalchemy.engine.base import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import Delete, Insert, Update
+
+from . import models
+
+blob_block_size = 1024 * 1024
+
+
+def is_sqlite_uri(database_uri: Any) -> bool:
+    return str(database_uri).startswith("sqlite")
+
+
+def is_sqlite_session(db: Session) -> bool:
+    return db.get_bind().dialect.name == "sqlite"
+
+
+def configure_engine(engine: Engine, writer: bool, mmap_size: int, busy_timeout_ms: int):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+            if not writer:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if writer else "BEGIN")
+
+
+def raw_connection(db: Session):
+    return db.connection().connection.dbapi_connection
+
+
+def has_blob_io(raw) -> bool:
+    # sqlite3.Connection.blobopen is new in Python 3.11
+    return hasattr(raw, "blobopen")
+
+
+def without_returning(statement):
+    plain = statement._generate()
+    plain._returning = ()
+    return plain
+
+
+def execute_returning(db: Session, statement) -> Result:
+    """Runs an INSERT, UPDATE or DELETE ... RETURNING, which SQLAlchemy 1.4 cannot compile for SQLite.
+
+    The affected rows are found by rowid; the writer's BEGIN IMMEDIATE transaction keeps them stable in between.
+    """
+    table = statement.table
+    rowid = literal_column(f"{table.name}.rowid")
+    columns = select(*statement.exported_columns)
+    if isinstance(statement, Insert):
+        res = db.execute(without_returning(statement))
+        rowids = [res.lastrowid] if res.rowcount > 0 else []
+        return db.execute(columns.where(rowid.in_(rowids)))
+    if not isinstance(statement, (Update, Delete)):
+        raise TypeError(f"RETURNING cannot be emulated for {type(statement).__name__}")
+    rowids = db.execute(select(rowid).select_from(table).where(statement.whereclause)).scalars().all()
+    if isinstance(statement, Delete):
+        deleted = db.execute(columns.where(rowid.in_(rowids))).freeze()
+        db.execute(without_returning(statement).where(rowid.in_(rowids)))
+        return deleted()
+    db.execute(without_returning(statement).where(rowid.in_(rowids)))
+    return db.execute(columns.where(rowid.in_(rowids)))
+
+
+def insert_chunks(db: Session, rows: List[Dict[str, Any]]):
+    raw = raw_connection(db)
+    if not has_blob_io(raw):
+        db.execute(insert(models.Chunk), rows)
+        return
+    for row in rows:
+        body = row["body"]
+        rowid = db.execute(
+            insert(models.Chunk).values(
+                id=row["id"],
+                item_id=row["item_id"],
+                index=row["index"],
+                body=func.zeroblob(len(body)),
+                digest=row["digest"],
+            )
+        ).lastrowid
+        view = memoryview(body)
+        with raw.blobopen(models.Chunk.__tablename__, "body", rowid) as blob:
+            for i in range(0, len(view), blob_block_size):
+                blob.write(view[i : i + blob_block_size])
+
+
+def chunk_blobs_statement(item_id: str):
+    return (
+        select(
+            literal_column(f"{models.Chunk.__tablename__}.rowid"),
+            func.length(models.Chunk.stored_body),
+            models.Chunk.digest,
+        )
+        .where(models.Chunk.item_id == item_id)
+        .order_by(models.Chunk.index)
+    )
+
+
+def shared_blob(db: Session, digest: str) -> Tuple[str, int, int]:
+    data = db.execute(
+        select(literal_column("rowid"), func.length(models.ChunkData.body)).where(models.ChunkData.digest == digest)
+    ).first()
+    if data is not None:
+        return (models.ChunkData.__tablename__, *data)
+    rowid, size = db.execute(
+        select(literal_column("rowid"), func.length(models.Chunk.stored_body))
+        .where(models.Chunk.digest == digest, models.Chunk.stored_body.isnot(None))
+        .limit(1)
+    ).one()
+    return (models.Chunk.__tablename__, rowid, size)
+
+
+def chunk_blobs(db: Session, item_id: str) -> List[Tuple[str, int, int]]:
+    """Table, rowid and size of each chunk body: the chunk row itself, or wherever a copy finds it by digest."""
+    blobs = []
+    for rowid, size, digest in db.execute(chunk_blobs_statement(item_id)).all():
+        if size is not None:
+            blobs.append((models.Chunk.__tablename__, rowid, size))
+        else:
+            blobs.append(shared_blob(db, digest))
+    return blobs
+
+
+def read_chunks(db: Session, item_id: str) -> bytearray:
+    raw = raw_connection(db)
+    if not has_blob_io(raw):
+        return bytearray().join(iter_chunks(db, item_id))
+    blobs = chunk_blobs(db, item_id)
+    buf = bytearray(sum(size for _, _, size in blobs))
+    view = memoryview(buf)
+    offset = 0
+    for table, rowid, size in blobs:
+        if size == 0:
+            continue
+        with raw.blobopen(table, "body", rowid, readonly=True) as blob:
+            for i in range(0, size, blob_block_size):
+                block = blob.read(blob_block_size)
+                view[offset : offset + len(block)] = block
+                offset += len(block)
+    return buf
+
+
+def iter_chunks(db: Session, item_id: str) -> Iterator[bytes]:
+    raw = raw_connection(db)
+    if not has_blob_io(raw):
+        chunks = select(models.Chunk.body).where(models.Chunk.item_id == item_id).order_by(models.Chunk.index)
+        for body in db.execute(chunks).scalars():
+            if body:
+                yield body
+        return
+    for table, rowid, size in chunk_blobs(db, item_id):
+        if size == 0:
+            continue
+        with raw.blobopen(table, "body", rowid, readonly=True) as blob:
+            for _ in range(0, size, blob_block_size):
+                yield blob.read(blob_block_size)
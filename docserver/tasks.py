@@ -0,0 +1,37 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from . import utils
+from .deps import SessionHandler
+
+logger = logging.getLogger(__name__)
+
+
+async def sweep_expired_refresh_tokens(session_handler: SessionHandler) -> int:
+    return await session_handler.call_operator("delete_expired_refresh_tokens")
+
+
+async def prune_item_versions(
+    session_handler: SessionHandler, keep: int, max_age_days: Optional[float], batch_size: int
+) -> int:
+    before = None if max_age_days is None else utils.gen_datetime() - timedelta(days=max_age_days)
+    total = 0
+    while True:
+        res = await session_handler.call_operator("prune_item_versions", keep, before, batch_size)
+        total += res
+        if res < batch_size:
+            break
+    while await session_handler.call_operator("prune_chunk_data", batch_size) == batch_size:
+        pass
+    return total
+
+
+async def run_periodically(interval: float, func, *args):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func(*args)
+        except Exception:
+            logger.exception("periodic task %s failed", func.__name__)
@@ -1,7 +1,7 @@
 import binascii
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 from logging.config import valid_ident
-from typing import Any
+from typing import Any, Dict, List, Union
 
 from . import utils
 
@@ -74,13 +74,70 @@ class Base64EncodedData(str):
             return v.encode_to_b64encoded_data()
         if isinstance(v, bytes):
             return RawBinaryData(v).encode_to_b64encoded_data()
+        if isinstance(v, (bytearray, memoryview)):
+            return cls(urlsafe_b64encode(v).decode("utf-8"))
         return cls(v)
 
 
 class RawBinaryData(bytes):
+    """Body of a msgpack or CBOR request, which carries bytes natively."""
+
     def encode_to_b64encoded_data(self) -> Base64EncodedData:
         return urlsafe_b64encode(self).decode("utf-8")
 
+    def decode_to_binary(self) -> bytes:
+        return bytes(self)
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v: Any):
+        if not isinstance(v, RawBinaryData):
+            raise TypeError("raw binary data expected")
+        return v
+
+
+class ChunkedBinaryData:
+    """Body decoded by the streaming JSON parser, kept as the chunk-sized buffers it was decoded into."""
+
+    def __init__(self, chunks: List[Union[bytes, bytearray]], size: int):
+        self.chunks = chunks
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def decode_to_binary(self) -> "ChunkedBinaryData":
+        return self
+
+    def prefix(self, limit: int) -> bytes:
+        res = bytearray()
+        for chunk in self.chunks:
+            if len(res) >= limit:
+                break
+            res += memoryview(chunk)[: limit - len(res)]
+        return bytes(res)
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v: Any):
+        if not isinstance(v, ChunkedBinaryData):
+            raise TypeError("chunked binary data expected")
+        return v
+
+    @classmethod
+    def __modify_schema__(cls, field_schema: Dict[str, Any]):
+        field_schema.update(type="string", format="binary")
+
+
+# request bodies: base64 text from JSON, or bytes already decoded by the streaming parser or a binary format
+BinaryData = Union[ChunkedBinaryData, RawBinaryData, Base64EncodedData]
+
 
 class DataTypeString(str):
     valid_types = set(
@@ -1,8 +1,11 @@
 import hashlib
+import hmac
+import secrets
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime
 from random import choices, shuffle
 from string import ascii_lowercase, ascii_uppercase, digits
+from typing import Optional
 
 import shortuuid
 
@@ -16,6 +19,40 @@ def calc_hash(x: bytes):
     return m.hexdigest()
 
 
+def calc_chunk_digest(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+def calc_token_digest(token: str) -> str:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def gen_refresh_token() -> str:
+    return secrets.token_urlsafe(32)
+
+
+api_key_marker = "dsk"
+
+
+def gen_api_key() -> str:
+    return f"{api_key_marker}_{suuid_generator.random(length=12)}_{secrets.token_urlsafe(32)}"
+
+
+def is_api_key(token: str) -> bool:
+    return token.startswith(f"{api_key_marker}_")
+
+
+def parse_api_key_prefix(api_key: str) -> Optional[str]:
+    parts = api_key.split("_", 2)
+    if len(parts) != 3 or parts[0] != api_key_marker or len(parts[1]) != 12:
+        return None
+    return parts[1]
+
+
+def calc_api_key_digest(api_key: str, secret_key: str) -> str:
+    return hmac.new(secret_key.encode("utf-8"), api_key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
 def gen_uuid() -> str:
     return suuid_generator.uuid()
 
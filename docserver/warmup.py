@@ -0,0 +1,74 @@
+import importlib
+import logging
+from typing import Sequence
+
+from fastapi import FastAPI
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from . import schema
+from .deps import AsyncSessionHandler, SessionHandler
+
+logger = logging.getLogger(__name__)
+
+lazy_imports = (
+    "email_validator",
+    "multipart",
+    "passlib.handlers.bcrypt",
+    "jose.backends",
+    "uvloop",
+    "httptools",
+)
+
+
+def import_lazy_modules(names: Sequence[str] = lazy_imports):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            logger.debug("warmup: %s is not installed", name)
+
+
+def warm_password_hashing():
+    schema._verify_password("warmup", schema._get_hashed_value("warmup"))
+
+
+def warm_engine(engine, connections: int):
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            opened.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+async def warm_async_engine(engine, connections: int):
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = await engine.connect()
+            opened.append(conn)
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            await conn.close()
+
+
+async def warmup(app: FastAPI):
+    session_handler: SessionHandler = app.session_handler
+    connections = session_handler.settings.DB_POOL_SIZE
+    await run_in_threadpool(import_lazy_modules)
+    await run_in_threadpool(warm_password_hashing)
+    app.openapi()
+    if isinstance(session_handler, AsyncSessionHandler):
+        await warm_async_engine(session_handler.async_engine, connections)
+        for engine in session_handler.async_replicas.engines:
+            await warm_async_engine(engine, connections)
+    else:
+        await run_in_threadpool(warm_engine, session_handler.engine, 1 if session_handler.is_sqlite else connections)
+        for engine in session_handler.replicas.engines:
+            await run_in_threadpool(warm_engine, engine, connections)
+    logger.info("worker warmed up with %d connections per engine", connections)
@@ -18,10 +18,11 @@ setup(
     description=__description__,
     long_description=__description__,
     packages=[__package_name__],
+    entry_points={"console_scripts": ["docserver=docserver.cli:main"]},
     install_requires=[
         "alembic[tz]",
         "fastapi",
-        "SQLAlchemy",
+        "SQLAlchemy[asyncio]",
         "shortuuid",
         "pyhumps",
         "python-dotenv",
@@ -44,10 +45,19 @@ setup(
             "tox",
             "isort",
             "psycopg2-binary",
+            "asyncpg",
             "requests",
             "pydantic-factories",
             "factory_boy",
+            "msgpack",
+            "cbor2",
+            "Pillow",
+            "brotli",
+            "zstandard",
         ],
-        "prod": ["psycopg2"],
+        "prod": ["psycopg2", "asyncpg"],
+        "binary": ["msgpack", "cbor2"],
+        "images": ["Pillow"],
+        "compression": ["brotli", "zstandard"],
     },
 )
@@ -1,3 +1,4 @@
+import re
 from base64 import urlsafe_b64encode
 from datetime import datetime, timedelta
 from typing import Any, Callable, Dict, Generator, Optional
@@ -8,13 +9,14 @@ import pytest
 from docserver import config, models, schema, utils
 from docserver.app import generate_app
 from docserver.deps import SessionHandler
-from docserver.types import Base64EncodedData, DataTypeString
+from docserver.types import Base64EncodedData, ChunkedBinaryData, DataTypeString, RawBinaryData
 from factory.alchemy import SQLAlchemyModelFactory
 from factory.fuzzy import FuzzyAttribute, FuzzyChoice, FuzzyText
 from fastapi import testclient
 from fastapi.testclient import TestClient
 from pydantic import BaseModel
 from pydantic_factories import ModelFactory
+from sqlalchemy import event, text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.orm.session import close_all_sessions
@@ -51,6 +53,31 @@ class TestSessionHandler(SessionHandler):
         finally:
             ...
 
+    def job_session(self) -> Session:
+        """Joins the test transaction through a savepoint so that worker commits and rollbacks stay inside it."""
+        conn = self.sessionmaker().connection()
+        savepoint = [conn.begin_nested()]
+        db = Session(bind=conn, autoflush=False, expire_on_commit=False)
+
+        @event.listens_for(db, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if not savepoint[0].is_active:
+                savepoint[0] = conn.begin_nested()
+
+        return db
+
+
+class CommittingSessionHandler(TestSessionHandler):
+    """Commits for real, for tests whose app opens its own sessions or needs a fresh transaction per request."""
+
+    @property
+    def sessionmaker(self) -> sessionmaker:
+        if self._sessionmaker is None:
+            self._sessionmaker = scoped_session(
+                sessionmaker(autocommit=False, autoflush=False, bind=self.engine), scopefunc=lambda: self._session_id
+            )
+        return self._sessionmaker
+
 
 class DocServerModelFactory(ModelFactory):
     data_generator = FuzzyText(length=2048)
@@ -60,6 +87,8 @@ class DocServerModelFactory(ModelFactory):
         m = super().get_provider_map()
         m[schema.PasswordString] = lambda: utils.gen_password(10)
         m[Base64EncodedData] = lambda: urlsafe_b64encode(cls.data_generator.fuzz().encode("utf-8"))
+        # binary request bodies are posted as JSON, so every member of BinaryData is generated as base64 text
+        m[ChunkedBinaryData] = m[RawBinaryData] = m[Base64EncodedData]
         m[DataTypeString] = FuzzyChoice(DataTypeString.valid_types).fuzz
         return m
 
@@ -254,10 +283,25 @@ def db(test_db, settings) -> Generator:
     test_session_handler.engine.dispose()
 
 
+@pytest.fixture(scope="function")
+def committing_db(test_db, settings) -> Generator:
+    """A db whose fixtures are committed, so every table is truncated afterwards instead of rolled back."""
+    session_handler = CommittingSessionHandler(settings=settings)
+    models.Base.metadata.create_all(session_handler.engine)
+
+    yield session_handler
+    close_all_sessions()
+    tables = ", ".join(d.name for d in models.Base.metadata.sorted_tables)
+    with session_handler.engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {tables} CASCADE"))
+    session_handler.engine.dispose()
+
+
 @pytest.fixture(scope="function")
 def app(db, settings) -> Generator:
     app_ = generate_app(settings)
     app_.dependency_overrides[app_.session_handler.get_db] = db.get_db
+    app_.dependency_overrides[app_.session_handler.get_read_db] = db.get_db
     yield app_
 
 
@@ -266,6 +310,20 @@ def client(app) -> Generator:
     yield DocServerTestClient(app)
 
 
+@pytest.fixture(scope="function")
+def query_budget() -> Generator:
+    def assert_within_budget(response, max_queries: int):
+        match = re.search(r'db;dur=[0-9.]+;desc="([0-9]+) queries', response.headers.get("Server-Timing", ""))
+        assert match is not None, "response has no Server-Timing db entry"
+        queries = int(match.group(1))
+        assert (
+            queries <= max_queries
+        ), f"{response.request.method} {response.request.url} ran {queries} queries, budget is {max_queries}"
+        return queries
+
+    yield assert_within_budget
+
+
 @pytest.fixture(scope="function")
 def factories(db) -> Generator:
     class UserCreateQueryFactory(DocServerModelFactory):
@@ -363,7 +421,11 @@ def fixture_users(factories) -> Generator:
 @pytest.fixture(scope="function")
 def fixture_refresh_token(factories, fixture_users) -> Generator:
     factories.RefreshTokenFactory(
-        id="1234567890abcdefABCDEF", user_id="0123456789abcdefABCDEF", token="the_refresh_token"
+        id="1234567890abcdefABCDEF",
+        user_id="0123456789abcdefABCDEF",
+        family_id="2234567890abcdefABCDEF",
+        digest=utils.calc_token_digest("the_refresh_token"),
+        expires_at=datetime(2021, 3, 1, 0, 0, 0),
     )
     yield None
     factories.UserFactory._meta.sqlalchemy_session.close()
@@ -0,0 +1,91 @@
+from datetime import datetime
+
+import freezegun
+from docserver import models, operators, utils
+from fastapi import status
+
+
+def create_api_key(mocker, client, settings, user_id, name="batch-job", **kwargs):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{user_id}"})
+    response = client.post(
+        f"{settings.API_V1_STR}/users/me/api-keys",
+        json={"name": name, **kwargs},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    mocker.stopall()
+    return response
+
+
+def test_create_api_key(mocker, db, client, settings, fixture_users):
+    dt = datetime(2022, 7, 1, 12, 0, 0)
+    with freezegun.freeze_time(dt):
+        response = create_api_key(mocker, client, settings, fixture_users["testuser"].id)
+    assert response.status_code == status.HTTP_200_OK
+    res_json = response.json()
+    api_key = res_json["apiKey"]
+    assert utils.is_api_key(api_key)
+    assert res_json["prefix"] == utils.parse_api_key_prefix(api_key)
+    assert res_json["name"] == "batch-job"
+    assert res_json["expiresAt"] is None
+    assert res_json["createdAt"] == dt.isoformat()
+
+    sess = db.sessionmaker()
+    x = sess.query(models.ApiKey).get(res_json["id"])
+    assert x.user_id == fixture_users["testuser"].id
+    assert x.digest == utils.calc_api_key_digest(api_key, settings.API_KEY_SECRET)
+    assert api_key not in (x.digest, x.prefix)
+    sess.close()
+
+
+def test_get_user_info_by_api_key_is_cached(mocker, client, settings, fixture_users):
+    api_key = create_api_key(mocker, client, settings, fixture_users["testuser"].id).json()["apiKey"]
+    decode = mocker.patch("docserver.operators.jwt.decode")
+    authenticate = mocker.spy(operators, "authenticate_api_key")
+    for _ in range(3):
+        response = client.get(settings.API_V1_STR + "/users/me", headers={"Authorization": f"Bearer {api_key}"})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["id"] == fixture_users["testuser"].id
+    assert authenticate.call_count == 1
+    decode.assert_not_called()
+
+
+def test_get_user_info_fails_with_unknown_api_key(client, settings, fixture_users):
+    response = client.get(settings.API_V1_STR + "/users/me", headers={"Authorization": f"Bearer {utils.gen_api_key()}"})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_get_user_info_fails_with_tampered_api_key(mocker, client, settings, fixture_users):
+    api_key = create_api_key(mocker, client, settings, fixture_users["testuser"].id).json()["apiKey"]
+    response = client.get(settings.API_V1_STR + "/users/me", headers={"Authorization": f"Bearer {api_key}x"})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_get_user_info_fails_with_expired_api_key(mocker, client, settings, fixture_users):
+    with freezegun.freeze_time(datetime(2022, 7, 1, 12, 0, 0)):
+        api_key = create_api_key(mocker, client, settings, fixture_users["testuser"].id, expiresInDays=1).json()[
+            "apiKey"
+        ]
+    with freezegun.freeze_time(datetime(2022, 7, 2, 12, 0, 1)):
+        response = client.get(settings.API_V1_STR + "/users/me", headers={"Authorization": f"Bearer {api_key}"})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_delete_api_key_evicts_cached_key(mocker, client, settings, fixture_users):
+    res_json = create_api_key(mocker, client, settings, fixture_users["testuser"].id).json()
+    headers = {"Authorization": f"Bearer {res_json['apiKey']}"}
+    assert client.get(settings.API_V1_STR + "/users/me", headers=headers).status_code == status.HTTP_200_OK
+
+    response = client.delete(f"{settings.API_V1_STR}/users/me/api-keys/{res_json['id']}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert client.get(settings.API_V1_STR + "/users/me", headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_list_api_keys(mocker, client, settings, fixture_users):
+    first = create_api_key(mocker, client, settings, fixture_users["testuser"].id, name="first").json()
+    create_api_key(mocker, client, settings, fixture_users["testuser2"].id, name="other")
+    response = client.get(
+        f"{settings.API_V1_STR}/users/me/api-keys", headers={"Authorization": f"Bearer {first['apiKey']}"}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert [d["name"] for d in response.json()] == ["first"]
+    assert all("apiKey" not in d for d in response.json())
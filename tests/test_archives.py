@@ -0,0 +1,172 @@
+import calendar
+import io
+import tarfile
+import zipfile
+from base64 import urlsafe_b64decode
+from datetime import datetime
+
+import pytest
+from docserver import archives
+from fastapi import status
+
+files = {"a.txt": b"hello" * 300, "b.bin": b"", "c.json": b'{"x": 1}'}
+
+
+def write_archive(fmt: str) -> io.BytesIO:
+    writer = archives.writers[fmt]()
+    out = io.BytesIO()
+    for name, body in files.items():
+        out.write(writer.begin_file(name, len(body), datetime(2022, 1, 2, 3, 4, 6)))
+        for i in range(0, len(body), 512):
+            out.write(writer.write(memoryview(body)[i : i + 512]))
+        out.write(writer.end_file())
+    out.write(writer.close())
+    out.seek(0)
+    return out
+
+
+def test_tar_stream_writer():
+    with tarfile.open(fileobj=write_archive("tar")) as tar:
+        assert {d.name: tar.extractfile(d).read() for d in tar.getmembers()} == files
+        assert tar.getmember("a.txt").mtime == calendar.timegm((2022, 1, 2, 3, 4, 6))
+
+
+def test_zip_stream_writer():
+    with zipfile.ZipFile(write_archive("zip")) as zf:
+        assert zf.testzip() is None
+        assert {d: zf.read(d) for d in zf.namelist()} == files
+        assert zf.getinfo("a.txt").date_time == (2022, 1, 2, 3, 4, 6)
+
+
+def read_archive(data: bytes, step: int):
+    reader = archives.ArchiveReader()
+    res = {}
+    for i in range(0, len(data), step):
+        for event in reader.feed(data[i : i + step]):
+            if event.kind == "start":
+                name = event.value
+                res[name] = b""
+            elif event.kind == "data":
+                res[name] += event.value
+    reader.close()
+    return res
+
+
+@pytest.mark.parametrize("fmt", ["tar", "zip"])
+@pytest.mark.parametrize("step", [1, 100, 1 << 20])
+def test_archive_reader_reads_own_archives(fmt, step):
+    assert read_archive(write_archive(fmt).getvalue(), step) == files
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz"])
+def test_archive_reader_reads_tar(mode):
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode=mode, format=tarfile.GNU_FORMAT) as tar:
+        directory = tarfile.TarInfo("d" * 120)
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+        for name, body in files.items():
+            info = tarfile.TarInfo(f"{'d' * 120}/{name}")
+            info.size = len(body)
+            tar.addfile(info, io.BytesIO(body))
+    assert read_archive(out.getvalue(), 1000) == {f"{'d' * 120}/{k}": v for k, v in files.items()}
+
+
+def test_archive_reader_reads_deflated_zip():
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("dir/", b"")
+        for name, body in files.items():
+            zf.writestr(name, body)
+    assert read_archive(out.getvalue(), 7) == files
+
+
+def test_archive_reader_rejects_malformed_archives():
+    data = write_archive("zip").getvalue()
+    for bad in (data[:100], b"x" * 1024, b""):
+        with pytest.raises(ValueError):
+            read_archive(bad, 10)
+
+
+def test_guess_data_type():
+    assert archives.guess_data_type("a/b.JPG", b"") == "image/jpeg"
+    assert archives.guess_data_type("b", b"\x89PNG\r\n\x1a\n...") == "image/png"
+    assert archives.guess_data_type("c", b' {"x": 1}') == "application/json"
+    assert archives.guess_data_type("d", "h\u00e9llo".encode()[:2]) == "text/plain"
+    assert archives.guess_data_type("e", b"\x00\x01") == "application/octet-stream"
+
+
+def test_member_name():
+    assert archives.member_name("abc", "application/json") == "abc.json"
+    assert archives.member_name("abc", "image/jpeg") == "abc.jpg"
+    assert archives.member_name("abc", None) == "abc.bin"
+
+
+@pytest.mark.parametrize("fmt", ["tar", "zip"])
+def test_retrieve_collection_archive(mocker, client, settings, fixture_users, fixture_collections, fixture_items, fmt):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/archive",
+        params={"format": fmt},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Type"] == archives.writers[fmt].media_type
+    expected = {archives.member_name(d.id, d.data_type): d.body for d in fixture_items["testuser_items"][collection.id]}
+    if fmt == "tar":
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+            assert {d.name: tar.extractfile(d).read() for d in tar.getmembers()} == expected
+    else:
+        with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+            assert {d: zf.read(d) for d in zf.namelist()} == expected
+
+
+def test_retrieve_collection_archive_returns_404_if_other_users_collection(
+    mocker, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser2_collections"][0]
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/archive",
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_import_collection_archive(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][1]
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/archive",
+        data=write_archive("zip").getvalue(),
+        headers=headers,
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["count"] == len(files)
+    results = {d["name"]: d for d in response.json()["results"]}
+    assert {k: v["dataType"] for k, v in results.items()} == {
+        "a.txt": "text/plain",
+        "b.bin": "application/octet-stream",
+        "c.json": "application/json",
+    }
+    for name, body in files.items():
+        response = client.get(
+            f"{settings.API_V1_STR}/collections/{collection.id}/items/{results[name]['id']}", headers=headers
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert urlsafe_b64decode(response.json()["body"]) == body
+
+
+def test_import_collection_archive_rejects_malformed_archive(
+    mocker, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][1]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/archive",
+        data=b"not an archive" * 100,
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
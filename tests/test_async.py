@@ -0,0 +1,84 @@
+"""Runs the collection, item, search and archive endpoint tests against the app served with DB_ASYNC=True.
+
+The app reaches the database through its own asyncpg connections, so fixtures are committed for real and every
+table is truncated after each test instead of rolling the test transaction back.
+"""
+import inspect
+import re
+from pathlib import Path
+
+import pytest
+from conftest import CommittingSessionHandler, DocServerTestClient
+from docserver import async_operators, config, operators
+from docserver.app import generate_app
+from test_archives import *  # noqa: F401,F403
+from test_collection import *  # noqa: F401,F403
+from test_items import *  # noqa: F401,F403
+from test_search import *  # noqa: F401,F403
+
+
+class RefreshingTestClient(DocServerTestClient):
+    """Refreshes what the test session holds after each request, since the app commits through other connections.
+
+    Rows the request deleted are expunged, so that lookups miss them while their loaded attributes stay readable.
+    """
+
+    def __init__(self, app, db: CommittingSessionHandler):
+        super(RefreshingTestClient, self).__init__(app)
+        self._db = db
+
+    def request(self, *args, **kwargs):
+        try:
+            return super(RefreshingTestClient, self).request(*args, **kwargs)
+        finally:
+            sess = self._db.sessionmaker()
+            for (model, ident, _), instance in list(sess.identity_map.items()):
+                # expunging an item cascades to its chunks
+                if instance in sess and sess.get(model, ident, populate_existing=True) is None:
+                    sess.expunge(instance)
+
+
+@pytest.fixture(scope="module")
+def settings():
+    yield config.get_setting(
+        DB_DBNAME="test",
+        DB_ASYNC=True,
+        JOBS_IN_PROCESS_WORKERS=0,
+        REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS=0,
+        ITEM_VERSIONS_PRUNE_INTERVAL_SECONDS=0,
+    )
+
+
+@pytest.fixture(scope="function")
+def db(committing_db):
+    yield committing_db
+
+
+@pytest.fixture(scope="function")
+def app(db, settings):
+    app_ = generate_app(settings)
+    yield app_
+    app_.session_handler.engine.dispose()
+
+
+@pytest.fixture(scope="function")
+def client(app, db):
+    # one event loop for the whole test, since pooled asyncpg connections belong to the loop that opened them
+    with RefreshingTestClient(app, db) as client_:
+        yield client_
+
+
+def test_async_stack_serves_routes(app):
+    assert type(app.session_handler).__name__ == "AsyncSessionHandler"
+
+
+def test_async_operators_match_sync_operators():
+    source = "\n".join(Path(operators.__file__).with_name(d).read_text() for d in ("routers.py", "tasks.py"))
+    names = set(re.findall(r"\bops\.([a-z_]+)\(", source))
+    names |= set(re.findall(r"(?:call_operator|stream_operator)\((?:db, )?\"([a-z_]+)\"", source))
+    assert len(names) > 0
+    for name in sorted(names):
+        sync, async_ = getattr(operators, name), getattr(async_operators, name, None)
+        assert async_ is not None, f"async_operators.{name} is missing"
+        assert inspect.iscoroutinefunction(async_) or inspect.isasyncgenfunction(async_), name
+        assert list(inspect.signature(async_).parameters) == list(inspect.signature(sync).parameters), name
@@ -0,0 +1,24 @@
+from docserver import cli, warmup
+
+
+def test_per_worker_pool_options(settings):
+    assert cli.per_worker_pool_options(settings, 4) == {}
+    sized = settings.copy(update={"DB_POOL_SIZE_TOTAL": 20, "DB_MAX_OVERFLOW_TOTAL": 6})
+    assert cli.per_worker_pool_options(sized, 4) == {"DB_POOL_SIZE": 5, "DB_MAX_OVERFLOW": 1}
+    assert cli.per_worker_pool_options(sized, 64) == {"DB_POOL_SIZE": 1, "DB_MAX_OVERFLOW": 0}
+
+
+def test_parse_args_defaults_come_from_settings(settings):
+    args = cli.parse_args([], settings.copy(update={"SERVER_PORT": 8123, "SERVER_WORKERS": 3}))
+    assert (args.port, args.workers, args.reuse_port) == (8123, 3, False)
+    args = cli.parse_args(["--workers", "2", "--reuse-port"], settings)
+    assert (args.workers, args.reuse_port) == (2, True)
+    assert cli.parse_args([], settings).command == "serve"
+    args = cli.parse_args(["worker", "--concurrency", "4"], settings)
+    assert (args.command, args.concurrency) == ("worker", 4)
+
+
+def test_warm_engine_opens_requested_connections(db):
+    warmup.warm_engine(db.engine, 3)
+    assert db.engine.pool.checkedin() >= 3
+    assert db.engine.pool.checkedout() == 0
@@ -3,7 +3,7 @@ from datetime import datetime
 from unittest.mock import MagicMock, call
 
 import freezegun
-from docserver import models, types, utils
+from docserver import models, operators, types, utils
 from fastapi import status
 
 
@@ -73,7 +73,9 @@ def test_list_collection_returns_empty_if_user_has_no_collection(mocker, client,
     }
 
 
-def test_list_collection_returns_first_ten_collections(mocker, client, settings, fixture_users, fixture_collections):
+def test_list_collection_returns_first_ten_collections(
+    mocker, client, settings, query_budget, fixture_users, fixture_collections
+):
     decode = mocker.patch(
         "docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"}
     )
@@ -82,6 +84,7 @@ def test_list_collection_returns_first_ten_collections(mocker, client, settings,
     response = client.get(f"{settings.API_V1_STR}/collections", headers={"Authorization": "Bearer the_access_token"})
 
     assert response.status_code == status.HTTP_200_OK
+    query_budget(response, 5)
     decode.assert_called_once_with("the_access_token", key=settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
     DecodedCursor_init.assert_called_once_with("n", fixture_collections["testuser_collections"][-11].cursor_value)
     assert response.json() == {
@@ -434,3 +437,46 @@ def test_delete_collection_returns_404_if_other_users_collection(
         headers={"Authorization": "Bearer the_access_token"},
     )
     assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_clone_collection_copies_items(mocker, db, client, settings, fixture_users, fixture_collections, fixture_items):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    source = fixture_collections["testuser_collections"][0]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{source.id}:clone",
+        json={"name": "template copy"},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["name"] == "template copy"
+    clone_id = response.json()["id"]
+    assert clone_id != source.id
+
+    sess = db.sessionmaker()
+    copies = sess.query(models.Item).filter(models.Item.collection_id == clone_id).all()
+    assert sorted((d.data_type, d.body) for d in copies) == sorted(
+        (d.data_type, d.body) for d in fixture_items["testuser_items"][source.id]
+    )
+    assert not set(d.id for d in copies) & set(d.id for d in fixture_items["testuser_items"][source.id])
+    sess.close()
+
+
+def test_clone_collection_commits_each_batch(mocker, db, fixture_users, fixture_collections, fixture_items):
+    source = fixture_collections["testuser_collections"][0]
+    sess = db.sessionmaker()
+    commit = mocker.spy(sess, "commit")
+    clone = operators.clone_collection(sess, fixture_users["testuser"], source.id, None, 1)
+    items = fixture_items["testuser_items"][source.id]
+    assert commit.call_count == len(items) + 1
+    assert sess.query(models.Item).filter(models.Item.collection_id == clone.id).count() == len(items)
+
+
+def test_clone_collection_returns_404_if_other_users_collection(
+    mocker, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{fixture_collections['testuser2_collections'][0].id}:clone",
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,93 @@
+from base64 import urlsafe_b64encode
+
+from docserver import compression
+from fastapi import status
+
+
+def test_negotiate_prefers_highest_quality(mocker):
+    gzip_encoding = compression.gzip_encoding()
+    fake_br = compression.Encoding("br", lambda data: data)
+    mocker.patch.object(compression, "encodings", {"br": fake_br, "gzip": gzip_encoding})
+    assert compression.negotiate(None) is None
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("gzip, br") is fake_br
+    assert compression.negotiate("gzip, br;q=0.5") is gzip_encoding
+    assert compression.negotiate("*;q=0.1, br;q=0") is gzip_encoding
+    assert compression.negotiate("deflate") is None
+
+
+def test_is_compressible():
+    assert compression.is_compressible("application/json")
+    assert compression.is_compressible("text/html; charset=utf-8")
+    assert compression.is_compressible("image/svg+xml")
+    assert not compression.is_compressible("image/png")
+    assert not compression.is_compressible("image/jpeg")
+    assert not compression.is_compressible("application/zip")
+
+
+def create_item(client, settings, collection, data_type, body):
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": data_type, "body": urlsafe_b64encode(body).decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()["id"]
+
+
+def test_retrieve_item_caches_compressed_body(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_item(client, settings, collection, "text/plain", b"compressible text " * 1000)
+    compress = mocker.spy(compression, "compress")
+    headers = {"Authorization": "Bearer the_access_token", "Accept-Encoding": "gzip"}
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}"
+    first = client.get(url, headers=headers)
+    second = client.get(url, headers=headers)
+    assert first.status_code == second.status_code == status.HTTP_200_OK
+    assert first.headers["Content-Encoding"] == second.headers["Content-Encoding"] == "gzip"
+    assert first.json() == second.json()
+    assert compress.call_count == 1
+
+
+def test_retrieve_item_does_not_recompress_images(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_item(client, settings, collection, "image/png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 4000)
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}",
+        headers={"Authorization": "Bearer the_access_token", "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept"
+
+
+def test_retrieve_item_varies_on_encoding_when_sent_uncompressed(
+    mocker, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_item(client, settings, collection, "text/plain", b"compressible text " * 1000)
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}",
+        headers={"Authorization": "Bearer the_access_token", "Accept-Encoding": "identity"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept, Accept-Encoding"
+
+
+def test_compression_middleware_compresses_large_json(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    for _ in range(20):
+        create_item(client, settings, collection, "text/plain", b"x")
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        headers={"Authorization": "Bearer the_access_token", "Accept-Encoding": "gzip"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert len(response.json()["results"]) > 0
@@ -0,0 +1,108 @@
+import json
+from base64 import urlsafe_b64encode
+
+import pytest
+from docserver import jsonpointer
+from fastapi import status
+
+document = {"a": {"b": [10, {"c~d": None}], "e/f": "g"}, "tags": ["x", "y"]}
+
+
+def test_parse_pointer():
+    assert jsonpointer.parse_pointer("") == ()
+    assert jsonpointer.parse_pointer("/a/b/0") == ("a", "b", "0")
+    assert jsonpointer.parse_pointer("/a/e~1f/c~0d") == ("a", "e/f", "c~d")
+    with pytest.raises(ValueError):
+        jsonpointer.parse_pointer("a/b")
+
+
+def test_resolve():
+    assert jsonpointer.resolve(document, ()) == document
+    assert jsonpointer.resolve(document, ("a", "b", "0")) == 10
+    assert jsonpointer.resolve(document, ("a", "b", "1", "c~d")) is None
+    assert jsonpointer.resolve(document, ("a", "e/f")) == "g"
+    for path in (("a", "x"), ("a", "b", "2"), ("a", "b", "01"), ("a", "b", "-"), ("tags", "0", "z")):
+        assert jsonpointer.resolve(document, path) is jsonpointer.missing
+
+
+def create_json_item(client, settings, collection, value):
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "application/json", "body": urlsafe_b64encode(json.dumps(value).encode()).decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()["id"]
+
+
+def test_retrieve_item_document_by_pointer(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_json_item(client, settings, collection, document)
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}/document"
+    headers = {"Authorization": "Bearer the_access_token"}
+    for pointer, expected in (("", document), ("/a/b/0", 10), ("/a/b/1/c~0d", None), ("/a/e~1f", "g")):
+        response = client.get(url, params={"pointer": pointer}, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == expected
+    assert client.get(url, params={"pointer": "/a/x"}, headers=headers).status_code == status.HTTP_404_NOT_FOUND
+    response = client.get(url, params={"pointer": "a"}, headers=headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_retrieve_item_document_rejects_other_types(
+    mocker, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = next(d for d in fixture_items["testuser_items"][collection.id] if d.data_type != "application/json")
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item.id}/document",
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+
+def test_update_item_refreshes_document(mocker, client, settings, factories, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_json_item(client, settings, collection, document)
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}"
+    headers = {"Authorization": "Bearer the_access_token"}
+    assert client.get(f"{url}/document?pointer=/tags/1", headers=headers).json() == "y"
+    query = factories.ItemUpdateQueryFactory.build(data_type=None, body=b'{"tags": ["z"]}')
+    response = client.put(url, data=query, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["dataType"] == "application/json"
+    assert client.get(f"{url}/document?pointer=/tags/0", headers=headers).json() == "z"
+
+
+def test_update_body_of_other_types_keeps_no_document(
+    mocker, client, settings, factories, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = next(d for d in fixture_items["testuser_items"][collection.id] if d.data_type != "application/json")
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item.id}"
+    headers = {"Authorization": "Bearer the_access_token"}
+    query = factories.ItemUpdateQueryFactory.build(data_type=None, body=b'{"tags": ["z"]}')
+    response = client.put(url, data=query, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert client.get(f"{url}/document", headers=headers).status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+
+
+def test_list_items_filtered_by_containment(mocker, db, client, settings, fixture_users, fixture_collections):
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("containment filters require PostgreSQL")
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][4]
+    first = create_json_item(client, settings, collection, {"kind": "a", "tags": ["x", "y"]})
+    create_json_item(client, settings, collection, {"kind": "b", "tags": ["y"]})
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        params={"contains": json.dumps({"tags": ["x"]})},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert [d["id"] for d in response.json()["results"]] == [first]
+    assert response.json()["meta"]["count"] == 1
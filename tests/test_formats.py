@@ -0,0 +1,69 @@
+import pytest
+from docserver import formats, models
+from fastapi import status
+
+
+@pytest.fixture
+def fake_format(mocker):
+    fmt = formats.BinaryFormat("application/x-fake", repr, eval)
+    mocker.patch.dict(formats.binary_formats, {fmt.media_type: fmt})
+    return fmt
+
+
+def test_negotiate_prefers_highest_quality(fake_format):
+    assert formats.negotiate(None) is None
+    assert formats.negotiate("application/json") is None
+    assert formats.negotiate("application/x-fake") is fake_format
+    assert formats.negotiate("application/json;q=0.5, application/x-fake") is fake_format
+    assert formats.negotiate("application/x-fake;q=0.5, */*") is None
+    assert formats.negotiate("text/html") is None
+
+
+def test_content_format_ignores_parameters(fake_format):
+    assert formats.content_format("application/x-fake; charset=binary") is fake_format
+    assert formats.content_format("application/json") is None
+    assert formats.content_format(None) is None
+
+
+def test_create_and_retrieve_item_as_msgpack(mocker, db, client, settings, fixture_users, fixture_collections):
+    msgpack = pytest.importorskip("msgpack")
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection_id = fixture_collections["testuser_collections"][0].id
+    body = bytes(range(256)) * 16
+    headers = {"Authorization": "Bearer the_access_token", "Accept": "application/msgpack"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection_id}/items",
+        data=msgpack.packb({"dataType": "application/octet-stream", "body": body}),
+        headers={**headers, "Content-Type": "application/msgpack"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Content-Type"] == "application/msgpack"
+    item_id = msgpack.unpackb(response.content)["id"]
+    assert db.sessionmaker().query(models.Item).get(item_id).body == body
+
+    response = client.get(f"{settings.API_V1_STR}/collections/{collection_id}/items/{item_id}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["Vary"] == "Accept, Accept-Encoding"
+    res = msgpack.unpackb(response.content)
+    assert (res["id"], res["dataType"], res["body"]) == (item_id, "application/octet-stream", body)
+
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection_id}/items/{item_id}",
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json()["id"] == item_id
+
+
+def test_list_items_as_cbor(mocker, client, settings, fixture_users, fixture_collections, fixture_items):
+    cbor2 = pytest.importorskip("cbor2")
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        headers={"Authorization": "Bearer the_access_token", "Accept": "application/cbor"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    res = cbor2.loads(response.content)
+    assert res["meta"]["count"] == len(fixture_items["testuser_items"][collection.id])
+    assert all("body" not in d for d in res["results"])
@@ -0,0 +1,77 @@
+import io
+from base64 import urlsafe_b64encode
+
+import pytest
+from docserver import images, models
+from fastapi import status
+
+
+def png_bytes(size, color=(200, 30, 30)):
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, format="PNG")
+    return out.getvalue()
+
+
+def test_render_derivative_downscales_and_keeps_aspect_ratio():
+    Image = pytest.importorskip("PIL.Image")
+    res = images.render_derivative(png_bytes((400, 100)), 200, "jpeg")
+    with Image.open(io.BytesIO(res)) as img:
+        assert (img.format, img.size) == ("JPEG", (200, 50))
+    with Image.open(io.BytesIO(images.render_derivative(png_bytes((40, 10)), 200, "png"))) as img:
+        assert img.size == (40, 10)
+    with pytest.raises(ValueError):
+        images.render_derivative(b"not an image", 200, "png")
+
+
+def test_retrieve_item_derivative_is_rendered_once(
+    mocker, db, client, settings, factories, fixture_users, fixture_collections
+):
+    Image = pytest.importorskip("PIL.Image")
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    render = mocker.patch("docserver.images.render_derivative", wraps=images.render_derivative)
+    collection = fixture_collections["testuser_collections"][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "image/png", "body": urlsafe_b64encode(png_bytes((100, 60))).decode()},
+        headers=headers,
+    )
+    item_id = response.json()["id"]
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}/derivative"
+    for _ in range(2):
+        response = client.get(url, params={"w": 50, "format": "png"}, headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["Content-Type"] == "image/png"
+        with Image.open(io.BytesIO(response.content)) as img:
+            assert img.size == (50, 30)
+    assert render.call_count == 1
+    sess = db.sessionmaker()
+    assert sess.query(models.ItemDerivative).filter(models.ItemDerivative.item_id == item_id).count() == 1
+
+    response = client.put(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}",
+        data=factories.ItemUpdateQueryFactory.build(data_type=None, body=png_bytes((10, 20))),
+        headers=headers,
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert sess.query(models.ItemDerivative).filter(models.ItemDerivative.item_id == item_id).count() == 0
+    with Image.open(io.BytesIO(client.get(url, params={"w": 50, "format": "png"}, headers=headers).content)) as img:
+        assert img.size == (10, 20)
+    assert render.call_count == 2
+
+
+def test_retrieve_item_derivative_rejects_other_types(
+    mocker, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = next(
+        d for d in fixture_items["testuser_items"][collection.id] if d.data_type not in images.source_data_types
+    )
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item.id}/derivative"
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.get(url, params={"w": 200}, headers=headers)
+    assert response.status_code == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    response = client.get(url, params={"w": 200, "format": "bmp"}, headers=headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
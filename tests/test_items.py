@@ -191,7 +191,7 @@ def test_retrieve_item_fails_if_no_valid_token_provided(client, settings, fixtur
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
 
 
-def test_retrieve_item(mocker, client, settings, fixture_users, fixture_collections, fixture_items):
+def test_retrieve_item(mocker, client, settings, query_budget, fixture_users, fixture_collections, fixture_items):
     decode = mocker.patch(
         "docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"}
     )
@@ -211,6 +211,7 @@ def test_retrieve_item(mocker, client, settings, fixture_users, fixture_collecti
         "updatedAt": item.updated_at.isoformat(),
         "body": 'YWFh',
     }
+    query_budget(response, 3)
 
 
 def test_retrieve_item_returns_404_if_no_such_item(
@@ -378,7 +379,9 @@ def test_list_items_returns_empty(mocker, client, settings, fixture_users, fixtu
     assert response.json() == {"meta": {"count": 0, "nextCursor": None, "prevCursor": None}, "results": []}
 
 
-def test_list_items_iterate_all(mocker, client, settings, fixture_users, fixture_collections, fixture_items):
+def test_list_items_iterate_all(
+    mocker, client, settings, query_budget, fixture_users, fixture_collections, fixture_items
+):
     decode = mocker.patch(
         "docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"}
     )
@@ -394,6 +397,7 @@ def test_list_items_iterate_all(mocker, client, settings, fixture_users, fixture
     assert first_response_json["meta"]["nextCursor"] is not None
     assert first_response_json["meta"]["prevCursor"] is None
     assert first_response.status_code == status.HTTP_200_OK
+    query_budget(first_response, 6)
 
     last_prev_cursor = None
     last_result = []
@@ -441,3 +445,95 @@ def test_list_items_iterate_all(mocker, client, settings, fixture_users, fixture
         }
         for d in sorted(items, key=lambda d: d.cursor_value, reverse=True)
     ]
+
+
+def test_copy_item_into_other_collection(mocker, client, settings, fixture_users, fixture_collections, fixture_items):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    source, target = fixture_collections["testuser_collections"][:2]
+    item = fixture_items["testuser_items"][source.id][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{source.id}/items/{item.id}:copy",
+        json={"collectionId": target.id},
+        headers=headers,
+    )
+    assert response.status_code == status.HTTP_200_OK
+    copy = response.json()
+    assert copy["id"] != item.id
+    assert copy["collectionId"] == target.id
+    assert copy["dataType"] == item.data_type
+    response = client.get(f"{settings.API_V1_STR}/collections/{target.id}/items/{copy['id']}", headers=headers)
+    assert response.json()["body"] == urlsafe_b64encode(item.body).decode()
+
+
+def test_copy_item_references_chunk_bodies(mocker, db, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    mocker.patch("docserver.models.chunk_size", 4)
+    source, target = fixture_collections["testuser_collections"][:2]
+    body = b"only this item stores me"
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{source.id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(body).decode()},
+        headers=headers,
+    )
+    item_id = response.json()["id"]
+    url = f"{settings.API_V1_STR}/collections/{source.id}/items/{item_id}:copy"
+    copy_ids = [client.post(url, json={"collectionId": target.id}, headers=headers).json()["id"] for _ in range(2)]
+
+    sess = db.sessionmaker()
+    stored = sess.query(models.Chunk).filter(models.Chunk.item_id == item_id).all()
+    copied = sess.query(models.Chunk).filter(models.Chunk.item_id.in_(copy_ids)).all()
+    assert len(copied) == 2 * len(stored) == 12
+    assert all(d.stored_body is None for d in copied)
+    assert all(d.stored_body is not None for d in stored)
+    assert sess.query(models.ChunkData).count() == 0
+
+    response = client.delete(f"{settings.API_V1_STR}/collections/{source.id}/items/{item_id}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert sess.query(models.ChunkData).count() == len({d.digest for d in copied})
+    for copy_id in copy_ids:
+        response = client.get(f"{settings.API_V1_STR}/collections/{target.id}/items/{copy_id}", headers=headers)
+        assert response.json()["body"] == urlsafe_b64encode(body).decode()
+
+
+def test_copy_item_returns_404_if_target_is_other_users_collection(
+    mocker, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    source = fixture_collections["testuser_collections"][0]
+    item = fixture_items["testuser_items"][source.id][0]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{source.id}/items/{item.id}:copy",
+        json={"collectionId": fixture_collections["testuser2_collections"][0].id},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_create_item_streams_json_body_into_chunks(mocker, db, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(b"abcdefghij").decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    sess = db.sessionmaker()
+    chunks = sess.query(models.Chunk).filter(models.Chunk.item_id == response.json()["id"]).order_by(models.Chunk.index)
+    assert [bytes(d.body) for d in chunks] == [b"abcd", b"efgh", b"ij"]
+    sess.close()
+
+
+def test_create_item_rejects_oversized_request(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch.object(settings, "ITEM_REQUEST_MAX_BYTES", 64)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(b"x" * 100).decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
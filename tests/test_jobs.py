@@ -0,0 +1,86 @@
+from datetime import timedelta
+
+from docserver import jobs, models, operators
+from fastapi import status
+
+
+def test_delete_collection_in_background(
+    mocker, db, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    headers = {"Authorization": "Bearer the_access_token"}
+    collection_id = fixture_collections["testuser_collections"][0].id
+    response = client.delete(f"{settings.API_V1_STR}/collections/{collection_id}?background=true", headers=headers)
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    job = response.json()
+    assert response.headers["Location"] == f"{settings.API_V1_STR}/jobs/{job['id']}"
+    assert (job["kind"], job["status"], job["progress"]) == ("delete_collection", "queued", 0.0)
+
+    worker = jobs.Worker(db.job_session)
+    assert worker.run_once()
+    assert not worker.run_once()
+
+    response = client.get(f"{settings.API_V1_STR}/jobs/{job['id']}", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    res_json = response.json()
+    assert (res_json["status"], res_json["progress"], res_json["attempts"]) == ("succeeded", 1.0, 1)
+    assert res_json["result"] == {"deletedItems": len(fixture_items["testuser_items"][collection_id])}
+    sess = db.sessionmaker()
+    assert sess.query(models.Collection).filter_by(id=collection_id).count() == 0
+    assert sess.query(models.Item).filter_by(collection_id=collection_id).count() == 0
+    sess.close()
+
+
+def test_delete_collection_in_background_returns_404_if_other_users_collection(
+    mocker, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser2_collections"][0]
+    response = client.delete(
+        f"{settings.API_V1_STR}/collections/{collection.id}?background=true",
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_retrieve_job_is_owner_checked(mocker, db, client, settings, fixture_users):
+    job = operators.create_job(
+        db.sessionmaker(), fixture_users["testuser"], "delete_collection", {"collection_id": "x"}
+    )
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser2'].id}"})
+    response = client.get(f"{settings.API_V1_STR}/jobs/{job.id}", headers={"Authorization": "Bearer the_access_token"})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_failed_job_is_retried_then_marked_failed(mocker, db, fixture_users):
+    calls = []
+
+    def broken(ctx, **params):
+        calls.append(params)
+        raise RuntimeError("boom")
+
+    mocker.patch.dict(jobs.handlers, {"broken": broken})
+    sess = db.sessionmaker()
+    job = operators.create_job(sess, fixture_users["testuser"], "broken", {"n": 1}, max_attempts=2)
+    worker = jobs.Worker(db.job_session, retry_seconds=0)
+    assert worker.run_once()
+    x = sess.query(models.Job).get(job.id)
+    assert (x.status, x.attempts, x.error) == ("queued", 1, "RuntimeError: boom")
+    assert worker.run_once()
+    sess.expire_all()
+    x = sess.query(models.Job).get(job.id)
+    assert (x.status, x.attempts) == ("failed", 2)
+    assert not worker.run_once()
+    assert calls == [{"n": 1}, {"n": 1}]
+    sess.close()
+
+
+def test_expired_lease_is_claimed_by_another_worker(db, fixture_users):
+    sess = db.sessionmaker()
+    job = operators.create_job(sess, fixture_users["testuser"], "delete_collection", {"collection_id": "x"})
+    assert operators.claim_job(sess, "first", timedelta(seconds=-1)).id == job.id
+    claimed = operators.claim_job(sess, "second", timedelta(seconds=60))
+    assert (claimed.id, claimed.attempts) == (job.id, 2)
+    assert not operators.report_job_progress(sess, job.id, "first", 0.5, timedelta(seconds=60))
+    assert operators.report_job_progress(sess, job.id, "second", 0.5, timedelta(seconds=60))
+    sess.close()
@@ -0,0 +1,48 @@
+import json
+from base64 import urlsafe_b64encode
+
+import pytest
+from docserver import jsonstream
+
+body = bytes(range(256)) * 3
+
+
+def parse(data: bytes, step: int, chunk_size: int = 100):
+    parser = jsonstream.ItemJsonParser(chunk_size)
+    for i in range(0, len(data), step):
+        parser.feed(data[i : i + step])
+    return parser.close()
+
+
+@pytest.mark.parametrize("step", [1, 3, 64, 1 << 20])
+def test_item_json_parser_decodes_body_into_chunks(step):
+    request = {
+        "dataType": "application/octet-stream",
+        "meta": {"a": [1, "}\""]},
+        "body": urlsafe_b64encode(body).decode(),
+    }
+    res = parse(json.dumps(request).encode(), step)
+    chunks = res.pop("body").chunks
+    assert [len(d) for d in chunks] == [100] * 7 + [68]
+    assert b"".join(chunks) == body
+    assert res == {"dataType": "application/octet-stream", "meta": {"a": [1, "}\""]}}
+
+
+def test_item_json_parser_accepts_escaped_slashes():
+    res = parse(b'{"body": "/\\/8="}', 2)
+    assert res["body"].prefix(10) == b"\xff\xff"
+
+
+@pytest.mark.parametrize(
+    "data", [b'{"body": "YWE"}', b'{"body": "YWFh"', b'{"a": 1} x', b"[1]", b'{"a" 1}', b'{"body": "YW\\"Fh"}']
+)
+def test_item_json_parser_rejects_malformed_requests(data):
+    with pytest.raises(ValueError):
+        parse(data, 4)
+
+
+@pytest.mark.parametrize("step", [1, 2, 4, 100, 1 << 20])
+def test_base64_chunk_encoder_matches_one_shot_encoding(step):
+    encoder = jsonstream.Base64ChunkEncoder()
+    res = b"".join(encoder.feed(body[i : i + step]) for i in range(0, len(body), step)) + encoder.close()
+    assert res == urlsafe_b64encode(body)
@@ -0,0 +1,133 @@
+import io
+
+import pytest
+from docserver import db as db_module
+from docserver import metrics, middleware, querystats
+from docserver.querystats import RequestStats
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+
+
+def test_counter_and_gauge():
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "requests", ("method",))
+    counter.inc(method="GET")
+    counter.inc(2, method="GET")
+    assert counter.get(method="GET") == 3
+    assert registry.counter("requests_total", "requests", ("method",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", "requests")
+    with pytest.raises(ValueError):
+        counter.inc(path="/")
+
+    gauge = registry.gauge("in_use", "in use")
+    gauge.set_function(lambda: 7)
+    assert gauge.get() == 7
+    assert list(gauge.samples()) == [("in_use", {}, 7)]
+
+
+def test_histogram_samples_are_cumulative():
+    histogram = metrics.Histogram("wait_seconds", "wait", buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(v)
+    assert list(histogram.samples()) == [
+        ("wait_seconds_bucket", {"le": "0.1"}, 1),
+        ("wait_seconds_bucket", {"le": "1.0"}, 3),
+        ("wait_seconds_bucket", {"le": "+Inf"}, 4),
+        ("wait_seconds_sum", {}, 4.25),
+        ("wait_seconds_count", {}, 4),
+    ]
+
+
+def test_pool_reports_checkouts_and_usage(db):
+    before = db_module.pool_checkout_seconds.get_count(pool="primary")
+    conn = db.engine.connect()
+    try:
+        assert db_module.pool_checkout_seconds.get_count(pool="primary") == before + 1
+        assert db_module.pool_connections_in_use.get(pool="primary") >= 1
+    finally:
+        conn.close()
+    assert db_module.pool_overflow.get(pool="primary") >= 0
+
+
+def test_render_prometheus_text():
+    registry = metrics.Registry()
+    registry.counter("hits_total", "Hits.", ("path",)).inc(path='/a"b')
+    registry.histogram("wait_seconds", "Wait.", buckets=(1.0,)).observe(0.5)
+    assert metrics.render(registry) == "\n".join(
+        [
+            "# HELP hits_total Hits.",
+            "# TYPE hits_total counter",
+            'hits_total{path="/a\\"b"} 1.0',
+            "# HELP wait_seconds Wait.",
+            "# TYPE wait_seconds histogram",
+            'wait_seconds_bucket{le="1.0"} 1',
+            'wait_seconds_bucket{le="+Inf"} 1',
+            "wait_seconds_sum 0.5",
+            "wait_seconds_count 1",
+            "",
+        ]
+    )
+
+
+def test_metrics_endpoint_reports_routes(mocker, client, settings, fixture_users):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": "userId:0123456789abcdefABCDEF"})
+    response = client.get(settings.API_V1_STR + "/users/me", headers={"Authorization": "Bearer the_access_token"})
+    assert response.status_code == 200
+
+    response = client.get(settings.METRICS_PATH)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    route_labels = f'method="GET",route="{settings.API_V1_STR}/users/me"'
+    assert f'docserver_http_request_seconds_count{{{route_labels},status="200"}}' in response.text
+    assert f"docserver_http_request_db_queries_count{{{route_labels}}}" in response.text
+    assert "docserver_access_token_decode_seconds_count" in response.text
+    assert 'docserver_db_pool_connections_in_use{pool="primary"}' in response.text
+
+
+def test_body_size_tolerates_missing_and_non_bytes_bodies():
+    assert middleware.body_size({"type": "http.request", "body": b"abc"}) == 3
+    assert middleware.body_size({"type": "http.request", "body": memoryview(b"abcd")}) == 4
+    assert middleware.body_size({"type": "http.request"}) == 0
+    assert middleware.body_size({"type": "http.request", "body": io.BytesIO(b"abc")}) == 0
+
+
+def test_request_stats_flags_repeated_statements():
+    stats = RequestStats()
+    for _ in range(3):
+        stats.record_query("SELECT * FROM chunks WHERE item_id = %(item_id)s", 0.001)
+    stats.record_query("SELECT * FROM items", 0.002)
+    stats.rows = 3
+    assert stats.queries == 4
+    assert stats.repeated_statements(3) == [("SELECT * FROM chunks WHERE item_id = %(item_id)s", 3)]
+    assert stats.server_timing(0.01) == 'db;dur=5.0;desc="4 queries, 3 rows", app;dur=10.0'
+
+
+def test_failed_statements_do_not_leak_query_timers():
+    engine = create_engine("sqlite://")
+    querystats.attach_query_counter(engine, "test")
+    with engine.connect() as conn:
+        with pytest.raises(DBAPIError):
+            conn.execute(text("select * from missing"))
+        assert conn.execute(text("select 1")).scalar() == 1
+        assert conn.info["query_started_at"] == {}
+
+
+def test_query_counter_counts_fetched_rows():
+    engine = create_engine("sqlite://")
+    querystats.attach_query_counter(engine, "test")
+    stats = RequestStats()
+    token = querystats.request_stats.set(stats)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("create table t (n integer)"))
+            conn.execute(text("insert into t (n) values (1), (2), (3)"))
+            assert conn.execute(text("update t set n = n + 1")).rowcount == 3
+            assert stats.rows == 0
+            assert len(conn.execute(text("select n from t")).all()) == 3
+            assert conn.execute(text("select n from t")).first() == (2,)
+            assert len(list(conn.execute(text("select n from t where n > 2")))) == 2
+    finally:
+        querystats.request_stats.reset(token)
+    assert stats.queries == 6
+    assert stats.rows == 6
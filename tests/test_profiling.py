@@ -0,0 +1,59 @@
+import os
+import re
+
+import pytest
+from docserver import profiling
+from docserver.app import generate_app
+from fastapi import status
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="function")
+def profiling_client(db, settings, tmp_path):
+    app = generate_app(
+        settings.copy(
+            update={
+                "PROFILING_ENABLED": True,
+                "PROFILING_TOKEN": "the_profiling_token",
+                "PROFILING_OUTPUT_DIR": str(tmp_path),
+                "PROFILING_INTERVAL_SECONDS": 0.001,
+            }
+        )
+    )
+    app.dependency_overrides[app.session_handler.get_db] = db.get_db
+    app.dependency_overrides[app.session_handler.get_read_db] = db.get_db
+    yield TestClient(app)
+
+
+def test_profile_is_stored_with_route_and_user(mocker, profiling_client, settings, tmp_path, fixture_users):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": "userId:0123456789abcdefABCDEF"})
+    response = profiling_client.get(
+        settings.API_V1_STR + "/users/me",
+        headers={"Authorization": "Bearer the_access_token", "X-Docserver-Profile": "the_profiling_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    profile_id = response.headers["X-Docserver-Profile-Id"]
+    assert "-api_v1_users_me-0123456789abcdefABCDEF-" in profile_id
+    assert os.listdir(tmp_path) == [profile_id]
+    with open(tmp_path / profile_id) as fp:
+        lines = fp.read().splitlines()
+    assert len(lines) > 0
+    assert all(re.match(r"^\S.* [0-9]+$", d) for d in lines)
+
+
+def test_profile_requires_the_token(mocker, profiling_client, settings, tmp_path, fixture_users):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": "userId:0123456789abcdefABCDEF"})
+    response = profiling_client.get(
+        settings.API_V1_STR + "/users/me",
+        headers={"Authorization": "Bearer the_access_token", "X-Docserver-Profile": "wrong"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert "X-Docserver-Profile-Id" not in response.headers
+    assert os.listdir(tmp_path) == []
+
+
+def test_render_folded():
+    samples = profiling.SamplingProfiler().samples
+    samples["main (a.py:1);handler (b.py:3)"] += 2
+    samples["main (a.py:1)"] += 1
+    assert profiling.render_folded(samples) == "main (a.py:1);handler (b.py:3) 2\nmain (a.py:1) 1\n"
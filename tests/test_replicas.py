@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import freezegun
+import pytest
+from docserver.db import ReplicaSet
+from docserver.deps import SessionHandler
+from starlette.requests import Request
+
+
+def fake_engine(name, checkedout=0):
+    return SimpleNamespace(name=name, pool=SimpleNamespace(checkedout=lambda: checkedout))
+
+
+def make_request(method, authorization=None):
+    headers = [] if authorization is None else [(b"authorization", authorization.encode("latin-1"))]
+    return Request({"type": "http", "method": method, "path": "/", "headers": headers})
+
+
+def test_replica_set_round_robin():
+    engines = [fake_engine("a"), fake_engine("b"), fake_engine("c")]
+    replicas = ReplicaSet(engines)
+    assert [next(replicas.candidates()).name for _ in range(4)] == ["a", "b", "c", "a"]
+    assert [d.name for d in replicas.candidates()] == ["b", "c", "a"]
+
+
+def test_replica_set_least_connections():
+    engines = [fake_engine("a", 4), fake_engine("b", 1), fake_engine("c", 2)]
+    replicas = ReplicaSet(engines, strategy="least_connections")
+    assert [d.name for d in replicas.candidates()] == ["b", "c", "a"]
+
+
+def test_replica_set_skips_replicas_marked_down():
+    engines = [fake_engine("a"), fake_engine("b")]
+    replicas = ReplicaSet(engines, retry_seconds=30)
+    with freezegun.freeze_time("2022-07-01 12:00:00") as fdt:
+        replicas.mark_down(engines[0])
+        assert [[d.name for d in replicas.candidates()] for _ in range(2)] == [["b"], ["b"]]
+        fdt.tick(31)
+        assert sorted(d.name for d in replicas.candidates()) == ["a", "b"]
+    replicas.mark_down(engines[0])
+    replicas.mark_down(engines[1])
+    assert list(replicas.candidates()) == []
+
+
+def test_replica_set_rejects_unknown_strategy():
+    with pytest.raises(ValueError):
+        ReplicaSet([], strategy="random")
+
+
+def test_read_your_writes_window(settings):
+    session_handler = SessionHandler(settings.copy(update={"DB_READ_YOUR_WRITES_SECONDS": 5.0}))
+    with freezegun.freeze_time("2022-07-01 12:00:00") as fdt:
+        session_handler.record_write(make_request("GET", "Bearer token_a"))
+        assert not session_handler.reads_own_writes(make_request("GET", "Bearer token_a"))
+        session_handler.record_write(make_request("POST", "Bearer token_a"))
+        assert session_handler.reads_own_writes(make_request("GET", "Bearer token_a"))
+        assert not session_handler.reads_own_writes(make_request("GET", "Bearer token_b"))
+        assert not session_handler.reads_own_writes(make_request("GET"))
+        fdt.tick(6)
+        assert not session_handler.reads_own_writes(make_request("GET", "Bearer token_a"))
+
+
+def test_read_your_writes_recorded_on_commit(test_db, settings):
+    session_handler = SessionHandler(settings.copy(update={"DB_READ_YOUR_WRITES_SECONDS": 5.0}))
+    request = make_request("POST", "Bearer token_a")
+    dependency = session_handler.get_db(request)
+    db = next(dependency)
+    assert not session_handler.reads_own_writes(make_request("GET", "Bearer token_a"))
+    db.commit()
+    assert session_handler.reads_own_writes(make_request("GET", "Bearer token_a"))
+    dependency.close()
+    session_handler.engine.dispose()
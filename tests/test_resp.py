@@ -0,0 +1,175 @@
+import asyncio
+import fnmatch
+import socketserver
+import threading
+import time
+
+import pytest
+from docserver import resp
+from docserver.cache import ByteLRUCache
+
+
+def encode_reply(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(d) for d in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    """Just enough of the Redis protocol for the cache backend and the invalidation bus."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+
+    @property
+    def url(self) -> str:
+        return "redis://127.0.0.1:%d/0" % self.server_address[1]
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command, args = args[0].upper(), args[1:]
+            with server.lock:
+                if command == b"SET":
+                    server.data[args[0]] = args[1]
+                    reply = "OK"
+                elif command == b"GET":
+                    reply = server.data.get(args[0])
+                elif command == b"EXISTS":
+                    reply = int(args[0] in server.data)
+                elif command == b"DEL":
+                    reply = sum(server.data.pop(d, None) is not None for d in args)
+                elif command == b"SADD":
+                    server.data.setdefault(args[0], set()).update(args[1:])
+                    reply = len(args) - 1
+                elif command == b"SMEMBERS":
+                    reply = sorted(server.data.get(args[0], ()))
+                elif command == b"SCAN":
+                    pattern = args[args.index(b"MATCH") + 1].decode()
+                    reply = [b"0", [d for d in server.data if fnmatch.fnmatchcase(d.decode(), pattern)]]
+                elif command == b"PUBLISH":
+                    message = encode_reply([b"message", args[0], args[1]])
+                    for d in server.subscribers:
+                        d.wfile.write(message)
+                    reply = len(server.subscribers)
+                elif command == b"SUBSCRIBE":
+                    server.subscribers.append(self)
+                    reply = [b"subscribe", args[0], 1]
+                else:
+                    reply = "PONG"
+            self.wfile.write(encode_reply(reply))
+
+
+@pytest.fixture
+def resp_server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_parse_url():
+    assert resp.parse_url("redis://:secret@cache:6380/2") == ("cache", 6380, 2, "secret")
+    assert resp.parse_url("redis://localhost") == ("localhost", 6379, 0, None)
+    with pytest.raises(ValueError):
+        resp.parse_url("http://localhost")
+
+
+def test_resp_cache_round_trip(resp_server):
+    cache = resp.RespCache(resp.RespClient(resp_server.url), name="test", max_entry_bytes=8)
+    assert cache.set(("item", "a"), b"payload", version=1, tags=("c1",))
+    assert not cache.set(("item", "b"), b"too large payload", version=1)
+    assert ("item", "a") in cache
+    assert cache.get(("item", "a"), version=1) == b"payload"
+    assert cache.get(("item", "a"), version=2) is None
+    cache.delete_tagged("c1")
+    assert cache.get(("item", "a"), version=1) is None
+
+
+def test_resp_cache_async_calls_run_off_the_event_loop(resp_server, monkeypatch):
+    cache = resp.RespCache(resp.RespClient(resp_server.url), name="test")
+    threads = []
+    execute = cache.client.execute
+
+    def record_thread(*args):
+        threads.append(threading.get_ident())
+        return execute(*args)
+
+    monkeypatch.setattr(cache.client, "execute", record_thread)
+
+    async def round_trip():
+        assert await cache.aset("a", b"payload", version=1)
+        assert await cache.acontains("a")
+        assert await cache.aget("a", version=1) == b"payload"
+        await cache.adelete("a")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(round_trip())
+    assert threads and loop_thread not in threads
+
+
+def test_resp_cache_misses_when_server_is_unreachable(resp_server):
+    url = resp_server.url
+    resp_server.shutdown()
+    resp_server.server_close()
+    cache = resp.RespCache(resp.RespClient(url, timeout=0.5), name="test")
+    assert not cache.set("a", b"payload")
+    assert cache.get("a") is None
+
+
+def test_invalidation_bus_evicts_on_other_workers(resp_server):
+    workers = []
+    for _ in range(2):
+        bus = resp.RespInvalidationBus(resp_server.url)
+        cache = ByteLRUCache(1024, name="responses")
+        bus.attach(cache)
+        bus.start()
+        assert bus.wait_subscribed(5)
+        workers.append((bus, cache))
+    try:
+        for _, cache in workers:
+            cache.set(("item", "a"), b"aaaa", tags=("c1",))
+            cache.set(("item", "b"), b"bbbb", tags=("c2",))
+        workers[0][1].delete(("item", "a"))
+        wait_until(lambda: ("item", "a") not in workers[1][1])
+        workers[1][1].delete_tagged("c2")
+        wait_until(lambda: ("item", "b") not in workers[0][1])
+    finally:
+        for bus, _ in workers:
+            bus.close()
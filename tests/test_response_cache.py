@@ -0,0 +1,116 @@
+from datetime import datetime
+
+from docserver import models, operators
+from docserver.cache import ByteLRUCache
+from fastapi import status
+
+
+def test_byte_lru_cache_evicts_least_recently_used_by_size():
+    cache = ByteLRUCache(10, name="test")
+    assert cache.set("a", b"aaaa")
+    assert cache.set("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    assert cache.set("c", b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.size_bytes == 8
+    assert not cache.set("d", b"d" * 11)
+    assert len(cache) == 2
+
+
+def test_byte_lru_cache_checks_version_and_tags():
+    cache = ByteLRUCache(100, name="test")
+    cache.set("a", b"aaaa", version=1, tags=("c1",))
+    cache.set("b", b"bbbb", version=1, tags=("c2",))
+    assert cache.get("a", version=2) is None
+    assert cache.get("a", version=1) == b"aaaa"
+    cache.delete_tagged("c1")
+    assert "a" not in cache
+    assert cache.get("b", version=1) == b"bbbb"
+    assert cache.size_bytes == 4
+
+
+def item_url(settings, collection, item):
+    return f"{settings.API_V1_STR}/collections/{collection.id}/items/{item.id}"
+
+
+def test_retrieve_item_is_served_from_cache(
+    mocker, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = fixture_items["testuser_items"][collection.id][0]
+    retrieve = mocker.spy(operators, "retrieve_item")
+    headers = {"Authorization": "Bearer the_access_token"}
+    first = client.get(item_url(settings, collection, item), headers=headers)
+    second = client.get(item_url(settings, collection, item), headers=headers)
+    assert first.status_code == second.status_code == status.HTTP_200_OK
+    assert first.json() == second.json()
+    assert second.json()["body"] == 'YWFh'
+    assert retrieve.call_count == 1
+
+
+def test_retrieve_item_cache_is_owner_checked(
+    mocker, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    collection = fixture_collections["testuser_collections"][0]
+    item = fixture_items["testuser_items"][collection.id][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    assert client.get(item_url(settings, collection, item), headers=headers).status_code == status.HTTP_200_OK
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser2'].id}"})
+    response = client.get(item_url(settings, collection, item), headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_update_item_invalidates_cached_item(
+    mocker, client, settings, factories, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = fixture_items["testuser_items"][collection.id][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    assert client.get(item_url(settings, collection, item), headers=headers).json()["body"] == 'YWFh'
+    query = factories.ItemUpdateQueryFactory.build(data_type="text/plain", body=b"updated")
+    assert (
+        client.put(item_url(settings, collection, item), data=query, headers=headers).status_code == status.HTTP_200_OK
+    )
+    response = client.get(item_url(settings, collection, item), headers=headers)
+    assert response.json()["body"] == query.body
+    assert response.json()["dataType"] == "text/plain"
+
+
+def test_delete_collection_invalidates_cached_items(
+    mocker, app, client, settings, fixture_users, fixture_collections, fixture_items
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item = fixture_items["testuser_items"][collection.id][0]
+    # the fixture instances are expired once their rows are gone, so read the ids up front
+    url, item_id = item_url(settings, collection, item), item.id
+    collection_url = f"{settings.API_V1_STR}/collections/{collection.id}"
+    headers = {"Authorization": "Bearer the_access_token"}
+    assert client.get(url, headers=headers).status_code == status.HTTP_200_OK
+    assert ("item", item_id) in app.response_cache
+    response = client.delete(collection_url, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert ("item", item_id) not in app.response_cache
+    response = client.get(url, headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_retrieve_collection_never_serves_an_older_revision(
+    mocker, db, client, settings, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    url = f"{settings.API_V1_STR}/collections/{collection.id}"
+    headers = {"Authorization": "Bearer the_access_token"}
+    assert client.get(url, headers=headers).json()["name"] == collection.name
+    # written behind the route's back, as another worker or a racing request would
+    sess = db.sessionmaker()
+    sess.query(models.Collection).filter(models.Collection.id == collection.id).update(
+        {"name": "renamed", "updated_at": datetime(2023, 1, 1)}, synchronize_session=False
+    )
+    sess.commit()
+    assert client.get(url, headers=headers).json()["name"] == "renamed"
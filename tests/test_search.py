@@ -0,0 +1,124 @@
+import asyncio
+from base64 import urlsafe_b64encode
+
+from docserver import models, operators, search
+from docserver.deps import AsyncSessionHandler
+from fastapi import status
+from sqlalchemy import select
+
+
+def test_extract_text_by_data_type():
+    assert search.extract_text("text/plain", b"Hello World") == "Hello World"
+    assert search.extract_text("application/json", b'{"title": "Alpha", "n": 3, "ok": true}') == "title Alpha n 3 ok"
+    html = b"<html><head><style>p {}</style></head><body><p>Alpha &amp; Beta</p><script>x()</script></body></html>"
+    assert search.tokenize(search.extract_text("text/html", html)) == ["alpha", "beta"]
+    assert search.extract_text("image/svg+xml", b"<svg><text>Gamma</text></svg>") == "Gamma"
+    assert search.extract_text("image/png", b"\x89PNG") is None
+    assert search.extract_text(None, b"text") is None
+
+
+def test_term_weights_and_query_terms():
+    weights = search.term_weights("apple banana apple")
+    assert weights["banana"] == search.term_weight_scale
+    assert weights["apple"] > weights["banana"]
+    assert search.term_weights(None) == {}
+    assert search.query_terms("Banana apple, banana!") == ["apple", "banana"]
+    assert search.query_terms(" ,. ") == []
+
+
+def test_search_cursor_value_round_trip():
+    value = search.format_search_cursor_value(0.1, "1612097014005678|2123456789abcdefABCDEF")
+    assert search.parse_search_cursor_value(value) == (0.1, "1612097014005678|2123456789abcdefABCDEF")
+
+
+def create_text_item(client, settings, collection, data_type, text):
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": data_type, "body": urlsafe_b64encode(text.encode()).decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()["id"]
+
+
+def test_search_collection_items_ranked(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    once = create_text_item(client, settings, collection, "text/plain", "zephyr quokka")
+    twice = create_text_item(client, settings, collection, "text/html", "<p>zephyr quokka zephyr quokka</p>")
+    create_text_item(client, settings, collection, "text/plain", "zephyr only")
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/search",
+        params={"q": "Quokka zephyr"},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    res = response.json()
+    assert [d["id"] for d in res["results"]] == [twice, once]
+    assert res["meta"] == {"count": 2, "nextCursor": None}
+
+
+def test_search_items_paginates_with_cursor(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collections = fixture_collections["testuser_collections"]
+    expected = {create_text_item(client, settings, collections[i % 2], "text/plain", "xylophone") for i in range(12)}
+    headers = {"Authorization": "Bearer the_access_token"}
+    first = client.get(f"{settings.API_V1_STR}/search", params={"q": "xylophone"}, headers=headers).json()
+    assert first["meta"]["count"] == 12
+    assert len(first["results"]) == 10
+    second = client.get(
+        f"{settings.API_V1_STR}/search",
+        params={"q": "xylophone", "cursor": first["meta"]["nextCursor"]},
+        headers=headers,
+    ).json()
+    assert second["meta"]["nextCursor"] is None
+    assert {d["id"] for d in first["results"] + second["results"]} == expected
+
+
+def test_search_items_after_update(mocker, client, settings, factories, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    item_id = create_text_item(client, settings, collection, "text/plain", "walrus")
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.put(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}",
+        data=factories.ItemUpdateQueryFactory.build(data_type=None, body=b"narwhal"),
+        headers=headers,
+    )
+    assert response.status_code == status.HTTP_200_OK
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/search"
+    assert client.get(url, params={"q": "walrus"}, headers=headers).json()["meta"]["count"] == 0
+    assert client.get(url, params={"q": "narwhal"}, headers=headers).json()["meta"]["count"] == 1
+    response = client.put(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}",
+        data=factories.ItemUpdateQueryFactory.build(data_type="application/octet-stream", body=None),
+        headers=headers,
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert client.get(url, params={"q": "narwhal"}, headers=headers).json()["meta"]["count"] == 0
+
+
+def test_search_rejects_empty_query(mocker, client, settings, fixture_users, fixture_collections):
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    response = client.get(
+        f"{settings.API_V1_STR}/search", params={"q": "  "}, headers={"Authorization": "Bearer the_access_token"}
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_text_search_config_binds_on_asyncpg(db, settings):
+    session_handler = AsyncSessionHandler(settings)
+    user = models.User(id="0123456789abcdefABCDEF")
+
+    async def run():
+        try:
+            async with session_handler.async_sessionmaker() as sess:
+                vector = (await sess.execute(select(operators.search_vector_expression("hello world")))).scalar()
+                ranked = operators.full_text_search_statement(user, None, "hello")
+                return vector, (await sess.execute(select(ranked))).all()
+        finally:
+            await session_handler.dispose()
+
+    vector, results = asyncio.run(run())
+    assert vector == "'hello':1 'world':2"
+    assert results == []
@@ -0,0 +1,104 @@
+"""Streams versions and archives through the app's own sessions while another request commits mid-stream.
+
+The test session shares one transaction across requests, so it cannot switch the isolation level that
+operators.use_snapshot asks for; these tests commit their fixtures instead and let the app open real sessions.
+"""
+import io
+import tarfile
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+import pytest
+from docserver import archives, config, operators
+from docserver.app import generate_app
+from fastapi import status
+from test_versions import put_body
+
+# a connection that ignored the REPEATABLE READ option would only warn
+pytestmark = pytest.mark.filterwarnings("error::sqlalchemy.exc.SAWarning")
+
+
+@pytest.fixture(scope="module")
+def settings():
+    yield config.get_setting(
+        DB_DBNAME="test",
+        JOBS_IN_PROCESS_WORKERS=0,
+        REFRESH_TOKEN_SWEEP_INTERVAL_SECONDS=0,
+        ITEM_VERSIONS_PRUNE_INTERVAL_SECONDS=0,
+    )
+
+
+@pytest.fixture(scope="function")
+def db(committing_db):
+    yield committing_db
+
+
+@pytest.fixture(scope="function")
+def app(db, settings):
+    app_ = generate_app(settings)
+    yield app_
+    app_.session_handler.engine.dispose()
+
+
+def create_item(client, settings, collection_id, body: bytes) -> str:
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection_id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(body).decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()["id"]
+
+
+def test_archive_stream_reads_one_snapshot(mocker, client, settings, factories, fixture_users, fixture_collections):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    bodies = {create_item(client, settings, collection.id, d): d for d in (b"first body", b"second body")}
+    iter_item_chunks = operators.iter_item_chunks
+    updated = []
+
+    def update_after_first_item(db, item_id, chunks):
+        yield from iter_item_chunks(db, item_id, chunks)
+        if len(updated) == 0:
+            # every remaining item grows, so sizes read before the update would no longer match its chunks
+            for other_id in bodies.keys() - {item_id}:
+                put_body(client, settings, factories, collection.id, other_id, b"rewritten while streaming")
+                updated.append(other_id)
+
+    mocker.patch("docserver.operators.iter_item_chunks", side_effect=update_after_first_item)
+    response = client.get(
+        f"{settings.API_V1_STR}/collections/{collection.id}/archive",
+        params={"format": "tar"},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert len(updated) == 1
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tar:
+        members = {d.name: tar.extractfile(d).read() for d in tar.getmembers()}
+    assert members == {archives.member_name(k, "text/plain"): v for k, v in bodies.items()}
+
+
+def test_version_stream_reads_one_snapshot(mocker, db, client, settings, factories, fixture_users, fixture_collections):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    item_id = create_item(client, settings, collection.id, b"the body of version one")
+    put_body(client, settings, factories, collection.id, item_id, b"version two")
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}"
+    version_chunk_bodies_statement = operators.version_chunk_bodies_statement
+    deleted = []
+
+    def delete_before_reading_bodies(digest):
+        if len(deleted) == 0:
+            # the item's versions go with it, and pruning drops the bodies only they referred to
+            deleted.append(client.delete(url, headers=headers).status_code)
+            deleted.append(operators.prune_chunk_data(db.sessionmaker(), 100))
+        return version_chunk_bodies_statement(digest)
+
+    mocker.patch("docserver.operators.version_chunk_bodies_statement", side_effect=delete_before_reading_bodies)
+    response = client.get(f"{url}/versions/1", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert deleted == [status.HTTP_200_OK, 6]
+    assert urlsafe_b64decode(response.json()["body"]) == b"the body of version one"
+    assert client.get(f"{url}/versions/1", headers=headers).status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,174 @@
+from base64 import urlsafe_b64encode
+
+import pytest
+from docserver import models, operators, schema, sqlite
+from docserver.deps import SessionHandler
+from sqlalchemy import text
+
+
+@pytest.fixture(scope="function")
+def sqlite_handler(settings, tmp_path) -> SessionHandler:
+    session_handler = SessionHandler(
+        settings.copy(update={"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'docserver.db'}"})
+    )
+    models.Base.metadata.create_all(session_handler.engine)
+    yield session_handler
+    session_handler.engine.dispose()
+    for engine in session_handler.replicas.engines:
+        engine.dispose()
+
+
+def test_sqlite_engines_are_tuned(sqlite_handler):
+    with sqlite_handler.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 1
+        assert conn.execute(text("PRAGMA query_only")).scalar() == 0
+    assert sqlite_handler.engine.pool.size() == 1
+    reader = next(sqlite_handler.replicas.candidates())
+    with reader.connect() as conn:
+        assert conn.execute(text("PRAGMA query_only")).scalar() == 1
+
+
+def test_sqlite_chunks_round_trip_through_blob_io(mocker, sqlite_handler):
+    mocker.patch("docserver.models.chunk_size", 7)
+    mocker.patch("docserver.sqlite.blob_block_size", 3)
+    body = bytes(range(256)) * 3
+    db = sqlite_handler.sessionmaker()
+    try:
+        db.add(models.User(id="0123456789abcdefABCDEF", username="testuser", email="t@x.com", hashed_password="x"))
+        db.flush()
+        db.add(models.Collection(id="1123456789abcdefABCDEF", owner_id="0123456789abcdefABCDEF", name="c"))
+        db.flush()
+        db.add(
+            models.Item(
+                id="2123456789abcdefABCDEF",
+                owner_id="0123456789abcdefABCDEF",
+                collection_id="1123456789abcdefABCDEF",
+                data_type="application/octet-stream",
+            )
+        )
+        db.flush()
+        operators.insert_chunks(db, "2123456789abcdefABCDEF", body)
+        db.commit()
+        assert db.query(models.Chunk).count() == 110
+        assert bytes(sqlite.read_chunks(db, "2123456789abcdefABCDEF")) == body
+    finally:
+        db.close()
+
+
+def test_sqlite_search_uses_term_index(sqlite_handler):
+    db = sqlite_handler.sessionmaker()
+    user = models.User(id="0123456789abcdefABCDEF", username="testuser", email="t@x.com", hashed_password="x")
+    try:
+        db.add(user)
+        db.add(models.Collection(id="1123456789abcdefABCDEF", owner_id=user.id, name="c"))
+        db.commit()
+        items = [
+            operators.create_item(
+                db,
+                user,
+                "1123456789abcdefABCDEF",
+                schema.ItemCreateQuery(data_type="text/plain", body=urlsafe_b64encode(d).decode()),
+            )
+            for d in (b"apple banana", b"apple apple banana", b"cherry")
+        ]
+        res = operators.search_items(db, user, "banana apple", collection_id="1123456789abcdefABCDEF")
+        assert [d.id for d in res["results"]] == [items[1].id, items[0].id]
+        operators.update_item(
+            db, user, "1123456789abcdefABCDEF", items[2].id, schema.ItemUpdateQuery(data_type="image/png")
+        )
+        assert operators.search_items(db, user, "cherry")["meta"]["count"] == 0
+        assert db.query(models.ItemTerm).filter(models.ItemTerm.item_id == items[2].id).count() == 0
+    finally:
+        db.close()
+
+
+def test_sqlite_chunks_round_trip_without_blob_io(mocker, sqlite_handler):
+    mocker.patch("docserver.models.chunk_size", 7)
+    mocker.patch("docserver.sqlite.has_blob_io", return_value=False)
+    body = bytes(range(256))
+    db = sqlite_handler.sessionmaker()
+    try:
+        user = operators.create_user(
+            db, schema.UserCreateQuery(username="testuser", email="t@x.com", password="p@ssW0rd")
+        )
+        collection = operators.create_collection(db, schema.CollectionCreateQuery(name="c"), user)
+        item = operators.create_item(
+            db,
+            user,
+            collection.id,
+            schema.ItemCreateQuery(data_type="application/octet-stream", body=urlsafe_b64encode(body).decode()),
+        )
+        assert bytes(sqlite.read_chunks(db, item.id)) == body
+        assert b"".join(sqlite.iter_chunks(db, item.id)) == body
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize("blob_io", [True, False])
+def test_sqlite_reads_copied_chunks_by_digest(mocker, sqlite_handler, blob_io):
+    mocker.patch("docserver.models.chunk_size", 7)
+    mocker.patch("docserver.sqlite.blob_block_size", 3)
+    if not blob_io:
+        mocker.patch("docserver.sqlite.has_blob_io", return_value=False)
+    body = bytes(range(256))
+    db = sqlite_handler.sessionmaker()
+    try:
+        user = operators.create_user(
+            db, schema.UserCreateQuery(username="testuser", email="t@x.com", password="p@ssW0rd")
+        )
+        collection = operators.create_collection(db, schema.CollectionCreateQuery(name="c"), user)
+        item = operators.create_item(
+            db,
+            user,
+            collection.id,
+            schema.ItemCreateQuery(data_type="application/octet-stream", body=urlsafe_b64encode(body).decode()),
+        )
+        copy = operators.copy_item(db, user, collection.id, item.id, collection.id, 100)
+        assert db.query(models.Chunk).filter(models.Chunk.stored_body.is_(None)).count() == 37
+        for item_id in (item.id, copy.id):
+            assert bytes(sqlite.read_chunks(db, item_id)) == body
+            assert b"".join(sqlite.iter_chunks(db, item_id)) == body
+        operators.delete_item(db, user, collection.id, item.id)
+        assert db.query(models.ChunkData).count() == 37
+        assert bytes(sqlite.read_chunks(db, copy.id)) == body
+        assert b"".join(sqlite.iter_chunks(db, copy.id)) == body
+    finally:
+        db.close()
+
+
+def test_sqlite_writes_emulate_returning(sqlite_handler):
+    db = sqlite_handler.sessionmaker()
+    try:
+        user = operators.create_user(
+            db, schema.UserCreateQuery(username="testuser", email="t@x.com", password="p@ssW0rd")
+        )
+        assert user.username == "testuser"
+        collection = operators.create_collection(db, schema.CollectionCreateQuery(name="c"), user)
+        assert operators.create_collection(db, schema.CollectionCreateQuery(name="c"), user).id != collection.id
+        assert operators.update_collection(db, user, collection.id, schema.CollectionUpdateQuery(name="d")).name == "d"
+        item = operators.create_item(
+            db,
+            user,
+            collection.id,
+            schema.ItemCreateQuery(data_type="text/plain", body=urlsafe_b64encode(b"abc").decode()),
+        )
+        assert (
+            operators.create_item(
+                db,
+                user,
+                "9123456789abcdefABCDEF",
+                schema.ItemCreateQuery(data_type="text/plain", body=urlsafe_b64encode(b"abc").decode()),
+            )
+            is None
+        )
+        updated = operators.update_item(
+            db, user, collection.id, item.id, schema.ItemUpdateQuery(body=urlsafe_b64encode(b"abcd").decode())
+        )
+        assert updated.id == item.id and updated.data_type == "text/plain"
+        assert operators.delete_item(db, user, collection.id, item.id) == item.id
+        assert operators.delete_item(db, user, collection.id, item.id) is None
+        assert operators.delete_collection(db, user, collection.id) == collection.id
+    finally:
+        db.close()
@@ -1,59 +1,13 @@
 from datetime import datetime, timedelta
-from unittest.mock import call
 
 import freezegun
-from docserver import models
+from docserver import models, operators, utils
 from fastapi import status
-from jose.exceptions import ExpiredSignatureError
 
 
 def test_get_token_with_generated_refresh_token(mocker, settings, db, client, factories, fixture_users):
-    m = mocker.patch("docserver.operators.jwt.encode", side_effect=["the_refresh_token", "the_access_token"])
-    dt = datetime(2021, 1, 31, 12, 23, 34, 5678)
-    query = factories.UserLoginQueryFactory.build(login_id="testuser", password="p@ssW0rd")
-    with freezegun.freeze_time(dt):
-        response = client.post(
-            settings.API_V1_STR + "/token",
-            data=query,
-        )
-        assert response.status_code == status.HTTP_200_OK
-        res_json = response.json()
-        assert res_json["tokenType"] == "bearer"
-        assert res_json["accessToken"] == "the_access_token"
-        assert res_json["refreshToken"] == "the_refresh_token"
-        m.assert_has_calls(
-            [
-                call(
-                    {
-                        "sub": "userId:0123456789abcdefABCDEF",
-                        "exp": dt + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
-                    },
-                    key=settings.SECRET_KEY,
-                    algorithm=settings.ALGORITHM,
-                )
-            ],
-            [
-                call(
-                    {
-                        "sub": "userId:0123456789abcdefABCDEF",
-                        "exp": dt + timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES),
-                    },
-                    key=settings.SECRET_KEY,
-                    algorithm=settings.ALGORITHM,
-                )
-            ],
-        )
-        sess = db.sessionmaker()
-        x = sess.query(models.RefreshToken).filter_by(user_id="0123456789abcdefABCDEF").one()
-        assert x.token == "the_refresh_token"
-        assert x.created_at == dt
-        assert x.updated_at == dt
-        sess.close()
-
-
-def test_get_token_with_stored_refresh_token(mocker, settings, client, factories, fixture_refresh_token):
     encode = mocker.patch("docserver.operators.jwt.encode", return_value="the_access_token")
-    decode = mocker.patch("docserver.operators.jwt.decode", return_value={"sub": "userId:0123456789abcdefABCDEF"})
+    mocker.patch("docserver.utils.gen_refresh_token", return_value="the_refresh_token")
     dt = datetime(2021, 1, 31, 12, 23, 34, 5678)
     query = factories.UserLoginQueryFactory.build(login_id="testuser", password="p@ssW0rd")
     with freezegun.freeze_time(dt):
@@ -74,58 +28,32 @@ def test_get_token_with_stored_refresh_token(mocker, settings, client, factories
             key=settings.SECRET_KEY,
             algorithm=settings.ALGORITHM,
         )
-        decode.assert_called_once_with("the_refresh_token", key=settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-
+        sess = db.sessionmaker()
+        x = sess.query(models.RefreshToken).filter_by(user_id="0123456789abcdefABCDEF").one()
+        assert x.digest == utils.calc_token_digest("the_refresh_token")
+        assert x.expires_at == dt + timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES)
+        assert x.rotated_at is None
+        assert x.created_at == dt
+        assert x.updated_at == dt
+        sess.close()
 
-def test_get_token_with_stored_but_old_refresh_token(mocker, settings, db, client, factories, fixture_refresh_token):
-    def raise_expired_signature_error(*args, **kwargs):
-        raise ExpiredSignatureError
 
-    encode = mocker.patch(
-        "docserver.operators.jwt.encode", side_effect=["the_regenerated_refresh_token", "the_access_token"]
-    )
-    decode = mocker.patch("docserver.operators.jwt.decode", side_effect=raise_expired_signature_error)
-    dt = datetime(2021, 1, 31, 12, 23, 34, 5678)
+def test_get_token_starts_new_family_on_every_login(mocker, settings, db, client, factories, fixture_refresh_token):
+    mocker.patch("docserver.operators.jwt.encode", return_value="the_access_token")
+    mocker.patch("docserver.utils.gen_refresh_token", return_value="the_new_refresh_token")
     query = factories.UserLoginQueryFactory.build(login_id="testuser", password="p@ssW0rd")
-    with freezegun.freeze_time(dt):
+    with freezegun.freeze_time(datetime(2021, 1, 31, 12, 23, 34, 5678)):
         response = client.post(
             settings.API_V1_STR + "/token",
             data=query,
         )
         assert response.status_code == status.HTTP_200_OK
-        res_json = response.json()
-        assert res_json["tokenType"] == "bearer"
-        assert res_json["accessToken"] == "the_access_token"
-        assert res_json["refreshToken"] == "the_regenerated_refresh_token"
-        encode.assert_has_calls(
-            [
-                call(
-                    {
-                        "sub": "userId:0123456789abcdefABCDEF",
-                        "exp": dt + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
-                    },
-                    key=settings.SECRET_KEY,
-                    algorithm=settings.ALGORITHM,
-                )
-            ],
-            [
-                call(
-                    {
-                        "sub": "userId:0123456789abcdefABCDEF",
-                        "exp": dt + timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES),
-                    },
-                    key=settings.SECRET_KEY,
-                    algorithm=settings.ALGORITHM,
-                )
-            ],
-        )
-        decode.assert_called_once_with("the_refresh_token", key=settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        sess = db.sessionmaker()
-        x = sess.query(models.RefreshToken).filter_by(user_id="0123456789abcdefABCDEF").one()
-        assert x.token == "the_regenerated_refresh_token"
-        assert x.created_at != dt
-        assert x.updated_at == dt
-        sess.close()
+        assert response.json()["refreshToken"] == "the_new_refresh_token"
+    sess = db.sessionmaker()
+    x = sess.query(models.RefreshToken).filter_by(digest=utils.calc_token_digest("the_new_refresh_token")).one()
+    assert x.family_id != "2234567890abcdefABCDEF"
+    assert sess.query(models.RefreshToken).filter_by(user_id="0123456789abcdefABCDEF").count() == 2
+    sess.close()
 
 
 def test_get_token_fails_when_wrong_password(client, settings, factories, fixture_users):
@@ -137,9 +65,9 @@ def test_get_token_fails_when_wrong_password(client, settings, factories, fixtur
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
 
 
-def test_get_token_by_refresh_token(mocker, client, settings, factories, fixture_refresh_token):
+def test_get_token_by_refresh_token_rotates_it(mocker, db, client, settings, factories, fixture_refresh_token):
     encode = mocker.patch("docserver.operators.jwt.encode", return_value="the_access_token")
-    decode = mocker.patch("docserver.operators.jwt.decode", return_value={"sub": "userId:0123456789abcdefABCDEF"})
+    mocker.patch("docserver.utils.gen_refresh_token", return_value="the_rotated_refresh_token")
     dt = datetime(2021, 1, 31, 12, 23, 34, 5678)
     query = factories.RefreshTokenQueryFactory.build(refresh_token="the_refresh_token")
     with freezegun.freeze_time(dt):
@@ -151,7 +79,7 @@ def test_get_token_by_refresh_token(mocker, client, settings, factories, fixture
         res_json = response.json()
         assert res_json["tokenType"] == "bearer"
         assert res_json["accessToken"] == "the_access_token"
-        assert res_json["refreshToken"] == "the_refresh_token"
+        assert res_json["refreshToken"] == "the_rotated_refresh_token"
         encode.assert_called_once_with(
             {
                 "sub": "userId:0123456789abcdefABCDEF",
@@ -160,4 +88,55 @@ def test_get_token_by_refresh_token(mocker, client, settings, factories, fixture
             key=settings.SECRET_KEY,
             algorithm=settings.ALGORITHM,
         )
-        decode.assert_called_once_with("the_refresh_token", key=settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+    sess = db.sessionmaker()
+    old = sess.query(models.RefreshToken).get("1234567890abcdefABCDEF")
+    assert old.rotated_at == dt
+    new = sess.query(models.RefreshToken).filter_by(digest=utils.calc_token_digest("the_rotated_refresh_token")).one()
+    assert new.family_id == "2234567890abcdefABCDEF"
+    assert new.rotated_at is None
+    assert new.expires_at == dt + timedelta(minutes=settings.REFRESH_TOKEN_EXPIRE_MINUTES)
+    sess.close()
+
+
+def test_get_token_by_reused_refresh_token_revokes_family(
+    mocker, db, client, settings, factories, fixture_refresh_token
+):
+    mocker.patch("docserver.operators.jwt.encode", return_value="the_access_token")
+    mocker.patch("docserver.utils.gen_refresh_token", return_value="the_rotated_refresh_token")
+    query = factories.RefreshTokenQueryFactory.build(refresh_token="the_refresh_token")
+    with freezegun.freeze_time(datetime(2021, 1, 31, 12, 23, 34, 5678)):
+        response = client.post(settings.API_V1_STR + "/token", data=query)
+        assert response.status_code == status.HTTP_200_OK
+        response = client.post(settings.API_V1_STR + "/token", data=query)
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    sess = db.sessionmaker()
+    assert sess.query(models.RefreshToken).filter_by(family_id="2234567890abcdefABCDEF").count() == 0
+    sess.close()
+
+
+def test_get_token_by_expired_refresh_token_fails(mocker, client, settings, factories, fixture_refresh_token):
+    query = factories.RefreshTokenQueryFactory.build(refresh_token="the_refresh_token")
+    with freezegun.freeze_time(datetime(2021, 3, 1, 0, 0, 1)):
+        response = client.post(settings.API_V1_STR + "/token", data=query)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_get_token_by_unknown_refresh_token_fails(client, settings, factories, fixture_refresh_token):
+    query = factories.RefreshTokenQueryFactory.build(refresh_token="unknown_refresh_token")
+    with freezegun.freeze_time(datetime(2021, 1, 31, 12, 23, 34, 5678)):
+        response = client.post(settings.API_V1_STR + "/token", data=query)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_delete_expired_refresh_tokens(db, factories, fixture_refresh_token):
+    factories.RefreshTokenFactory(
+        id="1234567890abcdefABCDEG",
+        user_id="0123456789abcdefABCDEF",
+        family_id="2234567890abcdefABCDEG",
+        digest=utils.calc_token_digest("the_other_refresh_token"),
+        expires_at=datetime(2021, 4, 1, 0, 0, 0),
+    )
+    sess = db.sessionmaker()
+    assert operators.delete_expired_refresh_tokens(sess, now=datetime(2021, 3, 15)) == 1
+    assert [d.id for d in sess.query(models.RefreshToken)] == ["1234567890abcdefABCDEG"]
+    sess.close()
@@ -0,0 +1,116 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from docserver import models, operators, utils
+from fastapi import status
+
+
+def test_diff_chunks_only_rewrites_changed_chunks(mocker):
+    mocker.patch("docserver.models.chunk_size", 4)
+    live = {0: utils.calc_chunk_digest(b"aaaa"), 1: utils.calc_chunk_digest(b"bbbb"), 2: utils.calc_chunk_digest(b"cc")}
+    changed, stale = operators.diff_chunks("item", b"aaaaBBBB", live)
+    assert [(d["index"], bytes(d["body"])) for d in changed] == [(1, b"BBBB")]
+    assert stale == [1, 2]
+    assert operators.archived_chunk_indexes({0: "x", 1: "y", 2: "y"}, [1, 2]) == [2]
+
+
+def put_body(client, settings, factories, collection_id, item_id, body):
+    response = client.put(
+        f"{settings.API_V1_STR}/collections/{collection_id}/items/{item_id}",
+        data=factories.ItemUpdateQueryFactory.build(data_type=None, body=body),
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_item_versions_share_unchanged_chunks(
+    mocker, db, client, settings, factories, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(b"aaaabbbbcccc").decode()},
+        headers=headers,
+    )
+    item_id = response.json()["id"]
+    put_body(client, settings, factories, collection.id, item_id, b"aaaaBBBBcccc")
+    put_body(client, settings, factories, collection.id, item_id, b"aaaaBBBB")
+
+    sess = db.sessionmaker()
+    archived = sess.query(models.ChunkData).all()
+    assert sorted(bytes(d.body) for d in archived) == [b"bbbb", b"cccc"]
+
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items/{item_id}/versions"
+    res = client.get(url, headers=headers).json()["results"]
+    assert [(d["version"], d["size"]) for d in res] == [(2, 12), (1, 12)]
+    for version, body in ((1, b"aaaabbbbcccc"), (2, b"aaaaBBBBcccc")):
+        response = client.get(f"{url}/{version}", headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert (response.json()["version"], urlsafe_b64decode(response.json()["body"])) == (version, body)
+    assert client.get(f"{url}/3", headers=headers).status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_prune_item_versions_keeps_newest(mocker, db, client, settings, factories, fixture_users, fixture_collections):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    response = client.post(
+        f"{settings.API_V1_STR}/collections/{collection.id}/items",
+        json={"dataType": "text/plain", "body": urlsafe_b64encode(b"v0v0").decode()},
+        headers={"Authorization": "Bearer the_access_token"},
+    )
+    item_id = response.json()["id"]
+    for body in (b"v1v1", b"v2v2", b"v3v3"):
+        put_body(client, settings, factories, collection.id, item_id, body)
+
+    sess = db.sessionmaker()
+    assert operators.prune_item_versions(sess, 1, None, 100) == 2
+    assert [d.version for d in sess.query(models.ItemVersion).filter(models.ItemVersion.item_id == item_id)] == [3]
+    assert [bytes(d.body) for d in sess.query(models.ChunkData)] == [b"v2v2"]
+    assert operators.prune_item_versions(sess, 1, None, 100) == 0
+    sess.close()
+
+
+def test_prune_chunk_data_removes_bodies_of_deleted_items(
+    mocker, db, client, settings, factories, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items"
+    response = client.post(
+        url, json={"dataType": "text/plain", "body": urlsafe_b64encode(b"v0v0").decode()}, headers=headers
+    )
+    item_id = response.json()["id"]
+    put_body(client, settings, factories, collection.id, item_id, b"v1v1")
+
+    sess = db.sessionmaker()
+    assert operators.prune_chunk_data(sess, 100) == 0
+    assert client.delete(f"{url}/{item_id}", headers=headers).status_code == status.HTTP_200_OK
+    assert operators.prune_chunk_data(sess, 100) == 1
+    assert sess.query(models.ChunkData).count() == 0
+
+
+def test_versions_of_copies_outlive_the_source(
+    mocker, db, client, settings, factories, fixture_users, fixture_collections
+):
+    mocker.patch("docserver.models.chunk_size", 4)
+    mocker.patch("docserver.operators.jwt.decode", return_value={"sub": f"userId:{fixture_users['testuser'].id}"})
+    collection = fixture_collections["testuser_collections"][0]
+    headers = {"Authorization": "Bearer the_access_token"}
+    url = f"{settings.API_V1_STR}/collections/{collection.id}/items"
+    response = client.post(
+        url, json={"dataType": "text/plain", "body": urlsafe_b64encode(b"s0s0").decode()}, headers=headers
+    )
+    source_id = response.json()["id"]
+    response = client.post(f"{url}/{source_id}:copy", json={"collectionId": collection.id}, headers=headers)
+    copy_id = response.json()["id"]
+    put_body(client, settings, factories, collection.id, copy_id, b"c1c1")
+
+    assert client.delete(f"{url}/{source_id}", headers=headers).status_code == status.HTTP_200_OK
+    response = client.get(f"{url}/{copy_id}/versions/1", headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert urlsafe_b64decode(response.json()["body"]) == b"s0s0"